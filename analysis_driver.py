@@ -1,9 +1,30 @@
 #!/bin/env python
 #import evaluate_pp
 import os
-import subprocess
-import eval_pp
 import sys
+import time
+
+# When run by dakota with OPAL_EVAL_SOCKET set, hand the evaluation to a
+# running eval_server.py instead of importing everything below.
+# Falls through to a normal local evaluation if no server is listening.
+if __name__ == '__main__' and 'OPAL_EVAL_SOCKET' in os.environ:
+    import eval_client
+    exit_code = eval_client.forward(os.environ['OPAL_EVAL_SOCKET'], sys.argv[1:])
+    if exit_code is not None:
+        sys.exit(exit_code)
+
+import atompaw_watchdog
+import compact
+import diaryf
+import dprepro
+import eval_pp
+import eval_trace
+import failure_ledger
+import file_cache
+import pp_cache
+import procgroup
+import result_store
+import workspace as workspace_layout
 import dakota_interfacing_2.interfacing.parallel as di
 
 # # EXAMPLE FROM DAKOTA DOCS (share/dakota/Python/dakota/interfacing/__init__.py)
@@ -24,14 +45,40 @@ import dakota_interfacing_2.interfacing.parallel as di
 class PseudopotentialFail(Exception):
     """raised if pseudopotential creation failed with given inputs"""
 
+class PseudopotentialTransientFail(PseudopotentialFail):
+    """
+    raised if pseudopotential creation failed for reasons of the machine
+    rather than the inputs, e.g. no tile for atompaw in time. Penalized,
+    but not recorded in the failure ledger.
+    """
+
+# exit code of a pseudopotential creation child process that raised
+# PseudopotentialFail, as opposed to one that crashed
+PSEUDOPOTENTIAL_FAIL_EXITCODE = 3
+# and of one that raised PseudopotentialTransientFail
+PSEUDOPOTENTIAL_TRANSIENT_FAIL_EXITCODE = 4
+
+# seconds run_atompaw waits for a tile before giving up
+ATOMPAW_MAX_TILE_WAIT = 3600.
+
+# mpirun arguments for one atompaw run
+ATOMPAW_COMMANDS = [(1, ["-np", "1", "--bind-to", "none", "atompaw"])]
+
+# opal.in settings the objectives of an evaluation depend on: the
+# convergence search and its options, and the limits that kill socorro runs
+RESULT_SETTINGS = ['element_list', 'gcuts', 'energy_tol', 'gcut_search', 'speculative_gcuts',
+                   'convergence_subset', 'convergence_verify', 'convergence_history',
+                   'restart_files', 'scf_divergence_steps', 'scf_stagnation_steps',
+                   'scf_max_steps']
+
 
 
-def main():
+def main(params_file='params', results_file='results'):
     """
     required files in run directory: 
         ../opal.in  (contains some user settings for optimization)
-        params  (created by dakota)
-        results  (created by dakota)
+        params  (created by dakota, name given by params_file)
+        results  (created by dakota, name given by results_file)
 
     the Results and Parameters objects are created using dakota's python interface
     """
@@ -39,116 +86,435 @@ def main():
         sys.stdout = ad_log
         # read settings from input file
         settings = read_inputs('../opal.in')
-        element_list = settings['element_list']
-        templates_dir = settings['templates_dir']
-        gcuts = map(float, settings['gcuts'])
-        energy_tol = float(settings['energy_tol'])
+        retention_policy = settings.get('retention_policy', 'none')
+        assert retention_policy in compact.RETENTION_POLICIES, \
+            "retention_policy must be one of " + ' '.join(compact.RETENTION_POLICIES)
+        assert settings.get('gcut_search', 'linear') in eval_pp.GCUT_SEARCHES, \
+            "gcut_search must be one of " + ' '.join(eval_pp.GCUT_SEARCHES)
+        assert settings.get('launch_engine', 'fork') in eval_pp.LAUNCH_ENGINES, \
+            "launch_engine must be one of " + ' '.join(eval_pp.LAUNCH_ENGINES)
+        trace_file = settings.get('trace_file')
+        if trace_file is not None:
+            eval_trace.start(workspace_layout.Workspace().trace_spool_file())
 
         # Parse the Dakota parameters file and construct Parameters and Results objects
-        params, results = di.read_parameters_file("params", "results")
-
-        preprocess_pseudopotential_input_files(element_list, templates_dir)
-        pseudopotential_success = create_all_pseudopotentials(element_list)
-        if pseudopotential_success:
-            try:
-                objectives = eval_pp.main(element_list, gcuts, energy_tol)
-                results['accu'].function = objectives['accu']
-                results['work'].function = objectives['work']
-            except eval_pp.SocorroFail:
-                # if a socorro run fails
-                results['accu'].function = 102
-                results['work'].function = 102
-            except eval_pp.NoCutoffConvergence:
-                # if the results don't converge with respect to plane wave cutoff
-                results['accu'].function = 95
-                results['work'].function = 95
-        else:
-            # if pseudopotential creation unsuccessful
-            results['accu'].function = 100
-            results['work'].function = 100
+        params, results = di.read_parameters_file(params_file, results_file)
 
+        outcome = evaluate(settings, params, results)
         results.write()
 
-    
+        if trace_file is not None:
+            eval_trace.finish(trace_file, eval_id=params.eval_id, outcome=outcome,
+                              accu=results['accu'].function, work=results['work'].function)
+
+    # pack and clean up this evaluation's outputs without holding up dakota
+    compact.compact_in_background(os.getcwd(), retention_policy)
 
-def create_all_pseudopotentials(element_list):
+
+
+def evaluate(settings, params, results):
+    """
+    sets the accu and work objectives of results for the parameters
+    in params, running atompaw and socorro in the current directory
+    if needed. The current directory is read here once; everything
+    below gets its paths from a workspace.Workspace.
+
+    returns the outcome of the evaluation: 'success', the kind of failure
+    ('atompaw', 'socorro' or 'cutoff'), 'stored' if an identical evaluation
+    was found in the result store, or 'near ' and the kind of failure if
+    the parameters were close to a failure in the failure ledger.
+    """
+    element_list = settings['element_list']
+    templates_dir = settings['templates_dir']
+    gcuts = map(float, settings['gcuts'])
+    energy_tol = float(settings['energy_tol'])
+    eval_pp_options = get_eval_pp_options(settings)
+    workspace = workspace_layout.Workspace()
+    pseudopotential_cache = get_pseudopotential_cache(settings)
+    watchdog = get_atompaw_watchdog(settings)
+
+    # reuse the result of an identical earlier evaluation
+    store = get_result_store(settings)
+    if store is not None:
+        key = evaluation_key(params, settings, workspace)
+        stored = store.get(key)
+        if stored is not None:
+            print 'Using stored result of an identical evaluation', key
+            results['accu'].function = stored['accu']
+            results['work'].function = stored['work']
+            return 'stored'
+
+    # skip the evaluation if the parameters are close to a known failure
+    ledger = get_failure_ledger(settings)
+    if ledger is not None:
+        param_vector = failure_ledger.parameter_vector(params)
+        known_failure = ledger.lookup(param_vector)
+        if known_failure is not None:
+            print 'Parameters are near a recorded', known_failure, 'failure'
+            results['accu'].function = failure_ledger.PENALTIES[known_failure]
+            results['work'].function = failure_ledger.PENALTIES[known_failure]
+            return 'near ' + known_failure
+
+    failure = None
+    transient = False  # failed for reasons of the machine, not of params
+    with eval_trace.span('preprocess'):
+        preprocess_pseudopotential_input_files(element_list, templates_dir, params, workspace)
+    with eval_trace.span('pseudopotentials'):
+        try:
+            pseudopotential_success = create_all_pseudopotentials(element_list,
+                                                                  pseudopotential_cache,
+                                                                  watchdog, workspace)
+        except PseudopotentialTransientFail:
+            pseudopotential_success = False
+            transient = True
+    if pseudopotential_success:
+        try:
+            objectives = eval_pp.main(element_list, gcuts, energy_tol, workspace=workspace,
+                                      **eval_pp_options)
+            results['accu'].function = objectives['accu']
+            results['work'].function = objectives['work']
+        except eval_pp.SocorroFail:
+            # if a socorro run fails
+            results['accu'].function = 102
+            results['work'].function = 102
+            failure = 'socorro'
+        except eval_pp.NoCutoffConvergence:
+            # if the results don't converge with respect to plane wave cutoff
+            results['accu'].function = 95
+            results['work'].function = 95
+            failure = 'cutoff'
+    else:
+        # if pseudopotential creation unsuccessful
+        results['accu'].function = 100
+        results['work'].function = 100
+        failure = 'atompaw'
+
+    if ledger is not None and failure is not None and not transient:
+        ledger.record(failure, param_vector)
+    # penalties are not stored: whether atompaw is killed depends on its
+    # timeouts, and the failure ledger already remembers failed parameters
+    if store is not None and failure is None:
+        store.put(key, {'accu': results['accu'].function,
+                        'work': results['work'].function})
+    return failure or 'success'
+
+
+
+def create_all_pseudopotentials(element_list, pseudopotential_cache=None, watchdog=None,
+                                workspace=None):
     """
     For each element, attempt to create pseudopotential.
 
+    The elements are run concurrently, each in its own process group.
+    The first failure terminates the atompaw runs still going for the
+    other elements.
+
     Returns True if all pseudopotentials were created succesfully, 
-    False otherwise.
+    False otherwise. Raises PseudopotentialTransientFail if one failed
+    for reasons of the machine rather than its inputs.
     """
-    for elem in element_list:
-        try:
-            create_a_pseudopotential(elem)
-        except PseudopotentialFail:
-            return False
-    return True   
+    processes = [procgroup.start_process_group(_create_a_pseudopotential_worker,
+                                               args=(elem, pseudopotential_cache, watchdog,
+                                                     workspace))
+                 for elem in element_list]
+    failed = procgroup.wait_all(processes)
+    if failed is None:
+        return True
+    elif failed.exitcode == PSEUDOPOTENTIAL_FAIL_EXITCODE:
+        return False
+    elif failed.exitcode == PSEUDOPOTENTIAL_TRANSIENT_FAIL_EXITCODE:
+        raise PseudopotentialTransientFail
+    else:
+        # not a bad pseudopotential, something else went wrong
+        raise RuntimeError('pseudopotential creation exited with code %s'
+                           % failed.exitcode)
+
+
+
+def _create_a_pseudopotential_worker(elem, pseudopotential_cache, watchdog, workspace):
+    """
+    create_a_pseudopotential for use in a child process, where the
+    failure has to be reported through the exit code
+    """
+    try:
+        create_a_pseudopotential(elem, pseudopotential_cache, watchdog, workspace)
+    except PseudopotentialTransientFail:
+        sys.exit(PSEUDOPOTENTIAL_TRANSIENT_FAIL_EXITCODE)
+    except PseudopotentialFail:
+        sys.exit(PSEUDOPOTENTIAL_FAIL_EXITCODE)
    
 
 
-def create_a_pseudopotential(elem):
+def create_a_pseudopotential(elem, pseudopotential_cache=None, watchdog=None, workspace=None):
     """
-    Creates a pseudopotential assuming input file is in current directory,
-    and it is named {elem}.in
+    Creates a pseudopotential assuming input file is in the workspace
+    (by default, the current directory), and it is named {elem}.in
 
     The pseudopotential is generated in a named directory where all 
     output files can be nicely stored, and then symlinked
-    to the current directory as PAW.{elem} 
+    to the workspace as PAW.{elem} 
+
+    If a PseudopotentialCache is given and already holds a pseudopotential
+    for this exact input file, it is linked into the named directory and
+    atompaw is not run. Newly created pseudopotentials are added to the cache.
+
+    If an AtompawWatchdog is given, atompaw is run under it, and a run it
+    kills counts as a failure. A run killed for taking too long is a
+    transient failure: runtimes depend on the load of the machine.
 
     raises PseudopotentialFail exception if no pseudopotential can be created.
+    raises PseudopotentialTransientFail if atompaw found no tile in time
+    or was killed by the watchdog's timeout.
     """
-    start_dir = os.getcwd()
-    atompaw_input_filename = os.path.join(start_dir, elem+'.in')
+    if workspace is None:
+        workspace = workspace_layout.Workspace()
+    atompaw_input_filename = workspace.path(elem+'.in')
     pseudopotential_name = elem+'.SOCORRO.atomicdata'
 
     dir_name = elem+'_pseudopotential'
-    os.mkdir(dir_name)
-    os.chdir(dir_name)
-
-    run_atompaw(atompaw_input_filename)
-    if os.path.isfile(pseudopotential_name):
-        # if pseudopotential actually created, symlink to it
-        os.chdir(start_dir)
-        os.symlink(os.path.join(dir_name, pseudopotential_name), 'PAW.'+elem)
+    pp_dir = workspace.pseudopotential_dir(elem)
+    pp_path = os.path.join(pp_dir, pseudopotential_name)
+    pp_link = workspace.path('PAW.'+elem)
+    os.mkdir(pp_dir)
+
+    cache_key = None
+    if pseudopotential_cache is not None:
+        cache_key = pseudopotential_cache.key(elem, atompaw_input_filename)
+        if pseudopotential_cache.fetch(cache_key, elem, pp_path):
+            print 'Using cached pseudopotential for', elem, cache_key
+            os.symlink(os.path.join(dir_name, pseudopotential_name), pp_link)
+            return
+
+    try:
+        kill_reason = run_atompaw(atompaw_input_filename, watchdog, pp_dir)
+    except di.ResourceError as e:
+        print 'atompaw run for', elem, 'found no tile:', e
+        raise PseudopotentialTransientFail
+    if kill_reason is not None:
+        print 'atompaw run for', elem, 'killed:', kill_reason
+        if watchdog.timed_out:
+            raise PseudopotentialTransientFail
+        raise PseudopotentialFail
+    if os.path.isfile(pp_path):
+        # if pseudopotential actually created, cache it and symlink to it
+        if pseudopotential_cache is not None:
+            pseudopotential_cache.store(cache_key, elem, pp_path)
+        os.symlink(os.path.join(dir_name, pseudopotential_name), pp_link)
     else:
-        os.chdir(start_dir)
         raise PseudopotentialFail
      
 
 
-def run_atompaw(atompaw_input_filename):
+def run_atompaw(atompaw_input_filename, watchdog=None, run_dir=None):
     """
-    runs atompaw in current directory for given input file
+    runs atompaw in run_dir (by default, the current directory) for given
+    input file
     currently assumes atompaw4
 
     For tile_run_dynamic, the first argument should be the tile size
     determined by the socorro runs, while np should always be 1.
+    While every tile is taken (e.g. by the socorro runs of other
+    evaluations), atompaw waits, trying again every
+    eval_pp.TILE_RETRY_SECONDS for up to ATOMPAW_MAX_TILE_WAIT seconds,
+    then raises parallel.ResourceError.
+
+    returns reason the watchdog killed atompaw, or None if it wasn't killed
+    (or there is no watchdog).
     """
-    with open(atompaw_input_filename,'r') as input_fin, open('log', 'w') as log_fout: 
+    if run_dir is None:
+        run_dir = os.getcwd()
+    log_path = os.path.join(run_dir, 'log')
+    kwargs = {}
+    if watchdog is not None:
+        elem = os.path.basename(atompaw_input_filename).split('.')[0]
+        kwargs['monitor'] = watchdog.monitor(log_path, elem)
+    timings = {}
+    start = time.time()
+    with open(atompaw_input_filename,'r') as input_fin, open(log_path, 'w') as log_fout: 
         # subprocess.call(['atompaw'], stdin=input_fin, stdout=log_fout)
         # subprocess.call(['srun', '-n', '1', 'atompaw'], stdin=input_fin, stdout=log_fout)
-        di.tile_run_dynamic(commands=[(1, ["-np", "1", "--bind-to", "none", "atompaw"])], 
-                            dedicated_master=0, stdin=input_fin, stdout=log_fout)
-
-
-
-def preprocess_pseudopotential_input_files(element_list, template_path):
+        while True:
+            try:
+                di.tile_run_dynamic(commands=ATOMPAW_COMMANDS, 
+                                    dedicated_master=0, stdin=input_fin, stdout=log_fout,
+                                    cwd=run_dir, timings=timings, **kwargs)
+                break
+            except di.ResourceError:
+                # raises again if the job has no tile for atompaw at all
+                di.available_tiles(commands=ATOMPAW_COMMANDS, dedicated_master=0)
+                if time.time() - start > ATOMPAW_MAX_TILE_WAIT:
+                    raise
+                print 'No idle tile for atompaw in', run_dir + ', retrying'
+                time.sleep(eval_pp.TILE_RETRY_SECONDS)
+    # waiting for a tile includes the retries
+    timings['tile_wait'] = time.time() - start - timings['mpirun']
+    eval_trace.record_timings('atompaw', timings, input=os.path.basename(atompaw_input_filename))
+    if watchdog is not None:
+        return watchdog.kill_reason
+    return None
+
+
+
+def preprocess_pseudopotential_input_files(element_list, template_path, params=None,
+                                           workspace=None):
     """
-    Preprocessing for atompaw, uses Dakota's dprepro utility 
+    Preprocessing for atompaw, same output as Dakota's dprepro utility 
     Writes atompaw input file called {elem}.in each element in element list.
     
     element_list: list of atomic symbols for all elements 
                   in current optimization    
-    template_path: path to dir containing input file templates
+    template_path: path to dir containing input file templates,
+                   relative to the workspace
+    params: Parameters object from read_parameters_file. If None, the
+            parameters file named params in the workspace is read.
+    workspace: workspace.Workspace to write the input files in, by
+            default the current directory's
     """
+    if workspace is None:
+        workspace = workspace_layout.Workspace()
+    if params is None:
+        params, _ = di.read_parameters_file(workspace.path('params'), di.UNNAMED)
     for elem in element_list:
-        template_file = os.path.join(template_path, elem+'.in.template')
-        new_input_file = elem+'.in'
-        subprocess.check_call(['dprepro', 'params', template_file, new_input_file])
+        template_file = os.path.join(workspace.path(template_path), elem+'.in.template')
+        new_input_file = workspace.path(elem+'.in')
+        dprepro.preprocess(template_file, params, new_input_file)
             
 
 
+def get_pseudopotential_cache(settings):
+    """
+    returns a PseudopotentialCache if pp_cache_dir is set in settings,
+    None otherwise. pp_cache_max_mb (default 1024) bounds the cache size.
+    """
+    if 'pp_cache_dir' not in settings:
+        return None
+    max_mb = float(settings.get('pp_cache_max_mb', 1024))
+    return pp_cache.PseudopotentialCache(settings['pp_cache_dir'],
+                                         max_bytes=int(max_mb * 1024**2))
+
+
+
+def get_failure_ledger(settings):
+    """
+    returns a FailureLedger if failure_ledger is set in settings,
+    None otherwise. failure_radius (default 0, i.e. only exact repeats)
+    is the distance in parameter space within which a recorded failure
+    is assumed to repeat. failure_scales, if given, divides each numeric
+    parameter (e.g. by the width of its bounds) before distances are taken.
+    """
+    if 'failure_ledger' not in settings:
+        return None
+    scales = settings.get('failure_scales')
+    if scales is not None:
+        if isinstance(scales, str):
+            scales = [scales]
+        scales = map(float, scales)
+    return failure_ledger.FailureLedger(settings['failure_ledger'],
+                                        float(settings.get('failure_radius', 0.)), scales)
+
+
+
+def get_eval_pp_options(settings):
+    """
+    returns dict of optional eval_pp.main arguments set in settings:
+        speculative_gcuts: number of higher gcuts to start early
+        gcut_search: linear or adaptive
+        restart_files: restart data files carried to the next gcut
+        convergence_subset: number of configurations to converge gcut with
+        convergence_verify: yes to check convergence of the full set
+        convergence_history: file of how hard configurations were to converge
+        launch_engine: fork or direct, see eval_pp.LAUNCH_ENGINES
+        refdata_cache: yes to read configurations.in and
+            allelectron_forces.dat from memory-mapped binary copies
+        scf_watchdog: diaryf.ScfWatchdog with the scf_divergence_steps,
+            scf_stagnation_steps and scf_max_steps settings, if any of
+            them is given
+    """
+    scf_limits = {}
+    for key in ['divergence_steps', 'stagnation_steps', 'max_steps']:
+        if 'scf_'+key in settings:
+            scf_limits[key] = int(settings['scf_'+key])
+    options = {}
+    if scf_limits:
+        options['scf_watchdog'] = diaryf.ScfWatchdog(**scf_limits)
+    if 'speculative_gcuts' in settings:
+        options['speculative_gcuts'] = int(settings['speculative_gcuts'])
+    if 'gcut_search' in settings:
+        options['gcut_search'] = settings['gcut_search']
+    if 'restart_files' in settings:
+        restart_files = settings['restart_files']
+        if isinstance(restart_files, str):
+            restart_files = [restart_files]
+        options['restart_files'] = restart_files
+    if 'convergence_subset' in settings:
+        options['convergence_subset'] = int(settings['convergence_subset'])
+    if 'convergence_verify' in settings:
+        options['convergence_verify'] = settings['convergence_verify'] == 'yes'
+    if 'convergence_history' in settings:
+        options['convergence_history'] = settings['convergence_history']
+    if 'launch_engine' in settings:
+        options['launch_engine'] = settings['launch_engine']
+    if 'refdata_cache' in settings:
+        options['refdata_cache'] = settings['refdata_cache'] == 'yes'
+    return options
+
+
+def get_atompaw_watchdog(settings):
+    """
+    returns an AtompawWatchdog if atompaw_history is set in settings,
+    None otherwise. Optional settings:
+        atompaw_kill_pattern: regex for log lines that kill the run
+        atompaw_timeout_factor: timeout is this times the p99 runtime
+        atompaw_timeout: timeout in seconds until enough runtimes are known
+        atompaw_history_runs: runs of each element the timeout comes from
+    """
+    if 'atompaw_history' not in settings:
+        return None
+    kwargs = {}
+    if 'atompaw_kill_pattern' in settings:
+        pattern = settings['atompaw_kill_pattern']
+        if isinstance(pattern, list):
+            pattern = ' '.join(pattern)  # read_inputs splits on whitespace
+        kwargs['kill_pattern'] = pattern
+    if 'atompaw_timeout_factor' in settings:
+        kwargs['timeout_factor'] = float(settings['atompaw_timeout_factor'])
+    if 'atompaw_timeout' in settings:
+        kwargs['default_timeout'] = float(settings['atompaw_timeout'])
+    if 'atompaw_history_runs' in settings:
+        kwargs['history_runs'] = int(settings['atompaw_history_runs'])
+    return atompaw_watchdog.AtompawWatchdog(settings['atompaw_history'], **kwargs)
+
+
+
+def get_result_store(settings):
+    """ returns a ResultStore if result_store is set in settings, None otherwise """
+    if 'result_store' not in settings:
+        return None
+    return result_store.ResultStore(settings['result_store'])
+
+
+
+def evaluation_key(params, settings, workspace=None):
+    """
+    returns a result_store.evaluation_key covering everything the
+    objectives of an evaluation in workspace (by default, the current
+    directory) depend on: the parameters, the input files and the
+    RESULT_SETTINGS in settings
+    """
+    if workspace is None:
+        workspace = workspace_layout.Workspace()
+    element_list = settings['element_list']
+    input_files = [os.path.join(workspace.path(settings['templates_dir']), elem+'.in.template')
+                   for elem in element_list]
+    input_files += [workspace.path('argvf.template'), workspace.path('crystal.template'),
+                    workspace.campaign_path('configurations.in'),
+                    workspace.campaign_path('allelectron_forces.dat')]
+    key_settings = dict((k, settings[k]) for k in RESULT_SETTINGS if k in settings)
+    return result_store.evaluation_key(params, input_files, key_settings)
+
+
+
+@file_cache.memoize_file
 def read_inputs(filename):
     """ 
     flimsy input file parser
@@ -172,4 +538,4 @@ def read_inputs(filename):
 
 
 if __name__=='__main__':
-    main()
+    main(*sys.argv[1:3])
@@ -0,0 +1,168 @@
+"""
+kill atompaw runs that are not going to produce a pseudopotential
+
+Some parameter sets make atompaw iterate for a very long time before giving
+up, holding a tile the whole time. AtompawWatchdog follows atompaw's log
+while it runs and kills mpirun when
+
+    - a line of the log matches kill_pattern (non-convergence messages), or
+    - the run takes longer than timeout_factor times the given percentile
+      of earlier successful runtimes of the same element (once min_samples
+      runtimes are known), or default_timeout seconds before then.
+
+Every run is appended to the history file as a JSON line with the element,
+runtime, returncode, and the kill reason if it was killed. The history is
+shared by all drivers of a campaign and supplies the runtime distribution.
+Only the last history_runs runs of each element count: once the file holds
+twice that many lines of an element, the run that records one more rolls
+the file over to the last history_runs runs of each element. Each watchdog
+remembers how far it has read the file and only reads the lines added
+since, unless the file was rolled over in the meantime.
+"""
+import collections
+import fcntl
+import json
+import os
+import re
+import time
+import numpy as np
+import logtail
+
+
+DEFAULT_KILL_PATTERN = r'(?i)\bno(t)? converge'
+# runs of each element the timeout is computed from
+HISTORY_RUNS = 1000
+
+
+class AtompawWatchdog(object):
+    """
+    history_file: JSON lines file of earlier atompaw runs
+    kill_pattern: regex; a log line matching it kills the run. None to
+        disable.
+    timeout_factor, percentile, min_samples: see module docstring
+    default_timeout: timeout in seconds until min_samples successful
+        runtimes are known. None for no timeout.
+    poll_interval: seconds between checks of the log
+    history_runs: see module docstring
+    """
+    def __init__(self, history_file, kill_pattern=DEFAULT_KILL_PATTERN,
+                 timeout_factor=3., percentile=99., min_samples=20,
+                 default_timeout=None, poll_interval=0.5, history_runs=HISTORY_RUNS):
+        self.history_file = history_file
+        self.lock_file = history_file + '.lock'
+        self.history_runs = history_runs
+        self.kill_pattern = None if kill_pattern is None else re.compile(kill_pattern)
+        self.timeout_factor = timeout_factor
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.default_timeout = default_timeout
+        self.poll_interval = poll_interval
+        self.kill_reason = None
+        self.timed_out = False
+        self._reset()
+
+    def _reset(self):
+        self._runs = {}  # elem: deque of its last history_runs runs
+        self._lines = {}  # elem: number of its lines in the history file
+        self._offset = 0  # where the lines not read yet start
+        self._last_line = None  # line just before self._offset
+
+    def _read_new_runs(self):
+        """ adds the runs recorded since the last call """
+        try:
+            fin = open(self.history_file)
+        except IOError:
+            self._reset()
+            return
+        with fin:
+            if self._last_line is not None:
+                fin.seek(self._offset - len(self._last_line))
+                if fin.readline() != self._last_line:
+                    # rolled over since the last call
+                    self._reset()
+                    fin.seek(0)
+            for line in fin:
+                if not line.endswith('\n'):
+                    break  # still being written
+                self._offset += len(line)
+                self._last_line = line
+                if line.strip():
+                    self._add(json.loads(line))
+
+    def _add(self, run):
+        if run['elem'] not in self._runs:
+            self._runs[run['elem']] = collections.deque(maxlen=self.history_runs)
+        self._runs[run['elem']].append(run)
+        self._lines[run['elem']] = self._lines.get(run['elem'], 0) + 1
+
+    def history(self):
+        """ returns list of dicts, one per run that counts, oldest first """
+        self._read_new_runs()
+        return sorted((run for runs in self._runs.values() for run in runs),
+                      key=lambda run: run['time'])
+
+    def timeout(self, elem):
+        """ returns current timeout in seconds for elem, None for no timeout """
+        self._read_new_runs()
+        runtimes = [run['seconds'] for run in self._runs.get(elem, ())
+                    if run['returncode'] == 0 and run['kill_reason'] is None]
+        if len(runtimes) < self.min_samples:
+            return self.default_timeout
+        return self.timeout_factor * np.percentile(runtimes, self.percentile)
+
+    def record(self, elem, seconds, returncode, kill_reason):
+        """ append a run to the history file, rolling it over if it is due """
+        line = json.dumps({'elem': elem, 'seconds': seconds, 'returncode': returncode,
+                           'kill_reason': kill_reason, 'time': time.time()})
+        # a separate lock file, because rolling over replaces the history file
+        with open(self.lock_file, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.history_file, 'a') as fout:
+                    fout.write(line + '\n')
+                self._read_new_runs()
+                if self._lines[elem] > 2 * self.history_runs:
+                    self._roll_over()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _roll_over(self):
+        """ replace the history file by the runs that count; call with the lock held """
+        tmp_file = self.history_file + '.tmp'
+        with open(tmp_file, 'w') as fout:
+            for run in self.history():
+                fout.write(json.dumps(run) + '\n')
+        os.rename(tmp_file, self.history_file)
+        self._reset()
+        self._read_new_runs()
+
+    def monitor(self, log_path, elem):
+        """
+        returns a monitor for tile_run_dynamic that watches log_path.
+        self.kill_reason is set if the run gets killed, and self.timed_out
+        if that was for taking too long.
+        """
+        def watch(process):
+            self.kill_reason = None
+            self.timed_out = False
+            timeout = self.timeout(elem)
+            log = logtail.LogTail(log_path)
+            start = time.time()
+            while process.poll() is None:
+                elapsed = time.time() - start
+                if self.kill_pattern is not None:
+                    for line in log.read_lines():
+                        if self.kill_pattern.search(line):
+                            self.kill_reason = 'log: ' + line.strip()
+                            break
+                if self.kill_reason is None and timeout is not None and elapsed > timeout:
+                    self.kill_reason = 'timeout after %.1f s' % timeout
+                    self.timed_out = True
+                if self.kill_reason is not None:
+                    process.terminate()
+                    process.wait()
+                    break
+                time.sleep(self.poll_interval)
+            self.record(elem, time.time() - start, process.returncode, self.kill_reason)
+            return process.returncode
+        return watch
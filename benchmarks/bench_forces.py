@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+times the forces pipeline (diaryf parsing into the (configs, atoms, 3)
+array, then force_objective) on synthetic diaryf files of large cells
+
+    python benchmarks/bench_forces.py [num_configs] [repeats]
+
+For comparison, 'append' times the old parser, which grew the forces with
+np.append once per atom and built the objective from a list of arrays.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import calc_accuracy
+import diaryf
+
+ATOM_COUNTS = [8, 64, 128, 216]
+
+
+def write_diaryf(path, forces):
+    """ writes a diaryf with an energy and the forces block socorro prints """
+    with open(path, 'w') as fout:
+        fout.write('     cell energy           = -738.821147137\n\n')
+        fout.write('   Atomic forces:\n')
+        fout.write('                    atom           Fx            Fy            Fz\n')
+        fout.write('                   ---------------------------------------------------\n')
+        for atom, f in enumerate(forces):
+            fout.write('                   %4d        %+.6f     %+.6f     %+.6f\n' % ((atom+1,) + tuple(f)))
+        fout.write('\n')
+
+
+def read_forces_append(path):
+    """ the parser before the preallocated pipeline """
+    forces = np.array([])
+    with open(path) as fin:
+        for line in fin:
+            if 'Atomic forces:' in line:
+                fin.next()
+                fin.next()
+                for line in fin:
+                    if line.strip() == '':
+                        break
+                    forces = np.append(forces, map(float, line.split()[1:4]))
+                return forces
+
+
+def bench(num_atoms, num_configs, repeats, tmp_dir):
+    reference = np.random.random([num_configs, 3*num_atoms])
+    paths = []
+    for c in range(num_configs):
+        paths.append(os.path.join(tmp_dir, 'diaryf.%d.%d' % (num_atoms, c)))
+        write_diaryf(paths[-1], np.random.random([num_atoms, 3]))
+
+    def preallocated():
+        forces = np.empty((num_configs, num_atoms, 3))
+        for c, path in enumerate(paths):
+            diaryf.read_diaryf(path, forces_out=forces[c])
+        return calc_accuracy.force_objective(forces, reference)
+
+    def append():
+        forces = [read_forces_append(path) for path in paths]
+        return calc_accuracy.force_objective(forces, reference)
+
+    assert np.isclose(preallocated(), append())
+    return dict((name, min(timeit.repeat(f, number=1, repeat=repeats)))
+                for name, f in [('preallocated', preallocated), ('append', append)])
+
+
+if __name__ == '__main__':
+    num_configs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print '%8s%16s%16s' % ('atoms', 'preallocated', 'append')
+        for num_atoms in ATOM_COUNTS:
+            times = bench(num_atoms, num_configs, repeats, tmp_dir)
+            print '%8d%16.6f%16.6f' % (num_atoms, times['preallocated'], times['append'])
+    finally:
+        shutil.rmtree(tmp_dir)
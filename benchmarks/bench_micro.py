@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+"""
+micro-benchmarks of the hot python paths, checked against stored baselines
+
+    python benchmarks/bench_micro.py [check|save] [case ...]
+
+check (the default) times each case (all of them if none are named) and
+compares it with its baseline in benchmarks/baselines.json. A case is a
+regression when it is slower than its baseline by more than its threshold
+(a fraction of the baseline: the case's own 'threshold' in baselines.json,
+or the file's default 'threshold'). The exit code is 1 if any case
+regressed, except cases whose baseline has 'gate': false, which are only
+reported: how the processes of tile_lock_4_processes_2_tiles_x100 take
+turns depends on the scheduler more than on the lock. save times the
+cases and stores them as the new baselines.
+
+Baselines are seconds per call on one machine; save them again on the
+machine the checks run on. Nothing here needs socorro, atompaw or SLURM:
+inputs are the tests/test_inputs fixtures or generated in a temporary
+directory.
+
+A case's time is the best over REPEATS runs of enough calls to take
+MIN_SECONDS, divided by the number of calls, as timeit does.
+"""
+import StringIO
+import collections
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+import numpy as np
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+import calc_accuracy
+import eval_pp
+import dakota_interfacing_2.interfacing.interfacing as di_interfacing
+import dakota_interfacing_2.interfacing.parallel as di_parallel
+
+BASELINES = os.path.join(REPO_DIR, 'benchmarks', 'baselines.json')
+TEST_INPUTS = os.path.join(REPO_DIR, 'tests', 'test_inputs')
+INTEGRATION_INPUTS = os.path.join(REPO_DIR, 'tests', 'test_inputs_integration',
+                                  'analysis_driver_main_success')
+DEFAULT_THRESHOLD = 0.5
+REPEATS = 5
+MIN_SECONDS = 0.05
+
+# name: function of a temporary directory returning the call to time
+CASES = collections.OrderedDict()
+
+
+def case(name):
+    def register(setup):
+        CASES[name] = setup
+        return setup
+    return register
+
+
+def write_params(path, num_variables, num_functions):
+    """ writes a dakota format params file, derivatives for all variables """
+    lines = ['%43d variables\n' % num_variables]
+    lines += ['%43.15e x%d\n' % (0.1*v, v) for v in range(num_variables)]
+    lines += ['%43d functions\n' % num_functions]
+    lines += ['%43d ASV_%d:f%d\n' % (1, f+1, f) for f in range(num_functions)]
+    lines += ['%43d derivative_variables\n' % num_variables]
+    lines += ['%43d DVV_%d:x%d\n' % (v+1, v+1, v) for v in range(num_variables)]
+    lines += ['%43d analysis_components\n' % 0, '%43d eval_id\n' % 1]
+    with open(path, 'w') as fout:
+        fout.writelines(lines)
+
+
+def read_params_call(path):
+    with open(path) as fin:
+        stream = StringIO.StringIO(fin.read())
+    def call():
+        stream.seek(0)
+        di_interfacing._read_parameters_stream(stream)
+    return call
+
+
+@case('read_parameters_stream_small')
+def params_small(tmp_dir):
+    return read_params_call(os.path.join(INTEGRATION_INPUTS, 'params'))
+
+
+@case('read_parameters_stream_10000_variables')
+def params_large(tmp_dir):
+    path = os.path.join(tmp_dir, 'params.large')
+    write_params(path, 10000, 100)
+    return read_params_call(path)
+
+
+@case('results_write_gradients_hessians_20_variables')
+def results_write(tmp_dir):
+    num_deriv_vars = 20
+    responses = collections.OrderedDict([('accu', '7'), ('work', '7')])
+    results = di_interfacing.Results(False, responses, ['x%d' % v for v in range(num_deriv_vars)],
+                                     '1', results_file=os.path.join(tmp_dir, 'results'))
+    for name in responses:
+        results[name].function = 1.
+        results[name].gradient = np.linspace(0., 1., num_deriv_vars)
+        results[name].hessian = np.eye(num_deriv_vars)
+    return results.write
+
+
+def write_large_diaryf(path, num_atoms, repeats):
+    """
+    writes the calc_nflops fixture with its output before the cell energy
+    repeated and a forces block of num_atoms atoms
+    """
+    with open(os.path.join(TEST_INPUTS, 'diaryf.test_calc_nflops')) as fin:
+        lines = fin.readlines()
+    energy_line = [i for i, line in enumerate(lines) if 'cell energy   ' in line][0]
+    forces_end = lines.index('\n', energy_line + 3)
+    with open(path, 'w') as fout:
+        fout.writelines(lines[:energy_line] * repeats)
+        fout.writelines(lines[energy_line:energy_line+5])
+        for atom, f in enumerate(np.random.random([num_atoms, 3])):
+            fout.write('                   %4d        %+.6f     %+.6f     %+.6f\n' % ((atom+1,) + tuple(f)))
+        fout.writelines(lines[forces_end:])
+
+
+def dft_run():
+    return eval_pp.DftRun([], os.path.join(INTEGRATION_INPUTS, 'argvf.template'),
+                          os.path.join(INTEGRATION_INPUTS, 'crystal.template'),
+                          [[0., 0., 0.1], [0.5, 0.6, 0.7]], 30.)
+
+
+@case('read_energy_forces_small')
+def read_small(tmp_dir):
+    path = os.path.join(TEST_INPUTS, 'diaryf.test_calc_nflops')
+    run = dft_run()
+    def call():
+        run.read_energy(path)
+        run.read_forces(path)
+    return call
+
+
+@case('read_energy_forces_1000_atoms')
+def read_large(tmp_dir):
+    path = os.path.join(tmp_dir, 'diaryf.large')
+    write_large_diaryf(path, 1000, 10)
+    run = dft_run()
+    def call():
+        run.read_energy(path)
+        run.read_forces(path)
+    return call
+
+
+def force_objective_call(num_configs, num_atoms):
+    forces = np.random.random([num_configs, num_atoms, 3])
+    reference = np.random.random([num_configs, 3*num_atoms])
+    return lambda: calc_accuracy.force_objective(forces, reference)
+
+
+@case('force_objective_10_configs_216_atoms')
+def force_objective_216(tmp_dir):
+    return force_objective_call(10, 216)
+
+
+@case('force_objective_10_configs_4096_atoms')
+def force_objective_4096(tmp_dir):
+    return force_objective_call(10, 4096)
+
+
+def preproc_crystal_call(template_text, num_atoms):
+    mytext = template_text.splitlines(True)
+    positions = np.random.random([num_atoms, 3]).tolist()
+    return lambda: eval_pp.DftRun._preproc_crystal(mytext, positions)
+
+
+@case('preproc_crystal_2_atoms')
+def preproc_crystal_small(tmp_dir):
+    with open(os.path.join(INTEGRATION_INPUTS, 'crystal.template')) as fin:
+        return preproc_crystal_call(fin.read(), 2)
+
+
+@case('preproc_crystal_216_atoms')
+def preproc_crystal_large(tmp_dir):
+    template_text = ('SiGe_moga\n  5.293267755\n      1.0  1.0  0.0\n      0.0  1.0  1.0\n'
+                     '      1.0  0.0  1.0\nlattice\n  216\n' + 'Si\n' * 216)
+    return preproc_crystal_call(template_text, 216)
+
+
+def acquire_release(lock_dir, num_tiles, cycles):
+    """ acquires and releases a tile cycles times, retrying while none is free """
+    for _ in range(cycles):
+        while True:
+            try:
+                with di_parallel._TileLock(num_tiles, 'bench', lock_dir):
+                    break
+            except di_parallel.ResourceError:
+                pass
+
+
+@case('tile_lock_acquire_release')
+def tile_lock(tmp_dir):
+    lock_dir = os.path.join(tmp_dir, 'locks.single')
+    return lambda: acquire_release(lock_dir, 4, 1)
+
+
+def contended_worker(lock_dir, num_tiles, cycles, start, done):
+    """ runs acquire_release for each item put on start, then puts on done """
+    while start.get():
+        acquire_release(lock_dir, num_tiles, cycles)
+        done.put(True)
+
+
+@case('tile_lock_4_processes_2_tiles_x100')
+def tile_lock_contended(tmp_dir):
+    # the processes are started once, so the call times the locking, not fork
+    lock_dir = os.path.join(tmp_dir, 'locks.contended')
+    starts = [multiprocessing.Queue() for _ in range(4)]
+    done = multiprocessing.Queue()
+    for start in starts:
+        p = multiprocessing.Process(target=contended_worker, args=(lock_dir, 2, 100, start, done))
+        p.daemon = True
+        p.start()
+    def call():
+        for start in starts:
+            start.put(True)
+        for start in starts:
+            done.get()
+    return call
+
+
+def time_call(call):
+    """ returns best seconds per call """
+    number = 1
+    while True:
+        seconds = timeit.timeit(call, number=number)
+        if seconds >= MIN_SECONDS:
+            break
+        number *= 10
+    return min([seconds] + timeit.repeat(call, number=number, repeat=REPEATS-1)) / number
+
+
+def run_cases(names):
+    """ returns OrderedDict of case name: seconds per call """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        return collections.OrderedDict((name, time_call(CASES[name](tmp_dir))) for name in names)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def read_baselines(path=BASELINES):
+    if not os.path.isfile(path):
+        return {'threshold': DEFAULT_THRESHOLD, 'cases': {}}
+    with open(path) as fin:
+        return json.load(fin)
+
+
+def compare(times, baselines):
+    """
+    returns list of (name, seconds, baseline seconds or None, regressed)
+    for the cases in times. Cases left out of the gate never regress.
+    """
+    rows = []
+    for name, seconds in times.items():
+        baseline = baselines['cases'].get(name)
+        if baseline is None:
+            rows.append((name, seconds, None, False))
+            continue
+        threshold = baseline.get('threshold', baselines.get('threshold', DEFAULT_THRESHOLD))
+        rows.append((name, seconds, baseline['seconds'], baseline.get('gate', True)
+                     and seconds > baseline['seconds'] * (1. + threshold)))
+    return rows
+
+
+def save(times, baselines, path=BASELINES):
+    """ stores times as the baselines, keeping the thresholds """
+    for name, seconds in times.items():
+        baselines['cases'].setdefault(name, {})['seconds'] = seconds
+    with open(path, 'w') as fout:
+        json.dump(baselines, fout, indent=2, separators=(',', ': '), sort_keys=True)
+        fout.write('\n')
+
+
+def main(args):
+    mode = 'check'
+    if args and args[0] in ['check', 'save']:
+        mode = args.pop(0)
+    names = args or list(CASES)
+    unknown = [name for name in names if name not in CASES]
+    assert not unknown, 'unknown cases: ' + ' '.join(unknown)
+
+    baselines = read_baselines()
+    times = run_cases(names)
+    if mode == 'save':
+        save(times, baselines)
+    print '%-48s%14s%14s%10s' % ('case', 'seconds', 'baseline', 'ratio')
+    regressed = False
+    for name, seconds, baseline, regression in compare(times, baselines):
+        if baseline is None:
+            print '%-48s%14.3e%14s%10s' % (name, seconds, '-', 'new')
+        else:
+            print '%-48s%14.3e%14.3e%10.2f%s' % (name, seconds, baseline, seconds / baseline,
+                                                 '  REGRESSION' if regression else '')
+        regressed = regressed or regression
+    return 1 if regressed and mode == 'check' else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+end to end throughput of analysis_driver.main with the stand-ins in
+benchmarks/simulators in place of socorro, atompaw and mpirun
+
+    python benchmarks/bench_throughput.py [num_drivers] [num_evals] [num_tiles] [launch_engine]
+
+sets up a campaign from tests/test_inputs_integration/analysis_driver_main_success
+in a temporary directory, with num_evals evaluations of parameters
+scattered around the ones in its params, and runs them the way dakota
+does with an evaluation concurrency of num_drivers: each evaluation is a
+new analysis_driver.py process, and a new one starts as soon as one
+exits. The drivers share a fake SLURM allocation of num_tiles one-task
+tiles, with its tile locks in the temporary directory.
+
+The stand-ins are set up with the OPAL_SIM_* variables described in
+benchmarks/simulators/simulator.py, e.g.
+
+    OPAL_SIM_SOCORRO_RUNTIME=2 OPAL_SIM_SOCORRO_FAIL_RATE=0.05 \\
+        python benchmarks/bench_throughput.py 8 32 16
+
+Reported are evaluations per hour, the tile idle time (sampled from the
+tile locks: tile-seconds no run held a tile, and as a fraction of all
+tile-seconds) and the driver CPU overhead (CPU seconds of the drivers and
+their python children, i.e. everything but the stand-ins, per evaluation
+and as a fraction of the wall time times num_drivers), then the
+per-phase summary of the evaluation trace.
+"""
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+import eval_pp
+import eval_trace
+
+SIMULATORS_DIR = os.path.join(REPO_DIR, 'benchmarks', 'simulators')
+INPUTS_DIR = os.path.join(REPO_DIR, 'tests', 'test_inputs_integration',
+                          'analysis_driver_main_success')
+EVAL_FILES = ['argvf.template', 'crystal.template', 'Si.in.template', 'Ge.in.template']
+LOCK_ID = 'bench'
+SAMPLE_INTERVAL = 0.05
+# objectives analysis_driver sets for each kind of failure
+FAILURE_OBJECTIVES = {100.: 'atompaw', 102.: 'socorro', 95.: 'cutoff'}
+
+
+def setup_campaign(campaign_dir, num_evals, launch_engine, spread=0.05):
+    """
+    writes the campaign files and num_evals evaluation directories
+    (workdir.1, ...) with parameters within spread of the template's.
+    Returns the list of evaluation directories.
+    """
+    shutil.copy(os.path.join(INPUTS_DIR, 'configurations.in.example'),
+                os.path.join(campaign_dir, 'configurations.in'))
+    shutil.copy(os.path.join(INPUTS_DIR, 'allelectron_forces.dat.example'),
+                os.path.join(campaign_dir, 'allelectron_forces.dat'))
+    with open(os.path.join(INPUTS_DIR, 'opal.in')) as fin:
+        opal_in = fin.read()
+    with open(os.path.join(campaign_dir, 'opal.in'), 'w') as fout:
+        fout.write(opal_in)
+        fout.write('launch_engine   %s\n' % launch_engine)
+        fout.write('trace_file      %s\n' % os.path.join(campaign_dir, 'trace'))
+    with open(os.path.join(INPUTS_DIR, 'params')) as fin:
+        params_lines = fin.readlines()
+
+    eval_dirs = []
+    for eval_id in range(1, num_evals+1):
+        eval_dir = os.path.join(campaign_dir, 'workdir.%d' % eval_id)
+        os.mkdir(eval_dir)
+        for name in EVAL_FILES:
+            shutil.copy(os.path.join(INPUTS_DIR, name), eval_dir)
+        with open(os.path.join(eval_dir, 'params'), 'w') as fout:
+            for line in params_lines:
+                words = line.split()
+                if words[1].startswith('DAKOTA_'):
+                    value = float(words[0]) * (1. + random.uniform(-spread, spread))
+                    line = '%43.15e %s\n' % (value, words[1])
+                elif words[1] == 'eval_id':
+                    line = '%43d %s\n' % (eval_id, words[1])
+                fout.write(line)
+        eval_dirs.append(eval_dir)
+    return eval_dirs
+
+
+def simulator_env(tmp_dir, num_tiles, stats_path):
+    """ returns environment of the drivers: stand-ins and a fake SLURM job """
+    env = dict(os.environ)
+    env['PATH'] = SIMULATORS_DIR + os.pathsep + env['PATH']
+    env['PYTHONPATH'] = REPO_DIR
+    env['HOME'] = tmp_dir
+    env['SLURM_JOBID'] = LOCK_ID
+    # two nodes of num_tiles tasks: the first is the dedicated master
+    env['SLURM_TASKS_PER_NODE'] = '%d(x2)' % num_tiles
+    env['OPAL_SIM_STATS'] = stats_path
+    return env
+
+
+def busy_tiles(lock_dir):
+    """ returns number of tiles whose lock is held """
+    if not os.path.isdir(lock_dir):
+        return 0
+    return len([f for f in os.listdir(lock_dir) if f.startswith(LOCK_ID + '.')])
+
+
+def run_drivers(eval_dirs, num_drivers, num_tiles, env):
+    """
+    runs an analysis driver in each of eval_dirs, num_drivers at a time,
+    and returns (wall seconds, idle tile-seconds)
+    """
+    lock_dir = os.path.join(env['HOME'], '.DakotaEvalTiling')
+    pending = list(eval_dirs)
+    running = []
+    idle = 0.
+    start = last = time.time()
+    while pending or running:
+        running = [p for p in running if p.poll() is None]
+        while pending and len(running) < num_drivers:
+            eval_dir = pending.pop(0)
+            with open(os.path.join(eval_dir, 'driver.err'), 'w') as err:
+                running.append(subprocess.Popen(
+                    [sys.executable, os.path.join(REPO_DIR, 'analysis_driver.py'), 'params', 'results'],
+                    cwd=eval_dir, env=env, stderr=err))
+        time.sleep(SAMPLE_INTERVAL)
+        now = time.time()
+        idle += (num_tiles - busy_tiles(lock_dir)) * (now - last)
+        last = now
+    return time.time() - start, idle
+
+
+def read_outcomes(eval_dirs):
+    """ returns dict of outcome: number of evaluations """
+    outcomes = {}
+    for eval_dir in eval_dirs:
+        try:
+            with open(os.path.join(eval_dir, 'results')) as fin:
+                accu = float(fin.readline().split()[0])
+            outcome = FAILURE_OBJECTIVES.get(accu, 'success')
+        except (IOError, IndexError, ValueError):
+            outcome = 'driver error'
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    return outcomes
+
+
+def simulator_cpu_seconds(stats_path):
+    """ returns CPU seconds of all stand-in runs """
+    if not os.path.isfile(stats_path):
+        return 0.
+    with open(stats_path) as fin:
+        return sum(float(line.split()[2]) for line in fin if line.strip())
+
+
+def main(num_drivers=4, num_evals=8, num_tiles=4, launch_engine='fork'):
+    assert launch_engine in eval_pp.LAUNCH_ENGINES, \
+        "launch_engine must be one of " + ' '.join(eval_pp.LAUNCH_ENGINES)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        campaign_dir = os.path.join(tmp_dir, 'campaign')
+        os.mkdir(campaign_dir)
+        eval_dirs = setup_campaign(campaign_dir, num_evals, launch_engine)
+        stats_path = os.path.join(tmp_dir, 'simulator_stats')
+        env = simulator_env(tmp_dir, num_tiles, stats_path)
+
+        wall, idle = run_drivers(eval_dirs, num_drivers, num_tiles, env)
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        driver_cpu = usage.ru_utime + usage.ru_stime - simulator_cpu_seconds(stats_path)
+
+        print 'drivers %d, evaluations %d, tiles %d, launch_engine %s' % (
+            num_drivers, num_evals, num_tiles, launch_engine)
+        print 'outcomes:', ', '.join('%s %d' % item for item in sorted(read_outcomes(eval_dirs).items()))
+        print '%-32s%12.1f' % ('evaluations/hour', num_evals / wall * 3600.)
+        print '%-32s%12.2f' % ('wall seconds', wall)
+        print '%-32s%12.2f%11.1f%%' % ('tile idle seconds', idle, 100. * idle / (num_tiles * wall))
+        print '%-32s%12.3f%11.1f%%' % ('driver CPU seconds/evaluation', driver_cpu / num_evals,
+                                       100. * driver_cpu / (num_drivers * wall))
+        trace_file = os.path.join(campaign_dir, 'trace')
+        if os.path.isfile(trace_file):
+            print
+            eval_trace.print_summary(eval_trace.summarize([trace_file]))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*(map(int, args[:3]) + args[3:4]))
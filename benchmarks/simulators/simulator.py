@@ -0,0 +1,78 @@
+"""
+shared parts of the socorro, atompaw and mpirun stand-ins in this directory
+
+Put this directory first on the PATH and the analysis driver runs the
+stand-ins instead of the real programs. They write the outputs the driver
+reads, replayed from the tests/test_inputs fixtures, and are set up with
+environment variables (PROGRAM is SOCORRO or ATOMPAW). The stand-ins run
+under python 2 and 3, whichever python is first on the PATH.
+
+Environment variables (PROGRAM is SOCORRO or ATOMPAW):
+
+    OPAL_SIM_{PROGRAM}_RUNTIME    seconds a run takes (default 0.5)
+    OPAL_SIM_{PROGRAM}_FAIL_RATE  fraction of runs that fail (default 0)
+    OPAL_SIM_SOCORRO_SCF_STEPS    SCF steps of a socorro run (default 19, as
+                                  in the fixture)
+    OPAL_SIM_STATS                if set, each run appends a line of
+                                  program, wall seconds, cpu seconds and
+                                  exit code to this file
+"""
+import os
+import random
+import signal
+import sys
+import time
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+FIXTURES_DIR = os.path.join(REPO_DIR, 'tests')
+
+
+def fixture(*names):
+    """ returns path of a file in the tests directory """
+    return os.path.join(FIXTURES_DIR, *names)
+
+
+def setting(program, name, default):
+    """ returns float of OPAL_SIM_{program}_{name}, default if not set """
+    return float(os.environ.get('OPAL_SIM_%s_%s' % (program.upper(), name), default))
+
+
+def fails(program):
+    """ True for a fraction OPAL_SIM_{program}_FAIL_RATE of calls """
+    return random.random() < setting(program, 'FAIL_RATE', 0.)
+
+
+class Run(object):
+    """
+    times one stand-in run and appends its stats to OPAL_SIM_STATS on exit
+
+        with simulator.Run('socorro') as run:
+            ...
+            run.returncode = 1
+    """
+    def __init__(self, program):
+        self.program = program
+        self.returncode = 0
+
+    def __enter__(self):
+        self._start = time.time()
+        # a terminated run exits through __exit__ too, so it is counted
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is SystemExit:
+            self.returncode = exc_value.code
+        elif exc_type is not None:
+            self.returncode = 1
+        stats_path = os.environ.get('OPAL_SIM_STATS')
+        if stats_path:
+            times = os.times()
+            line = '%s %.6f %.6f %d\n' % (self.program, time.time() - self._start,
+                                          times[0] + times[1], self.returncode)
+            # one short O_APPEND write, so concurrent runs don't interleave
+            fd = os.open(stats_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode())
+            finally:
+                os.close(fd)
@@ -1,40 +1,54 @@
 import os
 import sys
 import numpy as np
+import file_cache
+import refdata
 
 
-def calc_accuracy_objective(f_soc, allelectron_forces_file):
+def calc_accuracy_objective(f_soc, allelectron_forces_file, binary_cache=False):
     """
     Calculates accuracy objective by comparing socorro and
     all electron forces at each atomic structure tested.
+    binary_cache: see read_allelectron_forces
     """
-    f_allelectron = read_allelectron_forces(filename=allelectron_forces_file)
+    f_allelectron = read_allelectron_forces(filename=allelectron_forces_file,
+                                            binary_cache=binary_cache)
     return force_objective(f_soc, f_allelectron)
 
 
 def force_objective(f_soc, f_allelectron):
     """ 
-    f_soc is list of numpy arrays, where each element of list represents 
-    on atomic configuration. The numpy arrays are N by 3 where N is the number o
-    of atoms in the crystal.
+    f_soc is a numpy array of shape (M, N, 3), where M is the number of atomic
+    configurations and N is the number of atoms in the crystal, as filled in by
+    eval_pp.main. A list of per-configuration arrays (or an M by 3N array) is
+    also accepted, at the cost of a copy.
+    f_allelectron is M by 3N, as read by read_allelectron_forces.
     """
     assert f_allelectron.shape[1]%3 == 0, "Each atom should have three force components."
     num_configs = f_allelectron.shape[0]
     num_atoms   = (f_allelectron.shape[1])/3
+    f_soc = np.asarray(f_soc, dtype=float)
+    assert f_soc.size == f_allelectron.size, "Socorro and all electron forces differ in size."
 
     # accuracy objective is rmsd of magnitude of difference between socorro and elk force vectors
-    force_obj_unweighted = np.sqrt( np.sum((f_soc-f_allelectron)**2.)/num_configs/num_atoms )
+    diff = f_soc.reshape(num_configs, num_atoms, 3) - f_allelectron.reshape(num_configs, num_atoms, 3)
+    force_obj_unweighted = np.sqrt( np.einsum('ijk,ijk->', diff, diff)/num_configs/num_atoms )
     
     #force_obj = force_weight * force_obj_unweighted
     return force_obj_unweighted
 
 
-def read_allelectron_forces(filename='allelectron_forces.dat'):
+@file_cache.memoize_file
+def read_allelectron_forces(filename='allelectron_forces.dat', binary_cache=False):
     """
     Read 'correct' forces as calculated from Elk from file.
     Returns an MxN numpy array where M is the number of atomic structures and N/3 is the number of atoms
     in the structures.
+    binary_cache: if True, read the file's memory-mapped binary copy,
+        see refdata.load
     """
+    if binary_cache:
+        return refdata.load(filename, np.loadtxt)
     ae_forces = np.loadtxt(filename)
     return ae_forces
 
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+compact a finished evaluation directory
+
+An evaluation leaves {elem}_pseudopotential/ directories, PAW.{elem} links,
+the rendered {elem}.in files, a gcut_dir.N/workdir_r.M tree of socorro
+inputs, outputs and symlinks per gcut, the converged_gcut marker, and the
+eval_trace.spool of an evaluation that died before writing its trace (see
+workspace.py for the layout). Over a campaign this is millions of small
+files. compact packs the outputs worth keeping into one compressed archive
+per evaluation and removes everything the evaluation generated. params,
+results, analysis_driver.log and the input templates are left alone.
+
+Retention policies:
+    none        leave the directory as it is
+    all         archive every generated file
+    final_gcut  archive everything but the gcut directories other than the
+                one the energies converged in (named in converged_gcut by
+                eval_pp; the highest gcut directory if they didn't converge)
+    results     archive nothing, keep only the files that are never removed
+
+usage (run by analysis_driver in the background):
+
+    python compact.py eval_dir policy
+"""
+import errno
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import workspace
+
+RETENTION_POLICIES = ['none', 'all', 'final_gcut', 'results']
+ARCHIVE_NAME = 'outputs.tar.gz'
+
+# resolved at import, since __file__ may be relative to a directory we leave
+_SCRIPT = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+
+
+def gcut_dirs(eval_dir):
+    """ returns names of gcut_dir.N directories in eval_dir, sorted by N """
+    names = [os.path.basename(d) for d in glob.glob(os.path.join(eval_dir, 'gcut_dir.*'))]
+    return sorted(names, key=lambda name: int(name.split('.')[1]))
+
+
+def generated_paths(eval_dir):
+    """ returns names of files and directories in eval_dir made by an evaluation """
+    ws = workspace.Workspace(eval_dir)
+    pp_dirs = sorted(os.path.basename(d) for d in
+                     glob.glob(os.path.join(eval_dir, '*_pseudopotential')))
+    elements = [d[:-len('_pseudopotential')] for d in pp_dirs]
+    paths = pp_dirs
+    paths += [name for elem in elements for name in ['PAW.'+elem, elem+'.in']]
+    paths += [os.path.basename(f) for f in [ws.converged_gcut_file(), ws.trace_spool_file()]]
+    paths += gcut_dirs(eval_dir)
+    return [p for p in paths if os.path.lexists(os.path.join(eval_dir, p))]
+
+
+def _regular_files(eval_dir, path):
+    """ regular files (not symlinks) at or under eval_dir/path, relative to eval_dir """
+    full_path = os.path.join(eval_dir, path)
+    if os.path.islink(full_path):
+        return []
+    if os.path.isfile(full_path):
+        return [path]
+    files = []
+    for root, dirs, names in os.walk(full_path):
+        for name in sorted(names):
+            f = os.path.join(root, name)
+            if not os.path.islink(f):
+                files.append(os.path.relpath(f, eval_dir))
+    return files
+
+
+def final_gcut_dir(eval_dir):
+    """ returns name of the gcut_dir.N the evaluation converged in, or the highest one """
+    try:
+        with open(workspace.Workspace(eval_dir).converged_gcut_file()) as fin:
+            name = fin.read().strip()
+        if os.path.isdir(os.path.join(eval_dir, name)):
+            return name
+    except IOError:
+        pass
+    gcuts = gcut_dirs(eval_dir)
+    return gcuts[-1] if gcuts else None
+
+
+def files_to_keep(eval_dir, policy):
+    """ returns generated files to archive under policy """
+    paths = generated_paths(eval_dir)
+    if policy == 'results':
+        return []
+    if policy == 'final_gcut':
+        final = final_gcut_dir(eval_dir)
+        paths = [p for p in paths if not p.startswith('gcut_dir.') or p == final]
+    return [f for p in paths for f in _regular_files(eval_dir, p)]
+
+
+def compact(eval_dir, policy):
+    """ archive files kept by policy, then remove all generated paths """
+    assert policy in RETENTION_POLICIES, "Unknown retention policy " + policy
+    if policy == 'none':
+        return
+    keep = files_to_keep(eval_dir, policy)
+    if keep:
+        # write under a temporary name so a partial archive is never left behind
+        fd, tmp_archive = tempfile.mkstemp(dir=eval_dir, suffix='.tar.gz')
+        os.close(fd)
+        with tarfile.open(tmp_archive, 'w:gz') as tar:
+            for f in keep:
+                tar.add(os.path.join(eval_dir, f), arcname=f)
+        os.rename(tmp_archive, os.path.join(eval_dir, ARCHIVE_NAME))
+    for p in generated_paths(eval_dir):
+        full_path = os.path.join(eval_dir, p)
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            shutil.rmtree(full_path)
+        else:
+            try:
+                os.remove(full_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+def compact_in_background(eval_dir, policy):
+    """
+    run compact in a detached process so the analysis driver can exit
+    (and dakota start the next evaluation) right away
+    """
+    if policy == 'none':
+        return
+    with open(os.devnull, 'r+') as devnull:
+        subprocess.Popen([sys.executable, _SCRIPT,
+                          os.path.abspath(eval_dir), policy],
+                         stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, preexec_fn=os.setsid)
+
+
+if __name__ == '__main__':
+    compact(sys.argv[1], sys.argv[2])
@@ -53,13 +53,15 @@ class Parameters(object):
             eval_id=None):
         self.aprepro_format = aprepro_format
         self._variables = copy.deepcopy(variables)
+        self._raw_variables = copy.deepcopy(variables)
         self.an_comps = list(an_comps)
         self.eval_id = str(eval_id)
         self.eval_num = int(eval_id.split(":")[-1])
         # Convert variables to the appropriate type. The possible types
         # are int, float, and string. The variables are already strings.
+        # The original strings remain available through raw_value.
         # TODO: Consider a user option to override this behavior and keep
-        # everything as a string, or provide access to the original strings
+        # everything as a string
         for k, v in self._variables.items():
             try:
                 self._variables[k] = int(v)
@@ -82,9 +84,18 @@ class Parameters(object):
 
     def __setitem__(self,key,value):
         if type(key) is int:
-            self._variables[self.descriptors[key]] = value
+            key = self.descriptors[key]
+        self._variables[key] = value
+        self._raw_variables[key] = str(value)
+
+    def raw_value(self, key):
+        """Return a variable's value as the string read from the parameters
+        file, before conversion to int or float. Variables can be accessed
+        by name or by index."""
+        if type(key) is int:
+            return self._raw_variables[self.descriptors[key]]
         else:
-            self._variables[key] = value
+            return self._raw_variables[key]
 
     @property
     def num_variables(self):
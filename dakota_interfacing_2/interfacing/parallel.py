@@ -180,19 +180,34 @@ class _TileLock(object):
 
 
 
-def _mpirun(node_list, user_commands, **kwargs):
+def _mpirun(node_list, user_commands, monitor=None, **kwargs):
     """Use mpirun to launch a command in parallel
 
     Args:
         node_list (string): Relative node list formatted for use with -host option
         commands (list): Each item is a tuple: (applic_procs, tokenized command 
             to be run). len(commands) == 1 for SIMD model.
+        monitor (callable, optional): If provided, mpirun is started with
+            subprocess.Popen and monitor is called with the Popen object. It
+            must wait for mpirun to exit (it may kill it) and return its
+            returncode.
         **kwargs: optional keyword arguments to pass to suprocess.call. See 
             subprocess documentation for available options.
 
     Returns:
         returncode (int) of mpirun.
     """
+    if monitor is None:
+        returncode = subprocess.call(_mpirun_args(node_list, user_commands), **kwargs)
+    else:
+        process = subprocess.Popen(_mpirun_args(node_list, user_commands), **kwargs)
+        returncode = monitor(process)
+    sys.stdout.flush()
+    return returncode
+
+
+def _mpirun_args(node_list, user_commands):
+    """Build the mpirun command line for _mpirun and tile_start_dynamic"""
     mpi_command = ["mpirun"]
     host_args = ["-host", node_list]
     # construct a composite user_command from the list of provided commands.
@@ -200,9 +215,7 @@ def _mpirun(node_list, user_commands, **kwargs):
     for command in user_commands:
         user_command += ["-np", str(command[0])] + command[1] + [":"]
     user_command.pop() # remove the final :
-    returncode = subprocess.call(mpi_command + host_args + user_command, **kwargs)
-    sys.stdout.flush()
-    return returncode
+    return mpi_command + host_args + user_command
 
 def _calc_num_tiles(applic_tasks=None, tasks_per_node=None, num_nodes=None, 
         dedicated_master=None):
@@ -280,7 +293,7 @@ def tile_run_static(commands=[], dedicated_master=None, eval_num=None,
     return returncode
 
 def tile_run_dynamic(commands=[], dedicated_master=None, lock_id=None,
-        lock_dir=None, **kwargs):
+        lock_dir=None, timings=None, **kwargs):
     """Run a command in parallel on an available tile assuming dynamic scheduling
 
     Keyword args:
@@ -290,8 +303,13 @@ def tile_run_dynamic(commands=[], dedicated_master=None, lock_id=None,
             for Dakota (default: None).
         lock_id (str, optional): Unique prefix for lockfiles used to manage tiles.
         lock_dir (str, optional): Name of directory where lockfiles will be written.
+        timings (dict, optional): If provided, the seconds spent acquiring a
+            tile and running mpirun are stored under the keys 'tile_wait'
+            and 'mpirun'.
         **kwargs: optional keyword arguments to eventually pass to suprocess.call.
-            See subprocess documentation for available options.
+            See subprocess documentation for available options. The monitor
+            keyword is handled by _mpirun: a callable that is given the Popen
+            object of mpirun and waits for it.
             
     Returns:
         returncode (int) from mpirun
@@ -318,9 +336,138 @@ def tile_run_dynamic(commands=[], dedicated_master=None, lock_id=None,
         lock_dir = os.environ["HOME"] + os.sep + ".DakotaEvalTiling"
     # Acquire an available tile, calculate its list of nodes, and mpirun the command(s)
     # on these resources.
+    start = time.time()
     with _TileLock(num_tiles, lock_id, lock_dir) as tile:
+        acquired = time.time()
         node_list = _get_node_list(tile, applic_tasks, tasks_per_node, dedicated_master)
         returncode = _mpirun(node_list, commands, **kwargs)
+        finished = time.time()
+    if timings is not None:
+        timings['tile_wait'] = acquired - start
+        timings['mpirun'] = finished - acquired
     sys.stdout.flush()
     return returncode
 
+
+class TileRun(object):
+    """An mpirun started by tile_start_dynamic, holding its tile until it exits
+
+    Attributes:
+        process: subprocess.Popen object of mpirun
+        tile: Tile number, 0-based.
+    """
+
+    def __init__(self, lock, tile, process):
+        self._lock = lock
+        self.tile = tile
+        self.process = process
+        self._owner = os.getpid()
+        _tile_runs.append(self)
+
+    def poll(self):
+        """Return mpirun's returncode, None while it runs. The tile is
+        released once mpirun has exited."""
+        returncode = self.process.poll()
+        if returncode is not None:
+            self._release()
+        return returncode
+
+    def wait(self):
+        """Wait for mpirun to exit, release the tile and return the returncode"""
+        returncode = self.process.wait()
+        self._release()
+        return returncode
+
+    def _release(self):
+        if self._lock is not None:
+            self._lock.__exit__(None, None, None)
+            self._lock = None
+        if self in _tile_runs:
+            _tile_runs.remove(self)
+
+
+# TileRuns that hold a tile, see release_tile_runs
+_tile_runs = []
+
+
+def release_tile_runs():
+    """Terminate the mpiruns started by tile_start_dynamic in this process
+    and release their tiles, e.g. from a SIGTERM handler. TileRuns a forked
+    child inherited from its parent are left alone.
+    """
+    for run in list(_tile_runs):
+        if run._owner != os.getpid():
+            continue
+        if run.process.poll() is None:
+            run.process.terminate()
+        run.wait()
+
+
+def tile_start_dynamic(commands=[], dedicated_master=None, lock_id=None,
+        lock_dir=None, **kwargs):
+    """Start a command in parallel on an available tile without waiting for it
+
+    Like tile_run_dynamic, but mpirun is started with subprocess.Popen and
+    a TileRun is returned right away, so one process can drive many runs.
+    The tile stays locked until TileRun.poll or TileRun.wait sees mpirun
+    exit.
+
+    Keyword args:
+        commands, dedicated_master, lock_id, lock_dir: See tile_run_dynamic.
+        **kwargs: optional keyword arguments to pass to subprocess.Popen.
+
+    Returns:
+        TileRun of the started mpirun
+
+    Raises:
+        ResourceError: When a dedicated master is requested but there is only
+            one node in the job allocation, or when no available tiles were
+            found.
+    """
+    applic_tasks = 0
+    for command in commands:
+        applic_tasks += command[0]
+    num_nodes, tasks_per_node, job_id = _get_job_info()
+    num_tiles = _calc_num_tiles(applic_tasks, tasks_per_node, num_nodes, dedicated_master)
+    if lock_id is None:
+        lock_id = job_id
+    if lock_dir is None:
+        lock_dir = os.environ["HOME"] + os.sep + ".DakotaEvalTiling"
+    lock = _TileLock(num_tiles, lock_id, lock_dir)
+    tile = lock.__enter__()
+    try:
+        node_list = _get_node_list(tile, applic_tasks, tasks_per_node, dedicated_master)
+        process = subprocess.Popen(_mpirun_args(node_list, commands), **kwargs)
+    except:
+        lock.__exit__(*sys.exc_info())
+        raise
+    return TileRun(lock, tile, process)
+
+
+def available_tiles(commands=[], dedicated_master=None, lock_id=None,
+        lock_dir=None):
+    """Count the tiles tile_run_dynamic could acquire right now
+
+    Keyword args:
+        commands (list): Each item is a tuple: (applic_procs, tokenized command 
+            to be run). Used only to compute the tile size.
+        dedicated_master (NODE or TILE, optional): Reserve the first NODE or TILE 
+            for Dakota (default: None).
+        lock_id (str, optional): Unique prefix for lockfiles used to manage tiles.
+        lock_dir (str, optional): Name of directory where lockfiles will be written.
+
+    Returns:
+        Number of tiles (int) whose lockfile does not exist. Other processes
+        may acquire them at any time, so this is only an estimate.
+    """
+    applic_tasks = 0
+    for command in commands:
+        applic_tasks += command[0]
+    num_nodes, tasks_per_node, job_id = _get_job_info()
+    num_tiles = _calc_num_tiles(applic_tasks, tasks_per_node, num_nodes, dedicated_master)
+    if lock_id is None:
+        lock_id = job_id
+    if lock_dir is None:
+        lock_dir = os.environ["HOME"] + os.sep + ".DakotaEvalTiling"
+    return len([tile for tile in range(num_tiles)
+                if not os.path.exists(lock_dir + os.sep + lock_id + "." + str(tile))])
@@ -0,0 +1,233 @@
+"""
+reading socorro's diaryf output, including while socorro is still running
+
+read_diaryf reads a finished diaryf once and returns everything the
+objectives need from it.
+
+socorro writes a line per self-consistent (SCF) step to diaryf:
+
+    Self-consistent step  3:  cell energy = -738.814077556,  energy change = -1.2444E-01
+
+ScfWatchdog follows those lines as they are written and kills socorro runs
+whose SCF is going nowhere:
+
+    - diverging: the size of the energy change grew for divergence_steps
+      steps in a row
+    - stagnating: no step in the last stagnation_steps steps brought the
+      size of the energy change below the smallest one seen before them
+      (this catches oscillation as well as slow crawl)
+    - too long: more than max_steps steps
+
+Each criterion is off when its setting is None. Every watched run adds a
+'socorro.scf' span to the evaluation trace with its step count, last
+energy change and kill reason, if any.
+"""
+import re
+import time
+import numpy as np
+import eval_trace
+import logtail
+
+
+SCF_STEP = re.compile(r'Self-consistent step\s+(\d+):\s+cell energy\s*=\s*([-+.\dEeDd]+)'
+                      r'(?:,\s+energy change\s*=\s*([-+.\dEeDd]+))?')
+
+
+def parse_scf_step(line):
+    """
+    returns (step, cell energy, energy change) from an SCF step line,
+    None if line isn't one. The energy change is None for the first step.
+    """
+    m = SCF_STEP.search(line)
+    if m is None:
+        return None
+    step, energy, change = m.groups()
+    if change is not None:
+        change = float(change.replace('D', 'E').replace('d', 'e'))
+    return int(step), float(energy.replace('D', 'E').replace('d', 'e')), change
+
+
+def read_diaryf(path, forces_out=None):
+    """
+    reads socorro output file path in one pass and returns dict of
+        energy: final cell energy, None if socorro didn't finish
+        forces: 1 by 3N numpy array of atomic forces, where N is the number
+            of atoms, None if there are none. With forces_out, a flat view
+            of forces_out.
+        nb: number of bands
+        nkpnts: number of special k-points
+        nd: first plane wave cutoff energy (the density's)
+        ng: last plane wave cutoff energy (the wave functions')
+        niter: number of SCF steps
+        scf_energies: cell energy at each SCF step
+    any of nb, nd and ng that isn't in the file is None
+
+    forces_out: optional preallocated N by 3 float array (such as a row of
+        the (configs, atoms, 3) array eval_pp.main keeps per gcut) that the
+        forces are written into
+    """
+    record = {'energy': None, 'forces': None, 'nb': None, 'nkpnts': 0,
+              'nd': None, 'ng': None, 'niter': 0, 'scf_energies': []}
+    with open(path) as fin:
+        for line in fin:
+            if 'Self-consistent step' in line:
+                record['niter'] += 1
+                scf_step = parse_scf_step(line)
+                if scf_step is not None:
+                    record['scf_energies'].append(scf_step[1])
+            elif 'cell energy   ' in line:
+                if record['energy'] is None:
+                    record['energy'] = float(line.split()[3])
+            elif 'Atomic forces:' in line:
+                if record['forces'] is None:
+                    record['forces'] = _read_forces_block(fin, forces_out)
+            elif 'Special k-point' in line:
+                record['nkpnts'] += 1
+            elif 'Plane wave cutoff energy' in line:
+                cutoff = float(line.split('=')[1].split()[0])
+                if record['nd'] is None:
+                    record['nd'] = cutoff
+                record['ng'] = cutoff
+            elif 'Number of bands' in line:
+                if record['nb'] is None:
+                    record['nb'] = int(line.split('=')[1])
+    return record
+
+
+def _read_forces_block(fin, forces_out=None):
+    """
+    reads the atomic forces table following an 'Atomic forces:' line,
+    into forces_out if given. Returns them as a flat array.
+    """
+    # skip the two header lines
+    next(fin)
+    next(fin)
+    rows = []
+    for line in fin:
+        if line.strip() == '':
+            break  # blank line after forces
+        rows.append(line.split()[1:4])
+    if forces_out is None:
+        return np.array(rows, dtype=float).reshape(-1)
+    if len(rows) != len(forces_out):
+        raise ValueError('%d atomic forces in diaryf, expected %d' % (len(rows), len(forces_out)))
+    for atom, row in enumerate(rows):
+        forces_out[atom] = map(float, row)
+    return forces_out.reshape(-1)
+
+
+class ScfProgress(object):
+    """
+    SCF steps of one socorro run, checked against the ScfWatchdog criteria
+
+    attributes
+    steps: number of SCF steps seen
+    changes: sizes of the energy changes seen
+    """
+    def __init__(self, divergence_steps=None, stagnation_steps=None, max_steps=None):
+        self.divergence_steps = divergence_steps
+        self.stagnation_steps = stagnation_steps
+        self.max_steps = max_steps
+        self.steps = 0
+        self.changes = []
+
+    def add(self, line):
+        """ add a diaryf line (lines other than SCF steps are ignored) """
+        scf_step = parse_scf_step(line)
+        if scf_step is None:
+            return
+        self.steps += 1
+        if scf_step[2] is not None:
+            self.changes.append(abs(scf_step[2]))
+
+    def kill_reason(self):
+        """ returns why the run should be killed, None if it shouldn't """
+        if self.max_steps is not None and self.steps > self.max_steps:
+            return 'more than %d SCF steps' % self.max_steps
+        n = self.divergence_steps
+        if n is not None and len(self.changes) > n:
+            recent = self.changes[-n-1:]
+            if all(b > a for a, b in zip(recent[:-1], recent[1:])):
+                return 'energy change grew for %d SCF steps' % n
+        n = self.stagnation_steps
+        if n is not None and len(self.changes) > n:
+            if min(self.changes[-n:]) >= min(self.changes[:-n]):
+                return 'energy change did not decrease in %d SCF steps' % n
+        return None
+
+
+class ScfWatchdog(object):
+    """
+    divergence_steps, stagnation_steps, max_steps: see module docstring
+    poll_interval: most seconds between reads of diaryf. monitor starts
+        at first_poll_interval and doubles it up to poll_interval, so a
+        short run is noticed soon after it exits.
+    """
+    def __init__(self, divergence_steps=None, stagnation_steps=None, max_steps=None,
+                 poll_interval=0.5, first_poll_interval=0.02):
+        self.divergence_steps = divergence_steps
+        self.stagnation_steps = stagnation_steps
+        self.max_steps = max_steps
+        self.poll_interval = poll_interval
+        self.first_poll_interval = first_poll_interval
+
+    def follow(self, diaryf_path, run_name):
+        """ returns an ScfFollower of one run's diaryf_path, for polling """
+        return ScfFollower(ScfProgress(self.divergence_steps, self.stagnation_steps,
+                                       self.max_steps),
+                           diaryf_path, run_name)
+
+    def monitor(self, diaryf_path, run_name):
+        """
+        returns a monitor for tile_run_dynamic that follows diaryf_path
+        and terminates mpirun if the SCF is diverging or stagnating
+        """
+        def watch(process):
+            follower = self.follow(diaryf_path, run_name)
+            interval = min(self.first_poll_interval, self.poll_interval)
+            while process.poll() is None:
+                if follower.check() is not None:
+                    print 'Killing socorro in', run_name + ':', follower.kill_reason
+                    process.terminate()
+                    process.wait()
+                    break
+                time.sleep(interval)
+                interval = min(2*interval, self.poll_interval)
+            follower.finish()
+            return process.returncode
+        return watch
+
+
+class ScfFollower(object):
+    """
+    reads the SCF steps a socorro run has added to its diaryf each time
+    check() is called, without blocking
+
+    attributes
+    progress: ScfProgress of the run
+    kill_reason: why the run should be killed, None if it shouldn't
+    """
+    def __init__(self, progress, diaryf_path, run_name):
+        self.progress = progress
+        self.run_name = run_name
+        self.kill_reason = None
+        self._diaryf = logtail.LogTail(diaryf_path)
+        self._start = time.time()
+
+    def check(self):
+        """ reads new diaryf lines and returns kill_reason """
+        for line in self._diaryf.read_lines():
+            self.progress.add(line)
+        if self.kill_reason is None:
+            self.kill_reason = self.progress.kill_reason()
+        return self.kill_reason
+
+    def finish(self):
+        """ reads the rest of diaryf once the run has exited and traces the run """
+        for line in self._diaryf.read_lines():
+            self.progress.add(line)
+        changes = self.progress.changes
+        eval_trace.record('socorro.scf', time.time() - self._start, run=self.run_name,
+                          steps=self.progress.steps,
+                          last_change=changes[-1] if changes else None,
+                          kill_reason=self.kill_reason)
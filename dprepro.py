@@ -0,0 +1,67 @@
+"""
+in-process replacement for Dakota's dprepro utility
+
+Only the plain tag substitution opal2 uses is supported: every {NAME} in a
+template, where NAME is a variable in the Dakota parameters file, is
+replaced by the value exactly as written in the parameters file. This gives
+the same output as dprepro without starting a new process and re-parsing
+the parameters file for every template.
+
+Templates are compiled once into a list of literal text and tag names and
+kept in a module level cache, keyed by the template's path and invalidated
+when its mtime or size changes.
+"""
+import os
+import re
+
+
+class TemplateError(Exception):
+    """raised if a template contains a tag with no matching parameter"""
+
+
+_TAG_RE = re.compile(r'\{([A-Za-z_][A-Za-z0-9_:.]*)\}')
+
+# abspath -> (mtime, size, compiled template)
+_compiled_templates = {}
+
+
+def compile_template(text):
+    """
+    split template text into a list alternating between literal text
+    (even indices) and tag names (odd indices)
+    """
+    return _TAG_RE.split(text)
+
+
+def load_template(template_file):
+    """ returns compiled template for template_file, reusing cached copy """
+    path = os.path.abspath(template_file)
+    st = os.stat(path)
+    cached = _compiled_templates.get(path)
+    if cached is not None and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        return cached[2]
+    with open(path) as fin:
+        compiled = compile_template(fin.read())
+    _compiled_templates[path] = (st.st_mtime, st.st_size, compiled)
+    return compiled
+
+
+def render(compiled, params):
+    """
+    returns text of compiled template with tags replaced by values from
+    params, a Parameters object from read_parameters_file
+    """
+    pieces = list(compiled)
+    for i in range(1, len(pieces), 2):
+        try:
+            pieces[i] = params.raw_value(pieces[i])
+        except KeyError:
+            raise TemplateError('no parameter named ' + pieces[i])
+    return ''.join(pieces)
+
+
+def preprocess(template_file, params, output_file):
+    """ writes template_file to output_file with tags replaced from params """
+    text = render(load_template(template_file), params)
+    with open(output_file, 'w') as fout:
+        fout.write(text)
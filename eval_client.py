@@ -0,0 +1,39 @@
+"""
+thin client for eval_server.py
+
+Kept free of heavy imports (numpy, eval_pp, dakota_interfacing_2) so that
+forwarding an evaluation costs little more than starting python.
+"""
+import json
+import os
+import socket
+import sys
+
+
+def forward(socket_path, argv=()):
+    """
+    ask the evaluation server listening on socket_path to run
+    analysis_driver.main in the current directory, and wait for it
+
+    argv: the params and results file names given to analysis_driver.py
+
+    returns exit status of the evaluation (0 for success), or None if no
+    server is listening on socket_path.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+    request = {'cwd': os.getcwd(), 'argv': list(argv[:2])}
+    sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+    reply = sock.makefile('r').readline()
+    sock.close()
+    if not reply:
+        sys.stderr.write('evaluation server closed connection without replying\n')
+        return 1
+    reply = json.loads(reply)
+    if reply.get('message'):
+        sys.stderr.write(reply['message'])
+    return reply['status']
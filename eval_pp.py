@@ -1,9 +1,20 @@
 import numpy as np
 import os
+import re
 import sys
 import subprocess
+import time
 import multiprocessing
+import shutil
+import signal
 import calc_accuracy
+import diaryf as diaryf_parser
+import eval_trace
+import file_cache
+import flop_model
+import procgroup
+import refdata
+import workspace as workspace_layout
 import dakota_interfacing_2.interfacing.parallel as di
 
 
@@ -14,13 +25,60 @@ class NoCutoffConvergence(Exception):
     """raised if results don't converge with respect to cutoff"""
 
 
-def main(element_list, gcuts, energy_tol):
+# mpirun arguments for one socorro run (one tile per configuration)
+SOCORRO_COMMANDS = [(1, ["--bind-to", "none", "socorro"])]
+
+GCUT_SEARCHES = ['linear', 'adaptive']
+
+# how socorro runs are launched: 'fork' runs each mpirun from a forked
+# python worker, 'direct' starts mpirun from the driver process itself
+# (see SocorroLaunch)
+LAUNCH_ENGINES = ['fork', 'direct']
+
+# exit code of a socorro worker that found no idle tile (EX_TEMPFAIL),
+# and seconds before a PositionSweep tries again
+TILES_BUSY_EXIT = 75
+TILE_RETRY_SECONDS = 5.
+
+
+def main(element_list, gcuts, energy_tol, speculative_gcuts=0, gcut_search='linear',
+         restart_files=(), convergence_subset=0, convergence_verify=False,
+         convergence_history=None, scf_watchdog=None, workspace=None,
+         launch_engine='fork', refdata_cache=False):
     #def main(element_list):
     """
     INPUTS
         element_list: example are ['Si', 'Ge'] or ['N']
         gcuts: list of gcuts to run to tet for energy convergence
         energy_tol: energy at which
+        speculative_gcuts: while a gcut runs, start up to this many of the
+            following gcuts if there are enough idle tiles for them. They
+            are cancelled and removed once the energies converge at a
+            lower gcut. Only used by the linear search.
+        gcut_search: 'linear' runs gcuts in order until the energies of two
+            consecutive gcuts agree. 'adaptive' uses adaptive_gcut_search
+            to find the same gcut in fewer sweeps.
+        restart_files: restart data files (relative to a socorro run
+            directory) to carry from each configuration's run at the
+            highest finished lower gcut into its run at a new gcut.
+            See DftRun.
+        convergence_subset: if nonzero, search for the converged gcut
+            using only this many configurations, chosen by
+            select_convergence_subset, then run the rest at that gcut only
+        convergence_verify: with convergence_subset, also run the rest of
+            the configurations at the gcut below the converged one and,
+            if they aren't converged, continue the search with all
+            configurations
+        convergence_history: file recording how hard each configuration
+            was to converge, used to choose the subset
+        scf_watchdog: diaryf.ScfWatchdog that follows every socorro run
+            and kills those whose SCF diverges or stagnates
+        workspace: workspace.Workspace of the evaluation, the current
+            directory's by default. Nothing changes the current directory.
+        launch_engine: one of LAUNCH_ENGINES
+        refdata_cache: if True, read configurations.in and
+            allelectron_forces.dat from their memory-mapped binary copies
+            (see refdata.py)
 
     ATTRIBUTES
         all_energy: energy at every configuration for each gcut.
@@ -30,64 +88,438 @@ def main(element_list, gcuts, energy_tol):
             config, kth atom, and m=0,1,2 for x,y,z direction
     
     RETURNS:
-        objectives: 
+        objectives: dict of accu and work objectives, num_sweeps, the
+            number of gcuts socorro was run at, and num_runs, the number
+            of socorro runs
     """
-    run_dir = os.getcwd()
-
-    # these are the same for different optimizations
-    argvf_template_path = os.path.join(run_dir, 'argvf.template')
-    crystal_template_path = os.path.join(run_dir, 'crystal.template')
+    assert gcut_search in GCUT_SEARCHES, "Unknown gcut_search " + gcut_search
+    assert launch_engine in LAUNCH_ENGINES, "Unknown launch_engine " + launch_engine
+    if workspace is None:
+        workspace = workspace_layout.Workspace()
 
-    # these will change for different optimizations
-    pp_path_list = [os.path.join(run_dir, 'PAW.'+elem) for elem in element_list]
-    positions_to_run = get_random_configurations('../configurations.in') # read random configs from file
+    # read random configs from file
+    positions_to_run = get_random_configurations(workspace.campaign_path('configurations.in'),
+                                                 binary_cache=refdata_cache)
     print positions_to_run
+    all_configs = range(len(positions_to_run))
+    ladder = GcutLadder(element_list, gcuts, energy_tol, positions_to_run, workspace,
+                        gcut_search, speculative_gcuts, restart_files, scf_watchdog,
+                        launch_engine)
+    levels = ladder.levels
+    if launch_engine == 'direct':
+        # mpirun is the driver's own child: a killed driver must release its tiles
+        previous_sigterm = signal.signal(signal.SIGTERM, _release_tiles_and_exit)
+    try:
+        ladder_configs = all_configs
+        if convergence_subset:
+            ladder_configs = select_convergence_subset(len(all_configs), convergence_subset,
+                                                       convergence_history)
+            print 'Converging gcut with configurations ', ladder_configs
+        converged = ladder.search(ladder_configs, 0)
+        ladder.cancel()
+        if converged is not None and ladder_configs != all_configs:
+            if convergence_verify:
+                energies = ladder.run_levels([converged-1, converged], all_configs)
+                if not is_converged(energies, energy_tol):
+                    print 'Not converged at gcut = ', gcuts[converged], 'for all configurations'
+                    converged = ladder.search(all_configs, converged)
+                    ladder.cancel()
+            else:
+                ladder.run_levels([converged], all_configs)
+        num_runs = sum(len(level) for level in levels.values())
+        print 'Number of socorro sweeps: ', len(levels), ' runs: ', num_runs
+        eval_trace.annotate(num_sweeps=len(levels), num_runs=num_runs, gcut_search=gcut_search)
+        if restart_files:
+            eval_trace.annotate(scf_steps_saved=sum(ladder.scf_steps_saved))
+        if convergence_history is not None and converged is not None:
+            record_convergence_history(convergence_history, levels[converged-1],
+                                       levels[converged])
 
-    # increase gcut until converged
-    # these all_ lists are needed for convergence checks
-    all_energy = [] # will store all energies for each gcut
-    all_forces = [] # will store all energies for each gcut
-    for gcut in gcuts:
-        # make and move to gcut directory
-        gcut_dir_name = 'gcut_dir.' + str(int(gcut))
-        os.mkdir(gcut_dir_name)
-        os.chdir(gcut_dir_name)
-        
+        if converged is None:
+            raise NoCutoffConvergence  # if no gcut convergence
+
+        # If results are converged with respect to gcut,
+        # write results and exit.
+        print "Converged at gcut = ", gcuts[converged]
+        # the adaptive search may have run higher gcuts; compact keeps this one
+        with open(workspace.converged_gcut_file(), 'w') as fout:
+            fout.write(os.path.basename(workspace.gcut_dir(gcuts[converged])) + '\n')
+        position_dft_runs = [levels[converged][c][0] for c in all_configs]
+        forces = ladder.level_forces[converged]
+        with eval_trace.span('calc_accuracy'):
+            accu = calc_accuracy.calc_accuracy_objective(forces, 
+                                                         workspace.campaign_path('allelectron_forces.dat'),
+                                                         binary_cache=refdata_cache)
+        with eval_trace.span('calc_nflops'):
+            work = calc_work_objective(position_dft_runs)
+        return {'accu': accu, 'work': work, 'num_sweeps': len(levels), 'num_runs': num_runs}
+    finally:
+        # don't leave speculative runs behind when a lower gcut fails
+        ladder.cancel()
+        if launch_engine == 'direct':
+            signal.signal(signal.SIGTERM, previous_sigterm)
+
+
+def _release_tiles_and_exit(signum, frame):
+    """ SIGTERM handler of main with the direct launch engine """
+    di.release_tile_runs()
+    raise SystemExit(128 + signum)
+
+
+class GcutLadder(object):
+    """
+    the socorro sweeps of one eval_pp.main call, and the energies and
+    forces of the runs that finished, per gcut and configuration. Each
+    configuration is run at most once per gcut, however often search and
+    run_levels ask for it.
+
+    element_list, gcuts, energy_tol, gcut_search, speculative_gcuts,
+    restart_files, scf_watchdog, launch_engine: as for main
+    positions_to_run: M by 3N array of the M configurations, as from
+        get_random_configurations
+    workspace: workspace.Workspace of the evaluation
+
+    attributes
+    sweeps: sweeps started but not finished, dict of
+        (gcut index, tuple of configs): (gcut dir, dft runs, PositionSweep)
+    levels: finished runs, dict of gcut index: dict of config index:
+        (dft run, energy, forces)
+    level_forces: dict of gcut index: (configs, atoms, 3) array the runs'
+        forces are parsed into, nan where a configuration wasn't run
+    scf_steps_saved: self-consistent steps saved by restarting, per sweep
+    """
+    def __init__(self, element_list, gcuts, energy_tol, positions_to_run, workspace,
+                 gcut_search='linear', speculative_gcuts=0, restart_files=(),
+                 scf_watchdog=None, launch_engine='fork'):
+        self.gcuts = gcuts
+        self.energy_tol = energy_tol
+        self.positions_to_run = positions_to_run
+        self.workspace = workspace
+        self.gcut_search = gcut_search
+        self.speculative_gcuts = speculative_gcuts
+        self.restart_files = restart_files
+        self.scf_watchdog = scf_watchdog
+        self.launch_engine = launch_engine
+        # these are the same for different optimizations
+        self.argvf_template_path = workspace.path('argvf.template')
+        self.crystal_template_path = workspace.path('crystal.template')
+        # these will change for different optimizations
+        self.pp_path_list = [workspace.path('PAW.'+elem) for elem in element_list]
+        # the crystal files only depend on the configuration, so render them all once
+        self.templates = SocorroTemplates(self.argvf_template_path, self.crystal_template_path)
+        self.crystal_texts = self.templates.render_crystals(positions_to_run)
+        self.sweeps = {}
+        self.levels = {}
+        self.level_forces = {}
+        self.scf_steps_saved = []
+
+    def start_sweep(self, i, configs):
+        """ start a sweep of configs at gcuts[i] """
         # create DftRun object for each atomic structure
         position_dft_runs = []
-        for pos in positions_to_run:
-            pos_reshaped = pos.reshape([-1,3])  # reshape to one row per atom
-            position_dft_runs.append(DftRun(pp_path_list, argvf_template_path,
-                                            crystal_template_path, pos_reshaped, gcut))
-        
-        # run socorro at positions in parallel
-        position_sweep(position_dft_runs)
+        for c in configs:
+            # restart from the run at the highest lower gcut that has finished
+            finished_below = [j for j in self.levels if j < i and c in self.levels[j]]
+            restart_dir = None
+            if self.restart_files and finished_below:
+                restart_dir = self.levels[max(finished_below)][c][0].run_dir
+            pos_reshaped = self.positions_to_run[c].reshape([-1,3])  # reshape to one row per atom
+            if i not in self.level_forces:
+                self.level_forces[i] = np.full((len(self.positions_to_run), len(pos_reshaped), 3),
+                                               np.nan)
+            position_dft_runs.append(DftRun(self.pp_path_list, self.argvf_template_path,
+                                            self.crystal_template_path, pos_reshaped,
+                                            self.gcuts[i], restart_dir, self.restart_files,
+                                            self.level_forces[i][c], self.templates,
+                                            self.crystal_texts[c]))
+        self.sweeps[i, tuple(configs)] = start_gcut_sweep(self.gcuts[i], position_dft_runs,
+                                                          [c+1 for c in configs],
+                                                          self.scf_watchdog, self.workspace,
+                                                          self.launch_engine)
 
-        # extract relevant results from socorro outputs
-        try:
-            dft_results = get_dft_results_at_gcut(position_dft_runs) 
+    def run_levels(self, indices, configs):
+        """
+        returns energies of configs at gcuts[i] for i in indices,
+        running socorro where they haven't been run yet
+        """
+        missing = {}
+        for i in indices:
+            missing[i] = [c for c in configs if c not in self.levels.get(i, {})]
+            if missing[i] and (i, tuple(missing[i])) not in self.sweeps:
+                self.start_sweep(i, missing[i])
+        if self.gcut_search == 'linear':
+            # start the next gcuts early on tiles that would be idle
+            for j in range(indices[-1]+1,
+                           min(indices[-1]+1+self.speculative_gcuts, len(self.gcuts))):
+                if (j, tuple(configs)) not in self.sweeps and j not in self.levels:
+                    if idle_tiles(self.sweeps) < len(configs):
+                        break
+                    print 'Speculatively starting gcut = ', self.gcuts[j]
+                    self.start_sweep(j, configs)
+        for i in indices:
+            if not missing[i]:
+                continue
+            # run socorro at positions in parallel. The sweep stays in sweeps
+            # until it has finished, so cancel cancels it if waiting for it
+            # raises.
+            # The other sweeps are polled meanwhile, so their finished runs
+            # release their tiles and their SCF is still watched.
+            gcut_dir_name, position_dft_runs, sweep = self.sweeps[i, tuple(missing[i])]
+            with eval_trace.span('position_sweep', gcut=self.gcuts[i]):
+                wait_position_sweep(sweep, [s for _, _, s in self.sweeps.values()])
+            del self.sweeps[i, tuple(missing[i])]
+
+            # extract relevant results from socorro outputs
+            with eval_trace.span('parse', gcut=self.gcuts[i]):
+                dft_results = get_dft_results_at_gcut(position_dft_runs) 
             print dft_results
-        except SocorroFail:
-            raise
+            level = self.levels.setdefault(i, {})
+            for c, run, energy, forces in zip(missing[i], position_dft_runs,
+                                              dft_results['energies'], dft_results['forces']):
+                level[c] = (run, energy, forces)
+            if self.restart_files:
+                self.scf_steps_saved.append(report_restart_savings(position_dft_runs))
+        return [[self.levels[i][c][1] for c in configs] for i in indices]
 
-        # append this gcuts results to list
-        all_energy.append(dft_results['energies'])
-        all_forces.append(dft_results['forces'])
+    def search(self, configs, start):
+        """
+        returns index of the converged gcut at or above gcuts[start] for
+        configs, None if the energies don't converge
+        """
+        if self.gcut_search == 'linear':
+            # increase gcut until converged
+            # these all_ lists are needed for convergence checks
+            all_energy = [] # will store all energies for each gcut
+            for i in range(start, len(self.gcuts)):
+                # append this gcuts results to list
+                all_energy += self.run_levels([i], configs)
+                if is_converged(all_energy, self.energy_tol):
+                    return i
+            return None
+        else:
+            get_energies = lambda i, j: self.run_levels([start+i, start+j], configs)
+            converged = adaptive_gcut_search(self.gcuts[start:], self.energy_tol, get_energies)
+            if converged is None:
+                return None
+            return start + converged
 
-        os.chdir(run_dir)
+    def cancel(self):
+        """ cancel the sweeps that haven't finished (see cancel_gcut_sweeps) """
+        cancel_gcut_sweeps(self.sweeps)
 
-        # If results are converged with respect to gcut,
-        # write results and exit.
-        if is_converged(all_energy, energy_tol):
-            print "Converged at gcut = ", gcut
-            accu = calc_accuracy.calc_accuracy_objective(dft_results['forces'], 
-                                                         os.path.join(run_dir, '..', 'allelectron_forces.dat'))
-            work = calc_work_objective(position_dft_runs, os.path.join(run_dir, '..'))
-            return {'accu': accu, 'work': work}
-    else:
-        raise NoCutoffConvergence  # if no gcut convergence
+
+def select_convergence_subset(num_configs, subset_size, history_file=None):
+    """
+    returns sorted list of subset_size configuration indices to converge
+    gcut with
+
+    Configurations that the history file has no record of come first, so
+    every configuration eventually gets one, then those with the largest
+    mean energy difference at the converged gcut, i.e. the slowest to
+    converge. Without a history the indices are spread evenly over all
+    configurations.
+    """
+    if subset_size <= 0 or subset_size >= num_configs:
+        return range(num_configs)
+    differences = read_convergence_history(history_file) if history_file else {}
+    differences = dict((c, d) for c, d in differences.items() if c < num_configs)
+    if not differences:
+        spread = np.linspace(0, num_configs-1, subset_size)
+        return sorted(set(int(round(c)) for c in spread))
+    unknown = [c for c in range(num_configs) if c not in differences]
+    slowest = sorted(differences, key=lambda c: (-differences[c], c))
+    return sorted((unknown + slowest)[:subset_size])
 
 
+def read_convergence_history(history_file):
+    """ returns dict of configuration index: mean recorded energy difference """
+    differences = {}
+    try:
+        with open(history_file) as fin:
+            for line in fin:
+                fields = line.split()
+                if len(fields) == 2:
+                    differences.setdefault(int(fields[0]), []).append(float(fields[1]))
+    except IOError:
+        pass  # nothing recorded yet
+    return dict((c, np.mean(d)) for c, d in differences.items())
+
+
+def record_convergence_history(history_file, below, converged):
+    """
+    appends a line per configuration run at both the converged gcut and
+    the one below (dicts of config index: (dft run, energy, forces)) with
+    its energy difference between them
+    """
+    lines = ['%d %r\n' % (c, abs(converged[c][1] - below[c][1]))
+             for c in sorted(converged) if c in below]
+    # one write so lines of concurrent evaluations don't interleave
+    with open(history_file, 'a') as fout:
+        fout.write(''.join(lines))
+
+
+def report_restart_savings(dft_runs):
+    """
+    prints the self-consistent steps of each restarted run in dft_runs
+    next to those of the run it restarted from, and returns the total
+    number of steps saved
+    """
+    saved = 0
+    for run in dft_runs:
+        if not run.restarted:
+            continue
+        steps = run.read_scf_steps(os.path.join(run.run_dir, 'diaryf'))
+        previous_steps = run.read_scf_steps(os.path.join(run.restart_dir, 'diaryf'))
+        print 'Restarted', run.run_dir, 'from', run.restart_dir, ':', \
+            steps, 'self-consistent steps, previously', previous_steps
+        saved += previous_steps - steps
+    return saved
+
+
+def adaptive_gcut_search(gcuts, energy_tol, get_energies):
+    """
+    find the first gcut the linear search would stop at, running fewer gcuts
+
+    The linear search stops at gcuts[k] for the smallest k where the
+    energies at gcuts[k-1] and gcuts[k] pass is_converged. Assuming that
+    once two consecutive gcuts agree all higher ones do too, k can be
+    bisected for. Rather than always testing the middle of the remaining
+    range, the next k tested is where predict_converged_gcut expects
+    convergence from the energy differences seen so far.
+
+    gcuts: increasing list of gcuts
+    energy_tol: tolerance for is_converged
+    get_energies: get_energies(i, j) returns energies at gcuts[i] and
+        gcuts[j], a list of energies per configuration for each
+
+    returns k, or None if no consecutive gcuts converge
+    """
+    tested = {}  # k: energy differences between gcuts[k-1] and gcuts[k]
+    lo = 0  # highest k known not to converge (0: none tested)
+    hi = len(gcuts)  # lowest k known to converge (len(gcuts): none found)
+    while hi - lo > 1:
+        if not tested:
+            k = 1  # start like the linear search
+        else:
+            k = (lo + hi) // 2
+            ks = sorted(tested)
+            predicted = predict_converged_gcut([gcuts[i] for i in ks],
+                                               [tested[i] for i in ks], energy_tol)
+            if predicted is not None:
+                k = int(np.searchsorted(gcuts, predicted))
+            # probe at most twice as far from the start as the highest
+            # unconverged k, so a search that converges early doesn't
+            # run gcuts far above where the linear search would stop
+            k = min(max(k, lo+1), hi-1, 2*lo+1)
+        energies = get_energies(k-1, k)
+        tested[k] = np.abs(np.array(energies[1]) - np.array(energies[0]))
+        if is_converged(energies, energy_tol):
+            hi = k
+        else:
+            lo = k
+    if hi == len(gcuts):
+        return None
+    return hi
+
+
+def predict_converged_gcut(upper_gcuts, differences, tol):
+    """
+    predict the gcut where the energy difference from the previous gcut
+    falls below tol for every configuration
+
+    Fits log(difference) linearly in gcut (exponential convergence) for
+    each configuration and returns the largest gcut where a fit crosses
+    log(tol). Returns None if there are fewer than two gcuts or the
+    differences aren't shrinking.
+
+    upper_gcuts: higher gcut of each pair of consecutive gcuts tested
+    differences: energy differences per configuration for each pair
+    """
+    if len(upper_gcuts) < 2:
+        return None
+    g = np.array(upper_gcuts, dtype=float)
+    # a difference of exactly zero would be -inf on the log scale
+    log_d = np.log(np.maximum(np.array(differences, dtype=float), tol*1e-6))
+    slope, intercept = np.polyfit(g, log_d, 1)
+    if not (slope < 0).all():
+        return None
+    return np.max((np.log(tol) - intercept) / slope)
+
+
+
+ARGVF_TAG = re.compile(r'\{(gcut|4gcut|restart)\}')
+
+
+def compile_argvf(template_text):
+    """
+    split argvf template text into a list alternating between literal text
+    (even indices) and tag names (odd indices), like dprepro.compile_template.
+    The tags are {gcut}, {4gcut} and {restart}.
+    """
+    return ARGVF_TAG.split(template_text)
+
+
+def render_argvf(compiled, gcut, restarted):
+    """ returns argvf text of compiled template at gcut """
+    gcut = float(gcut)
+    values = {'gcut': str(gcut), '4gcut': str(4.0 * gcut),
+              'restart': 'on' if restarted else 'off'}
+    pieces = list(compiled)
+    for i in range(1, len(pieces), 2):
+        pieces[i] = values[pieces[i]]
+    return ''.join(pieces)
+
+
+def compile_crystal(template_text, num_atoms):
+    """
+    returns crystal template text as a % format string taking the 3
+    coordinates of each of num_atoms atoms. Blank lines are removed and the
+    coordinates are appended to the last num_atoms lines.
+    """
+    lines = [line.replace('%', '%%') for line in template_text.splitlines(True) if line.strip()]
+    head = lines[:len(lines)-num_atoms]
+    atoms = [line.strip() + ' %s %s %s\n' for line in lines[len(lines)-num_atoms:]]
+    return ''.join(head + atoms)
+
+
+class SocorroTemplates(object):
+    """
+    argvf and crystal templates, read and compiled once (on first use) and
+    rendered for every DftRun of an eval_pp.main call
+    """
+    def __init__(self, argvf_template_path, crystal_template_path):
+        self.argvf_template_path = argvf_template_path
+        self.crystal_template_path = crystal_template_path
+        self._argvf = None
+        self._crystal_text = None
+        self._argvf_texts = {}
+
+    def render_argvf(self, gcut, restarted):
+        """ returns argvf text at gcut, rendered once per gcut """
+        key = (float(gcut), bool(restarted))
+        if key not in self._argvf_texts:
+            if self._argvf is None:
+                with open(self.argvf_template_path) as fin:
+                    self._argvf = compile_argvf(fin.read())
+            self._argvf_texts[key] = render_argvf(self._argvf, gcut, restarted)
+        return self._argvf_texts[key]
+
+    def render_crystals(self, positions):
+        """
+        returns list of crystal file texts, one for each configuration
+
+        positions: M by 3N array of M configurations of N atoms, as from
+            get_random_configurations (or a list of N by 3 arrays)
+        """
+        if self._crystal_text is None:
+            with open(self.crystal_template_path) as fin:
+                self._crystal_text = fin.read()
+        positions = np.array(positions, dtype=float)
+        positions = positions.reshape(len(positions), -1)
+        compiled = compile_crystal(self._crystal_text, positions.shape[1]/3)
+        # tolist() gives python floats, so %s formats them as str() did
+        return [compiled % tuple(row) for row in positions.tolist()]
+
 
 class DftRun:
     """
@@ -101,6 +533,15 @@ class DftRun:
     crystal_template_path: path to crystal template file
     atom_positions: Nx3 array of atomic positions where N is number of atoms
     gcut: wf energy cutoff for dft calculation
+    restart_dir: optional run_dir of a finished run of the same
+     configuration (at a lower gcut) to copy restart data from
+    restart_files: paths, relative to a run directory, of the restart
+     data socorro writes and reads (e.g. density and wavefunctions)
+    forces_out: see attributes
+    templates: optional SocorroTemplates of the two template paths,
+     shared by the runs of an eval_pp.main call
+    crystal_text: optional crystal file text already rendered by
+     templates.render_crystals
 
     important attributes
     pp_path_list: see inputs (pp_path_list)
@@ -108,6 +549,12 @@ class DftRun:
     crystal_template_path: see inputs
     atom_positions: see inputs
     gcut: see inputs
+    restart_dir, restart_files: see inputs
+    restarted: True if setup_files() copied every restart file
+    diaryf_record: diaryf.read_diaryf record of the finished run, None until
+        parse_diaryf() finds energy and forces in run_dir/diaryf
+    forces_out: optional N by 3 array (N atoms) parse_diaryf() writes the
+        forces into
     run_dir: dir where files are setup (and where socorro should be run
         and where results will be)
     _are_files_setup: True if setup_files() run success, False otherwise
@@ -119,12 +566,23 @@ class DftRun:
      if _are_files_setup is True
     """
     def __init__(self, pp_path_list, argvf_template_path,
-                 crystal_template_path, atom_positions, gcut):
+                 crystal_template_path, atom_positions, gcut,
+                 restart_dir=None, restart_files=(), forces_out=None,
+                 templates=None, crystal_text=None):
         self.pp_path_list = pp_path_list
         self.atom_positions = atom_positions
         self.gcut = float(gcut)
         self.argvf_template_path = argvf_template_path
         self.crystal_template_path = crystal_template_path
+        self.restart_dir = restart_dir
+        self.restart_files = list(restart_files)
+        self.restarted = False
+        self.diaryf_record = None
+        self.forces_out = forces_out
+        if templates is None:
+            templates = SocorroTemplates(argvf_template_path, crystal_template_path)
+        self.templates = templates
+        self.crystal_text = crystal_text
         self._are_files_setup = False
         self.run_dir = None
 
@@ -147,30 +605,33 @@ class DftRun:
     #         p = subprocess.Popen('socorro', stdout=logfile, stderr=logfile)
     #         return p # return process id for wait later
    
-    def setup_files(self):
+    def setup_files(self, run_dir=None):
         """
-        write dft input files from templates 
+        write dft input files from templates in run_dir (an existing
+        directory, the current directory by default)
 
         note this will probably fail if argvf, data/, or data/crystal
         alread exist. This may be desirable behavior but if not I can
         change it.
         """
+        if run_dir is None:
+            run_dir = os.getcwd()
+        self.run_dir = os.path.abspath(run_dir)
+        os.mkdir(self._path('data'))
+        self.restarted = self._copy_restart_files()
         self._make_argvf()
-        os.mkdir('data')
         self._make_crystal()
         self._symlink_pseudopotentials()
         self._are_files_setup = True
-        self.run_dir = os.getcwd()
+
+    def _path(self, *names):
+        """ path of names in run_dir (the current directory before setup_files) """
+        return os.path.join(self.run_dir or os.curdir, *names)
 
     def _make_argvf(self):
         """ writes preprocessed argvf text to argvf file """
-        # read in text from template file
-        with open(self.argvf_template_path) as fin:
-            argvf_template_text = fin.readlines()
-        # write preprocessed text to new argvf file
-        with open('argvf', 'w') as fout:
-            preprocessed_text = self._preproc_argvf(argvf_template_text)
-            fout.writelines(preprocessed_text)
+        with open(self._path('argvf'), 'w') as fout:
+            fout.write(self.templates.render_argvf(self.gcut, self.restarted))
  
 
     def _preproc_argvf(self, template_text):
@@ -180,38 +641,48 @@ class DftRun:
         gcut: number to input into template file (int, float, or str)
         template_text: template text for input to dft code,
             read using readlines or similar. The tags {gcut} and 
-            {4gcut} should be in the file.
+            {4gcut} should be in the file. The optional tag {restart}
+            is replaced with on if restart data was copied, off otherwise.
         returns new_text: final text for running dft code, in list of lines
         """
-        gcut = float(self.gcut)
-        text_tmp = [ line.replace('{gcut}', str(gcut)) for line in template_text ]
-        new_text = [ line.replace('{4gcut}', str(4.0 * gcut)) for line in text_tmp ]
-        return new_text
+        compiled = compile_argvf(''.join(template_text))
+        return render_argvf(compiled, self.gcut, self.restarted).splitlines(True)
+
+    def _copy_restart_files(self):
+        """
+        copies restart_files from restart_dir to run_dir.
+        returns True if there were restart files and all were copied; if
+        any is missing (e.g. the earlier run failed) none are copied.
+        """
+        if self.restart_dir is None or not self.restart_files:
+            return False
+        sources = [os.path.join(self.restart_dir, f) for f in self.restart_files]
+        if not all(os.path.isfile(f) for f in sources):
+            return False
+        for f, source in zip(self.restart_files, sources):
+            dest = self._path(f)
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            shutil.copy(source, dest)
+        return True
 
     def _make_crystal(self):
         """
         Some socorro builds want the crystal file in data/
         and some want it in the run directory.
         """
-        # read in text from template file
-        with open(self.crystal_template_path) as fin:
-            crystal_template_text = fin.readlines()
-        preprocessed_text = self._preproc_crystal(crystal_template_text,
-                                                  self.atom_positions)
+        crystal_text = self.crystal_text
+        if crystal_text is None:
+            crystal_text = self.templates.render_crystals([self.atom_positions])[0]
         # write preprocessed text to data/crystal
-        with open('data/crystal', 'w') as fout:
-            fout.writelines(preprocessed_text)
-        os.symlink('data/crystal', 'crystal')
+        with open(self._path('data', 'crystal'), 'w') as fout:
+            fout.write(crystal_text)
+        os.symlink('data/crystal', self._path('crystal'))
  
     @staticmethod
     def _preproc_crystal(mytext, atom_positions):
-        atom_positions = [ map(float, r) for r in atom_positions ]
-        # remove all blank lines (shouldn't cause problems?)
-        mytext = [ line for line in mytext if line.strip() ]
-        # append 3 float values for each of final lines
-        for i, r in enumerate(reversed(atom_positions)):
-            mytext[-i-1] = mytext[-i-1].strip()+' '+' '.join(map(str, r))+'\n'
-        return mytext
+        compiled = compile_crystal(''.join(mytext), len(atom_positions))
+        return (compiled % tuple(np.array(atom_positions, dtype=float).ravel().tolist())).splitlines(True)
 
 
     def _symlink_pseudopotentials(self):
@@ -224,8 +695,8 @@ class DftRun:
         """
         for pp in self.pp_path_list:
             pp_name = os.path.basename(pp)
-            os.symlink(pp, pp_name)
-            os.symlink(pp, 'data/'+pp_name)
+            os.symlink(pp, self._path(pp_name))
+            os.symlink(pp, self._path('data', pp_name))
 
     def read_energy(self, diaryf='diaryf'):
         """
@@ -239,11 +710,7 @@ class DftRun:
         This could fail if the socorro run ouputs multiple cell
         energies, as it does for structure relaxations.
         """
-        with open(diaryf) as fin:
-            for line in fin:
-                if 'cell energy   ' in line:
-                    return float(line.split()[3])
-            return None
+        return diaryf_parser.read_diaryf(diaryf)['energy']
 
 
     def read_forces(self, diaryf='diaryf'):
@@ -252,56 +719,379 @@ class DftRun:
     
         returns forces as 1 by 3N numpy array where N is the number of atoms
         """
-        forces = np.array([]) # blank np array
-        with open(diaryf) as fin:
-            for line in fin:
-                if 'Atomic forces:' in line:
-                    # skip two lines then continue through file
-                    fin.next()
-                    fin.next()
-                    for line in fin:
-                        if line.strip() == '':
-                            break # break when blank line after forces reached
-                        f = map(float, line.split()[1:4])
-                        forces = np.append(forces, f) # append to forces array
-                    return forces
+        return diaryf_parser.read_diaryf(diaryf)['forces']
+
+    def read_scf_steps(self, diaryf='diaryf'):
+        """ returns number of self-consistent steps in socorro output file """
+        return diaryf_parser.read_diaryf(diaryf)['niter']
+
+    def parse_diaryf(self):
+        """
+        returns the diaryf.read_diaryf record of run_dir/diaryf, None if
+        there is no diaryf. A record with energy and forces is kept in
+        diaryf_record, so a finished run's diaryf is only read once.
+        """
+        if self.diaryf_record is not None:
+            return self.diaryf_record
+        diaryf_path = os.path.join(self.run_dir, 'diaryf')
+        if not os.path.isfile(diaryf_path):
             return None
+        record = diaryf_parser.read_diaryf(diaryf_path, self.forces_out)
+        if record['energy'] is not None and record['forces'] is not None:
+            self.diaryf_record = record
+        return record
 
 
 
 def position_sweep(dft_runs):
     """
     run several instances of socorro on different threads using
-    different positions
+    different positions. Raises SocorroFail as soon as one of them fails.
+    """
+    wait_position_sweep(start_position_sweep(dft_runs))
+
+
+def start_position_sweep(dft_runs, run_numbers=None, scf_watchdog=None, sweep_dir=None,
+                         launch_engine='fork'):
     """
-    pos_sweep_dir = os.getcwd()
-    print 'Calling position sweep in ' + pos_sweep_dir
+    set up files for each dft run in a new sweep_dir/workdir_r.N directory
+    (sweep_dir is the current directory by default) and start
+    socorro there without waiting for it, on as many runs at once as there
+    are idle tiles (see max_concurrent_runs). The others are queued and
+    started by wait_position_sweep as tiles free up.
 
-    # for each dft run, set up files and start socorro subprocess
-    processes = []
-    for i,dft_run in enumerate(dft_runs):
-        this_dir = 'workdir_r.'+str(i+1)
+    run_numbers: N for each run, 1, 2, ... by default
+    scf_watchdog: optional diaryf.ScfWatchdog to follow each run
+    launch_engine: one of LAUNCH_ENGINES
+
+    returns the started PositionSweep
+    """
+    if run_numbers is None:
+        run_numbers = range(1, len(dft_runs)+1)
+    if sweep_dir is None:
+        sweep_dir = os.getcwd()
+    print 'Calling position sweep in ' + sweep_dir
+
+    # for each dft run, set up files
+    run_dirs = []
+    for n,dft_run in zip(run_numbers, dft_runs):
+        this_dir = os.path.join(os.path.abspath(sweep_dir), 'workdir_r.'+str(n))
         os.mkdir(this_dir)
-        os.chdir(this_dir)
-
-        dft_run.setup_files()
-
-        # start the tiler on its own process and run socorro
-        # without multiprocess, the socorro runs are serial
-        with open('socorro.out', 'w') as logfile:
-            p = multiprocessing.Process(target=di.tile_run_dynamic, 
-                                        kwargs={"commands" : [(1, ["--bind-to", "none", "socorro"])],
-                                        "dedicated_master" : 0, "stdout" : logfile, "stderr" : logfile})
-            p.start()
-            # p = subprocess.Popen('socorro', stdout=logfile, stderr=logfile)
-        processes.append(p) # add p to process list
-        
-        os.chdir(pos_sweep_dir)
-    
-    # wait for each process to finish
-    for process in processes:
-        process.join()
-        #process.wait()
+        dft_run.setup_files(this_dir)
+        run_dirs.append(this_dir)
+
+    sweep = PositionSweep(dft_runs, run_dirs, max_concurrent_runs(len(dft_runs)),
+                          scf_watchdog, launch_engine)
+    sweep.start_next()
+    return sweep
+
+
+def max_concurrent_runs(num_runs):
+    """
+    how many of num_runs socorro runs to start at once: the idle tiles, but
+    at least one. Outside a resource manager allocation there are no tiles
+    to count, so all of them.
+    """
+    try:
+        tiles = di.available_tiles(commands=SOCORRO_COMMANDS, dedicated_master=0)
+    except di.MgrEnvError:
+        return num_runs
+    return min(num_runs, max(1, tiles))
+
+
+class PositionSweep(object):
+    """
+    runs socorro for the dft runs of a position sweep, at most max_running
+    at a time, each in its own process group so it can be cancelled with
+    procgroup.terminate_process_group. Runs beyond max_running wait in a
+    queue and are started as running ones exit. A run that found every tile
+    taken (exit code TILES_BUSY_EXIT, or ResourceError when launched
+    directly) goes back to the front of the queue. Nothing is started for
+    TILE_RETRY_SECONDS after that, then max_running is counted again from
+    the idle tiles (see max_concurrent_runs).
+
+    With the 'fork' launch_engine each run is a forked _run_socorro_worker,
+    with 'direct' a SocorroLaunch.
+
+    attributes
+    dft_runs: DftRun objects, set up in run_dirs
+    max_running: most runs at once
+    pending: indices of runs waiting to start
+    running: dict of Process (or SocorroLaunch): index of its run
+    returncodes: dict of run index: exit code of the run
+    failed: index of the first run found to have failed, None if none did
+    seconds: dict of run index: seconds its socorro process took
+    processes: every process started, in order
+    """
+    def __init__(self, dft_runs, run_dirs, max_running, scf_watchdog=None,
+                 launch_engine='fork'):
+        self.dft_runs = dft_runs
+        self.run_dirs = run_dirs
+        self.max_running = max_running
+        self.scf_watchdog = scf_watchdog
+        self.launch_engine = launch_engine
+        self.pending = range(len(dft_runs))
+        self.running = {}
+        self.returncodes = {}
+        self.failed = None
+        self.seconds = {}
+        self.processes = []
+        self._created = time.time()
+        self._started = {}
+        self._retry_time = 0.
+
+    def start_next(self):
+        """ start queued runs while there are free slots """
+        if self._retry_time and time.time() >= self._retry_time:
+            # a run found no idle tile: count them again
+            self._retry_time = 0.
+            self.max_running = len(self.running) + max_concurrent_runs(len(self.pending))
+        while (self.pending and len(self.running) < self.max_running
+               and time.time() >= self._retry_time):
+            if not self._start(self.pending.pop(0)):
+                break
+
+    def _start(self, index):
+        """ starts run index, returns False if there was no idle tile for it """
+        run_dir = self.run_dirs[index]
+        if self.launch_engine == 'direct':
+            try:
+                p = SocorroLaunch(run_dir, self.scf_watchdog)
+            except di.ResourceError:
+                self._requeue(index)
+                return False
+        else:
+            p = procgroup.start_process_group(_run_socorro_worker,
+                                              args=(run_dir, self.scf_watchdog))
+        eval_trace.record('socorro.queue', time.time() - self._created,
+                          run=os.path.basename(run_dir))
+        self.running[p] = index
+        self._started[index] = time.time()
+        self.processes.append(p)
+        return True
+
+    def _requeue(self, index):
+        """ put run index back in front of the queue after finding no idle tile """
+        print 'No idle tile for', self.run_dirs[index] + ', requeued'
+        self.pending.insert(0, index)
+        self._retry_time = time.time() + TILE_RETRY_SECONDS
+
+    def poll(self, check=None):
+        """
+        collect runs that exited and start queued ones in their place.
+        The first run found to have failed, a nonzero exit code or
+        check(index) False, is recorded in failed and terminates the rest.
+
+        returns index of the failed run, None if none failed
+        """
+        for p in [p for p in self.running if not p.is_alive()]:
+            p.join()
+            index = self.running.pop(p)
+            self.returncodes[index] = p.exitcode
+            self.seconds[index] = time.time() - self._started[index]
+            if p.exitcode == TILES_BUSY_EXIT:
+                self._requeue(index)
+            elif p.exitcode != 0 or (check is not None and not check(index)):
+                self.failed = index
+                self.terminate()
+                return index
+        self.start_next()
+        return None
+
+    def is_done(self):
+        return not self.pending and not self.running
+
+    def wait(self, poll_interval=0.1, check=None):
+        """
+        wait for every run to exit. The first failed run (see poll)
+        terminates the rest.
+
+        returns None if all runs succeeded, otherwise the failed run's index
+        """
+        while not self.is_done():
+            self.poll(check)
+            if not self.is_done():
+                time.sleep(poll_interval)
+        return self.failed
+
+    def terminate(self):
+        """ drop the queued runs and terminate the running ones """
+        self.pending = []
+        for p in self.running:
+            procgroup.terminate_process_group(p)
+        self.running.clear()
+
+
+def wait_position_sweep(sweep, others=(), poll_interval=0.1):
+    """
+    wait for the runs of a PositionSweep started by start_position_sweep
+    to finish, starting queued runs as tiles free up. The sweeps in others
+    are polled too (see poll_all), without waiting for them.
+
+    Each run is checked as soon as its process exits: a nonzero exit code
+    or a diaryf without energy and forces terminates the runs still going
+    (releasing their tiles) and raises SocorroFail right away.
+    """
+    all_sweeps = [sweep] + [other for other in others if other is not sweep]
+    while not sweep.is_done():
+        poll_all(all_sweeps)
+        if not sweep.is_done():
+            time.sleep(poll_interval)
+    if sweep.failed is not None:
+        print 'socorro failed in', sweep.dft_runs[sweep.failed].run_dir, \
+            'with exit code', sweep.returncodes[sweep.failed]
+        raise SocorroFail
+
+
+def poll_all(sweeps):
+    """
+    poll every PositionSweep in sweeps once: runs that exited release
+    their tiles and are checked as in wait_position_sweep, and queued runs
+    start. A sweep with a failed run is terminated, for
+    wait_position_sweep to raise SocorroFail when it gets to it.
+    """
+    for sweep in sweeps:
+        if not sweep.is_done():
+            sweep.poll(check=lambda index, sweep=sweep: is_run_complete(sweep.dft_runs[index]))
+
+
+def is_run_complete(dft_run):
+    """ True if the dft run's diaryf has an energy and forces """
+    dft_run.parse_diaryf()
+    return dft_run.diaryf_record is not None
+
+
+def _run_socorro_worker(run_dir, scf_watchdog=None):
+    """
+    runs socorro in run_dir on a tile, recording tile wait and mpirun time
+    to the trace, and exits with mpirun's returncode
+    """
+    run_name = os.path.basename(run_dir)
+    timings = {}
+    kwargs = {}
+    if scf_watchdog is not None:
+        kwargs['monitor'] = scf_watchdog.monitor(os.path.join(run_dir, 'diaryf'), run_name)
+    with open(os.path.join(run_dir, 'socorro.out'), 'w') as logfile:
+        try:
+            returncode = di.tile_run_dynamic(commands=SOCORRO_COMMANDS, dedicated_master=0,
+                                             stdout=logfile, stderr=logfile, cwd=run_dir,
+                                             timings=timings, **kwargs)
+        except di.ResourceError:
+            # another sweep took the last tile since it was counted
+            sys.exit(TILES_BUSY_EXIT)
+    eval_trace.record_timings('socorro', timings, run=run_name)
+    # the exit code tells wait_position_sweep whether socorro failed
+    sys.exit(returncode)
+
+
+class SocorroLaunch(object):
+    """
+    socorro run in run_dir started by the driver process itself, with
+    parallel.tile_start_dynamic, instead of by a forked python worker. It
+    has the is_alive/join/exitcode/pid of the multiprocessing.Process of a
+    forked worker, so PositionSweep and procgroup.terminate_process_group
+    handle both alike. mpirun leads its own process group.
+
+    Nothing blocks: each is_alive() polls mpirun and, with an scf_watchdog,
+    reads the SCF steps added to diaryf since the last call, terminating
+    mpirun if the SCF is diverging or stagnating.
+
+    raises parallel.ResourceError if there is no idle tile
+    """
+    def __init__(self, run_dir, scf_watchdog=None):
+        self.run_name = os.path.basename(run_dir)
+        self._logfile = open(os.path.join(run_dir, 'socorro.out'), 'w')
+        try:
+            self._tile_run = di.tile_start_dynamic(commands=SOCORRO_COMMANDS, dedicated_master=0,
+                                                   stdout=self._logfile, stderr=self._logfile,
+                                                   cwd=run_dir, preexec_fn=os.setpgrp)
+        except:
+            self._logfile.close()
+            raise
+        self.pid = self._tile_run.process.pid
+        self.exitcode = None
+        self._start = time.time()
+        self._follower = None
+        if scf_watchdog is not None:
+            self._follower = scf_watchdog.follow(os.path.join(run_dir, 'diaryf'), self.run_name)
+
+    def is_alive(self):
+        if self.exitcode is not None:
+            return False
+        if self._follower is not None and self._follower.kill_reason is None:
+            if self._follower.check() is not None:
+                print 'Killing socorro in', self.run_name + ':', self._follower.kill_reason
+                self._tile_run.process.terminate()
+        returncode = self._tile_run.poll()
+        if returncode is None:
+            return True
+        self._finish(returncode)
+        return False
+
+    def join(self):
+        if self.exitcode is None:
+            self._finish(self._tile_run.wait())
+
+    def _finish(self, returncode):
+        self.exitcode = returncode
+        self._logfile.close()
+        if self._follower is not None:
+            self._follower.finish()
+        eval_trace.record_timings('socorro', {'mpirun': time.time() - self._start},
+                                  run=self.run_name)
+
+
+def start_gcut_sweep(gcut, dft_runs, run_numbers=None, scf_watchdog=None, workspace=None,
+                     launch_engine='fork'):
+    """
+    make gcut_dir.{gcut} in the workspace (by default, the current
+    directory), if it isn't there already, and start a position sweep of
+    dft_runs in it
+
+    returns (gcut dir path, dft_runs, started PositionSweep)
+    """
+    if workspace is None:
+        workspace = workspace_layout.Workspace()
+    gcut_dir = workspace.gcut_dir(gcut)
+    if not os.path.isdir(gcut_dir):
+        os.mkdir(gcut_dir)
+    sweep = start_position_sweep(dft_runs, run_numbers, scf_watchdog, gcut_dir,
+                                 launch_engine)
+    return gcut_dir, dft_runs, sweep
+
+
+def cancel_gcut_sweeps(sweeps):
+    """
+    terminate the socorro runs of every sweep in sweeps (dict of
+    started gcut sweeps, emptied here) and remove their run directories,
+    and their gcut directories if nothing else is left there
+    """
+    for gcut_dir, dft_runs, sweep in sweeps.values():
+        sweep.terminate()
+        for run in dft_runs:
+            if run.run_dir is not None:
+                shutil.rmtree(run.run_dir, ignore_errors=True)
+        try:
+            os.rmdir(gcut_dir)
+        except OSError:
+            pass  # runs of another sweep are there
+    sweeps.clear()
+
+
+def idle_tiles(sweeps):
+    """
+    estimate of the tiles a new sweep could use: the tiles nobody has
+    locked, less the runs of sweeps that are still going (some of which
+    may not have locked their tile yet) or queued. Outside a resource
+    manager allocation there are no tiles to count, so 0 (nothing is
+    started speculatively).
+    """
+    busy = sum(len(sweep.running) + len(sweep.pending)
+               for gcut_dir, dft_runs, sweep in sweeps.values())
+    try:
+        return di.available_tiles(commands=SOCORRO_COMMANDS, dedicated_master=0) - busy
+    except di.MgrEnvError:
+        return 0
 
 # def call_socorro():
 #     with open('socorro.log', 'w') as fout:
@@ -335,14 +1125,24 @@ def is_converged(energies_so_far, tol):
     return np.isclose(energies_latest, energies_previous, atol=tol, rtol=0).all()
 
 
-def get_random_configurations(filename):
+@file_cache.memoize_file
+def get_random_configurations(filename, binary_cache=False):
     """ 
     Read random atomic configurations from file.
 
     Configurations should be formatted one random configuration per 
     line, where each group of three coordinates is one atom. 
+
+    binary_cache: if True, read the file's memory-mapped binary copy,
+        see refdata.load
     """
-    return np.genfromtxt(filename, comments='#') 
+    if binary_cache:
+        return refdata.load(filename, _parse_configurations)
+    return _parse_configurations(filename)
+
+
+def _parse_configurations(filename):
+    return np.genfromtxt(filename, comments='#')
 
 
 
@@ -356,44 +1156,33 @@ def get_dft_results_at_gcut(position_dft_runs):
     Raises SocorroFail exception if any of the socorro 
     output files did not contain energy or forces, indicating
     socorro did not complete at that position.
+
+    diaryf files not already parsed by wait_position_sweep are parsed
+    here.
     """
-    # get energy and force results from each socorro run
-    energy_list = []
-    forces_list = []
-    for dft_run in position_dft_runs:
-        # if a run did not finish, dft_run.read_*() will return None
-        diaryf_path = os.path.join(dft_run.run_dir, 'diaryf')
-        energy_list.append( dft_run.read_energy(diaryf=diaryf_path) )
-        forces_list.append( dft_run.read_forces(diaryf=diaryf_path) )
-
-    # check for Nones in energies and forces
-    if None in energy_list or True in [x is None for x in forces_list]:
+    for run in position_dft_runs:
+        if run.diaryf_record is None:
+            run.parse_diaryf()
+
+    # if a run did not finish, it has no diaryf_record
+    if any(run.diaryf_record is None for run in position_dft_runs):
         raise SocorroFail
 
+    energy_list = [run.diaryf_record['energy'] for run in position_dft_runs]
+    forces_list = [run.diaryf_record['forces'] for run in position_dft_runs]
+
     return {'energies': energy_list, 'forces': forces_list}
 
 
 
-def calc_work_objective(position_dft_runs, calc_nflops_dir=None):
+def calc_work_objective(position_dft_runs):
     """ 
-    I'm using an old bash script from Alan T. and Rachael H. so I'm just
-    going to subprocess it.
-        
     the work objective is equal to the sum of the estimated number of floating 
-    point operations for all socorro runs (there is one socorro run per atomic 
-    configuration).
+    point operations (in Gflops) for all socorro runs (there is one socorro run
+    per atomic configuration). Uses flop_model, the model of the old
+    calc_nflops bash script from Alan T. and Rachael H.
     """
-    start_dir = os.getcwd()
-    if calc_nflops_dir is None:
-        calc_nflops_dir = os.getcwd()
-    calc_nflops = os.path.join(calc_nflops_dir, 'calc_nflops')
-
-    work_objective = 0.
-    for run in position_dft_runs:
-        os.chdir(run.run_dir)
-        nflops_data = subprocess.check_output([calc_nflops])
-        work_objective += float(nflops_data.split()[-1])
-    os.chdir(start_dir)
-    return work_objective 
+    records = [run.parse_diaryf() for run in position_dft_runs]
+    return float(flop_model.gflops(records).sum())
 
 
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+long-lived evaluation server for analysis_driver.py
+
+Starting a new python for every dakota evaluation means importing numpy,
+eval_pp and dakota_interfacing_2 and parsing opal.in, configurations.in and
+allelectron_forces.dat every time. This server does that once, then forks a
+child for each evaluation request it gets on a unix socket, so every
+evaluation starts warm. Evaluations still run one process each, because
+they change directory and redirect stdout.
+
+usage, on each node dakota runs analysis drivers on:
+
+    python eval_server.py socket_path [campaign_dir]
+
+and export OPAL_EVAL_SOCKET=socket_path for dakota. analysis_driver.py then
+forwards its evaluation to the server (see eval_client.py). campaign_dir is
+the directory holding opal.in, configurations.in and allelectron_forces.dat,
+which are read ahead of time if given.
+"""
+import errno
+import json
+import os
+import SocketServer
+import sys
+import traceback
+import analysis_driver
+import calc_accuracy
+import eval_pp
+
+
+class EvaluationHandler(SocketServer.StreamRequestHandler):
+    """ runs one evaluation request in the forked child """
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        stdout = sys.stdout
+        try:
+            os.chdir(request['cwd'])
+            analysis_driver.main(*request['argv'])
+            reply = {'status': 0}
+        except Exception:
+            reply = {'status': 1, 'message': traceback.format_exc()}
+        finally:
+            sys.stdout = stdout  # main redirects stdout to its log
+        self.wfile.write(json.dumps(reply) + '\n')
+
+
+class EvaluationServer(SocketServer.ForkingMixIn, SocketServer.UnixStreamServer):
+    """ forks a child per evaluation request """
+    max_children = 1024
+
+
+def warm_up(campaign_dir):
+    """ read the files every evaluation in campaign_dir will need """
+    settings = {}
+    opal_in = os.path.join(campaign_dir, 'opal.in')
+    if os.path.isfile(opal_in):
+        settings = analysis_driver.read_inputs(opal_in)
+    # same arguments as the evaluations' calls, so they hit the memoized copies
+    binary_cache = settings.get('refdata_cache') == 'yes'
+    loaders = [(eval_pp.get_random_configurations, 'configurations.in'),
+               (calc_accuracy.read_allelectron_forces, 'allelectron_forces.dat')]
+    for loader, filename in loaders:
+        path = os.path.join(campaign_dir, filename)
+        if os.path.isfile(path):
+            loader(path, binary_cache=binary_cache)
+
+
+def serve(socket_path, campaign_dir=None):
+    """ serve evaluation requests on socket_path until killed """
+    if campaign_dir is not None:
+        warm_up(campaign_dir)
+    try:
+        os.remove(socket_path)  # left behind by a previous server
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    server = EvaluationServer(socket_path, EvaluationHandler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+if __name__ == '__main__':
+    serve(*sys.argv[1:3])
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+per-phase timing trace of evaluations
+
+analysis_driver.main calls start() at the beginning of an evaluation and
+finish() at the end. In between, span() and record() append one JSON line
+per timed phase to a spool file in the evaluation directory. Appending to a
+file (instead of keeping spans in memory) means phases timed in forked
+children, such as the atompaw and socorro launches, end up in the trace too.
+finish() folds the spool into a single JSON line for the evaluation and
+appends it to the campaign's trace file.
+
+When no trace has been started, span() and record() do nothing.
+
+To summarize a campaign:
+
+    python eval_trace.py trace_file [trace_file ...]
+
+prints count, mean, p50, p90, p99 and total seconds of every phase, and
+the same statistics of the number of gcut sweeps, socorro runs and
+self-consistent steps saved by restarts per evaluation.
+"""
+import contextlib
+import json
+import os
+import sys
+import time
+import numpy as np
+
+# spool file of the running evaluation, None if not tracing.
+# module level so forked children inherit it.
+_spool_path = None
+_start_time = None
+
+# evaluation attributes summarize() reports along with the phases
+SUMMARIZED_ATTRS = ['num_sweeps', 'num_runs', 'scf_steps_saved']
+
+
+def start(spool_path):
+    """ start tracing an evaluation, collecting spans in spool_path """
+    global _spool_path, _start_time
+    _spool_path = os.path.abspath(spool_path)
+    _start_time = time.time()
+    open(_spool_path, 'w').close()
+
+
+def record(name, seconds, **attrs):
+    """ add a phase that took seconds to the trace """
+    if _spool_path is None:
+        return
+    span_record = {'name': name, 'seconds': seconds, 'pid': os.getpid()}
+    span_record.update(attrs)
+    with open(_spool_path, 'a') as fout:
+        fout.write(json.dumps(span_record) + '\n')
+
+
+def record_timings(name, timings, **attrs):
+    """ add the tile_wait and mpirun timings from tile_run_dynamic """
+    for phase in ['tile_wait', 'mpirun']:
+        if phase in timings:
+            record(name + '.' + phase, timings[phase], **attrs)
+
+
+def annotate(**attrs):
+    """ add attrs, such as the number of gcuts run, to the evaluation's trace line """
+    if _spool_path is None:
+        return
+    with open(_spool_path, 'a') as fout:
+        fout.write(json.dumps({'attrs': attrs}) + '\n')
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """ context manager adding the time spent in its block to the trace """
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        record(name, time.time() - start_time, **attrs)
+
+
+def finish(trace_file, **attrs):
+    """
+    append one JSON line for the evaluation, with its spans, total
+    seconds and attrs, to trace_file. Then stop tracing.
+    """
+    global _spool_path, _start_time
+    if _spool_path is None:
+        return
+    evaluation = {'eval_dir': os.path.dirname(_spool_path), 'start': _start_time,
+                  'seconds': time.time() - _start_time, 'spans': []}
+    with open(_spool_path) as fin:
+        for line in fin:
+            if not line.strip():
+                continue
+            spool_record = json.loads(line)
+            if 'attrs' in spool_record:
+                evaluation.update(spool_record['attrs'])
+            else:
+                evaluation['spans'].append(spool_record)
+    evaluation.update(attrs)
+    with open(trace_file, 'a') as fout:
+        fout.write(json.dumps(evaluation) + '\n')
+    os.remove(_spool_path)
+    _spool_path = None
+    _start_time = None
+
+
+def summarize(trace_files):
+    """
+    returns dict of phase name: dict of count, mean, p50, p90, p99 and
+    total seconds, over all evaluations in trace_files. Spans with the same
+    name in one evaluation are counted separately. The whole evaluation is
+    reported as 'evaluation'. Numeric attributes listed in SUMMARIZED_ATTRS
+    are summarized the same way, under their own name.
+    """
+    seconds = {}
+    for trace_file in trace_files:
+        with open(trace_file) as fin:
+            for line in fin:
+                if not line.strip():
+                    continue
+                evaluation = json.loads(line)
+                seconds.setdefault('evaluation', []).append(evaluation['seconds'])
+                for attr in SUMMARIZED_ATTRS:
+                    if attr in evaluation:
+                        seconds.setdefault(attr, []).append(evaluation[attr])
+                for s in evaluation['spans']:
+                    seconds.setdefault(s['name'], []).append(s['seconds'])
+    summary = {}
+    for name, values in seconds.items():
+        values = np.array(values)
+        summary[name] = {'count': len(values), 'mean': values.mean(),
+                         'p50': np.percentile(values, 50), 'p90': np.percentile(values, 90),
+                         'p99': np.percentile(values, 99), 'total': values.sum()}
+    return summary
+
+
+def print_summary(summary):
+    """ prints the table of a summarize summary, the phase with the most total seconds first """
+    columns = ['count', 'mean', 'p50', 'p90', 'p99', 'total']
+    print '%-32s' % 'phase' + ''.join('%12s' % c for c in columns)
+    for name in sorted(summary, key=lambda n: -summary[n]['total']):
+        row = summary[name]
+        print '%-32s' % name + '%12d' % row['count'] + \
+            ''.join('%12.3f' % row[c] for c in columns[1:])
+
+
+if __name__ == '__main__':
+    print_summary(summarize(sys.argv[1:]))
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""
+persistent record of parameter points where an evaluation failed
+
+Each line of the ledger file is one failure, a JSON object with its kind
+and parameter vector, e.g.
+
+    {"kind": "atompaw", "vector": [1.9, 2.1, "Si"]}
+
+The ledger is shared by
+every analysis driver in a campaign, so appends are done under an flock.
+Lookups load the ledger into one numpy array per kind (and per value of
+the string valued variables, which only match exactly) and find the
+nearest recorded failure with a vectorized distance calculation. Each
+numeric variable can be given a scale (e.g. the width of its bounds), so
+the radius means the same for variables of different magnitudes.
+
+Every lookup also appends a line to {ledger}.stats recording whether it hit
+and the distance to the nearest failure of each kind, so the radius can be
+tuned afterwards:
+
+    python failure_ledger.py ledger_file [radius ...]
+
+prints hit/miss counts and how many lookups would have hit at each radius.
+"""
+import fcntl
+import json
+import sys
+import numpy as np
+
+
+# objective values analysis_driver returns for each kind of failure.
+# lookup breaks ties between kinds in this order.
+FAILURE_KINDS = ['atompaw', 'socorro', 'cutoff']
+PENALTIES = {'atompaw': 100, 'socorro': 102, 'cutoff': 95}
+
+
+def parameter_vector(params):
+    """
+    returns list of the values of a Parameters object: floats, and
+    strings for string valued variables
+    """
+    return [params[d] if isinstance(params[d], basestring) else float(params[d])
+            for d in params.descriptors]
+
+
+def _split(vector):
+    """ returns (float array of the numbers in vector, tuple of its strings) """
+    numbers = [x for x in vector if not isinstance(x, basestring)]
+    return np.array(numbers, dtype=float), tuple(x for x in vector if isinstance(x, basestring))
+
+
+class FailureLedger(object):
+    """
+    nearest neighbour lookup of known failures
+
+    path: ledger file, created on first record
+    radius: a parameter vector within this euclidean distance of a
+        recorded failure is assumed to fail the same way. String valued
+        variables have to be equal.
+    scales: optional scale of each numeric variable: distances are
+        measured in differences over scale
+    """
+    def __init__(self, path, radius, scales=None):
+        self.path = path
+        self.stats_path = path + '.stats'
+        self.radius = float(radius)
+        self.scales = None if scales is None else np.array(scales, dtype=float)
+
+    def record(self, kind, vector):
+        """ add a failure of given kind at vector (as from parameter_vector) to the ledger """
+        assert kind in PENALTIES, "Unknown failure kind " + kind
+        vector = [x if isinstance(x, basestring) else float(x) for x in vector]
+        _locked_append(self.path, json.dumps({'kind': kind, 'vector': vector}) + '\n')
+
+    def load(self):
+        """
+        returns dict of kind: dict of the string values: MxN array of
+        the numeric values of failed parameter vectors
+        """
+        rows = dict((kind, {}) for kind in FAILURE_KINDS)
+        try:
+            with open(self.path) as fin:
+                for line in fin:
+                    if not line.strip():
+                        continue
+                    failure = json.loads(line)
+                    if failure['kind'] in rows:
+                        numbers, strings = _split(failure['vector'])
+                        rows[failure['kind']].setdefault(strings, []).append(numbers)
+        except IOError:
+            pass  # nothing recorded yet
+        return dict((kind, dict((strings, np.array(r)) for strings, r in by_strings.items()))
+                    for kind, by_strings in rows.items())
+
+    def nearest(self, failures, vector):
+        """
+        returns scaled distance from the numeric vector to the nearest row
+        of failures, or inf if there are none with the same dimension
+        """
+        if failures.ndim != 2 or failures.shape[1] != len(vector):
+            return np.inf
+        differences = failures - vector
+        if self.scales is not None:
+            assert len(self.scales) == len(vector), \
+                "need a scale for each of the %d numeric variables" % len(vector)
+            differences = differences / self.scales
+        return np.sqrt(np.min(np.sum(differences**2, axis=1)))
+
+    def lookup(self, vector):
+        """
+        returns kind of the nearest recorded failure within radius of
+        vector (as from parameter_vector), None if there is none
+        """
+        numbers, strings = _split(vector)
+        failures = self.load()
+        distances = [self.nearest(failures[kind][strings], numbers)
+                     if strings in failures[kind] else np.inf
+                     for kind in FAILURE_KINDS]
+        hit = None
+        nearest = int(np.argmin(distances))
+        if distances[nearest] <= self.radius:
+            hit = FAILURE_KINDS[nearest]
+        _locked_append(self.stats_path, '%s %s\n' % (hit or 'miss',
+                                                     ' '.join(map(repr, distances))))
+        return hit
+
+    def stats(self, radii=()):
+        """
+        returns dict of lookup statistics:
+            lookups: number of lookups
+            hits: dict of kind: number of lookups that hit that kind
+            misses: number of lookups that missed
+            would_hit: dict of radius: number of lookups that would have
+                hit at that radius, for each radius in radii
+        """
+        hits = dict((kind, 0) for kind in FAILURE_KINDS)
+        misses = 0
+        nearest = []
+        try:
+            with open(self.stats_path) as fin:
+                for line in fin:
+                    fields = line.split()
+                    if fields[0] == 'miss':
+                        misses += 1
+                    else:
+                        hits[fields[0]] += 1
+                    nearest.append(min(map(float, fields[1:])))
+        except IOError:
+            pass
+        nearest = np.array(nearest)
+        would_hit = dict((r, int(np.sum(nearest <= r))) for r in radii)
+        return {'lookups': len(nearest), 'hits': hits, 'misses': misses,
+                'would_hit': would_hit}
+
+
+
+def _locked_append(path, text):
+    with open(path, 'a') as fout:
+        fcntl.flock(fout, fcntl.LOCK_EX)
+        try:
+            fout.write(text)
+            fout.flush()
+        finally:
+            fcntl.flock(fout, fcntl.LOCK_UN)
+
+
+
+if __name__ == '__main__':
+    ledger = FailureLedger(sys.argv[1], radius=0.)
+    stats = ledger.stats(radii=map(float, sys.argv[2:]))
+    print 'lookups:', stats['lookups']
+    print 'misses: ', stats['misses']
+    for kind in FAILURE_KINDS:
+        print 'hits (%s):' % kind, stats['hits'][kind]
+    for r in sorted(stats['would_hit']):
+        print 'would hit at radius %g:' % r, stats['would_hit'][r]
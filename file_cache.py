@@ -0,0 +1,48 @@
+"""
+memoization of functions that parse an input file
+
+A long-lived process (see eval_server.py) evaluates many parameter sets
+against the same opal.in, configurations.in and allelectron_forces.dat.
+Functions decorated with memoize_file only re-read their file when its
+path, mtime or size changes.
+"""
+import copy
+import functools
+import os
+import numpy as np
+
+
+def memoize_file(loader):
+    """
+    decorator caching loader(filename, ...) by the file's absolute path,
+    mtime and size. The filename can be passed positionally or as the
+    filename keyword. Cached numpy arrays are returned as read-only views,
+    anything else as a deep copy, so callers can't alter the cache.
+    """
+    cache = {}
+
+    @functools.wraps(loader)
+    def wrapper(*args, **kwargs):
+        if args:
+            filename, other_args = args[0], args[1:]
+        elif 'filename' in kwargs:
+            filename, other_args = kwargs['filename'], ()
+        else:
+            return loader(*args, **kwargs)  # default filename, don't cache
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        key = (path, other_args,
+               tuple(sorted(kw for kw in kwargs.items() if kw[0] != 'filename')))
+        cached = cache.get(key)
+        if cached is None or cached[0] != (st.st_mtime, st.st_size):
+            cached = ((st.st_mtime, st.st_size), loader(*args, **kwargs))
+            cache[key] = cached
+        value = cached[1]
+        if isinstance(value, np.ndarray):
+            value = value.view()
+            value.flags.writeable = False
+            return value
+        return copy.deepcopy(value)
+
+    wrapper.cache = cache
+    return wrapper
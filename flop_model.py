@@ -0,0 +1,55 @@
+"""
+estimated floating point operations of socorro runs, for the work objective
+
+This is the model of the calc_nflops script (from Alan T. and Rachael H.),
+evaluated on numpy arrays so all runs of an evaluation are done at once.
+See calc_nflops for the derivation. In short, one SCF iteration costs
+
+    10*nb^2*ng + nb^3 + ng + (nb+1)*nd*log2(nd) + nb*(3*ng + 4*np*ng + 2*ng*log2(ng))
+
+where
+    nb: number of bands
+    ng: wave function plane wave cutoff (stands in for the FFT grid size)
+    nd: density plane wave cutoff (ditto)
+    np: number of projectors
+    niter: number of SCF iterations
+    nkpnts: number of special k-points
+
+calc_nflops ignores k-points and uses np = 1. Those are the defaults here,
+so gflops() returns the same numbers as the script. Pass kpoints=True to
+scale the band work by the number of k-points, and num_projectors to count
+the projectors.
+"""
+import numpy as np
+
+
+def flops_per_iteration(nb, ng, nd, num_projectors=1, nkpnts=1, kpoints=False):
+    """
+    flops of one SCF iteration, elementwise on arrays (or scalars)
+
+    num_projectors: number of projectors (np above)
+    kpoints: if True, band work (everything but forming the density's
+        FFT and the potential) is done at each of nkpnts k-points
+    """
+    nb = np.asarray(nb, dtype=float)
+    ng = np.asarray(ng, dtype=float)
+    nd = np.asarray(nd, dtype=float)
+    band_work = 10.*nb**2*ng + nb**3 + nb*(3.*ng + 4.*num_projectors*ng + 2.*ng*np.log2(ng))
+    if kpoints:
+        band_work = band_work*np.asarray(nkpnts, dtype=float)
+    return band_work + ng + (nb+1.)*nd*np.log2(nd)
+
+
+def gflops(records, num_projectors=1, kpoints=False):
+    """
+    returns numpy array of the estimated Gflops of each run
+
+    records: diaryf.read_diaryf records of the runs
+    num_projectors, kpoints: see flops_per_iteration
+    """
+    columns = dict((field, np.array([r[field] for r in records], dtype=float))
+                   for field in ['nb', 'nkpnts', 'ng', 'nd', 'niter'])
+    flopsiter = flops_per_iteration(columns['nb'], columns['ng'], columns['nd'],
+                                    num_projectors=num_projectors,
+                                    nkpnts=columns['nkpnts'], kpoints=kpoints)
+    return columns['niter']*flopsiter/1.e9
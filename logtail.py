@@ -0,0 +1,33 @@
+"""
+incremental reader for output files that are still being written
+"""
+import errno
+
+
+class LogTail(object):
+    """
+    follows a text file as another process appends to it
+
+    read_lines returns the complete lines added since the last call. A
+    trailing partial line is held back until its newline arrives. The file
+    does not need to exist yet.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._offset = 0
+        self._partial = ''
+
+    def read_lines(self):
+        """ returns list of new complete lines, without newlines """
+        try:
+            with open(self.path) as fin:
+                fin.seek(self._offset)
+                text = fin.read()
+                self._offset = fin.tell()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise
+        lines = (self._partial + text).split('\n')
+        self._partial = lines.pop()
+        return lines
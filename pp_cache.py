@@ -0,0 +1,160 @@
+"""
+persistent on-disk cache of atompaw pseudopotentials
+
+Entries are keyed by a hash of the rendered atompaw input file ({elem}.in),
+so different parameter values that dprepro renders to the same input text
+share one entry. Layout of the cache directory:
+
+    cache_dir/entries/{key}/{elem}.SOCORRO.atomicdata
+    cache_dir/tmp/          (staging area for new and evicted entries)
+    cache_dir/lock          (flock'd while evicting)
+
+Many analysis drivers can use the same cache at once. New entries are
+staged in tmp/ and renamed into entries/ in one step, evicted entries are
+renamed out of entries/ before they are deleted, and hits are hard linked
+into the run directory, so a reader never sees a half written entry and an
+eviction never pulls a file out from under a running socorro job.
+
+Entry directory mtimes are bumped on every hit and used for LRU eviction.
+"""
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+class PseudopotentialCache(object):
+    """
+    content-addressed, size-bounded cache of pseudopotential files
+
+    cache_dir: directory holding the cache, created if needed
+    max_bytes: evict least recently used entries once the cache grows
+        beyond this size. None means the cache is never trimmed.
+    """
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self._entries_dir = os.path.join(self.cache_dir, 'entries')
+        self._tmp_dir = os.path.join(self.cache_dir, 'tmp')
+        self._lock_path = os.path.join(self.cache_dir, 'lock')
+        for d in [self.cache_dir, self._entries_dir, self._tmp_dir]:
+            _mkdir_p(d)
+
+    @staticmethod
+    def key(elem, atompaw_input_filename):
+        """ returns cache key for a rendered atompaw input file """
+        sha = hashlib.sha256()
+        sha.update(elem.encode('utf-8') + b'\0')
+        with open(atompaw_input_filename, 'rb') as fin:
+            sha.update(fin.read())
+        return sha.hexdigest()
+
+    def _entry_file(self, key, elem):
+        return os.path.join(self._entries_dir, key, elem+'.SOCORRO.atomicdata')
+
+    def fetch(self, key, elem, dest):
+        """
+        link cached pseudopotential for key to dest
+
+        returns True on a hit, False on a miss. dest must not exist.
+        """
+        entry_file = self._entry_file(key, elem)
+        try:
+            _link_or_copy(entry_file, dest)
+        except (OSError, IOError) as e:
+            if e.errno == errno.ENOENT:
+                return False  # never cached, or evicted by another driver
+            raise
+        try:
+            os.utime(os.path.dirname(entry_file), None)  # mark recently used
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        return True
+
+    def store(self, key, elem, pseudopotential_path):
+        """
+        add pseudopotential_path to the cache under key, then trim the
+        cache to max_bytes. Does nothing if key is already cached.
+        """
+        entry_dir = os.path.join(self._entries_dir, key)
+        if os.path.isdir(entry_dir):
+            return
+        staging_dir = tempfile.mkdtemp(dir=self._tmp_dir)
+        shutil.copy(pseudopotential_path,
+                    os.path.join(staging_dir, elem+'.SOCORRO.atomicdata'))
+        try:
+            os.rename(staging_dir, entry_dir)
+        except OSError as e:
+            # another driver stored the same key first
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+        self.evict()
+
+    def size(self):
+        """ returns total size in bytes of all cached entries """
+        return sum(size for _, size, _ in self._list_entries())
+
+    def evict(self):
+        """ remove least recently used entries until size <= max_bytes """
+        if self.max_bytes is None:
+            return
+        with open(self._lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                entries = sorted(self._list_entries(), key=lambda e: e[2])
+                total = sum(size for _, size, _ in entries)
+                for entry_dir, size, _ in entries:
+                    if total <= self.max_bytes:
+                        break
+                    self._remove_entry(entry_dir)
+                    total -= size
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _list_entries(self):
+        """ returns list of (entry_dir, size in bytes, last use time) """
+        entries = []
+        for name in os.listdir(self._entries_dir):
+            entry_dir = os.path.join(self._entries_dir, name)
+            try:
+                last_use = os.stat(entry_dir).st_mtime
+                size = sum(os.stat(os.path.join(entry_dir, f)).st_size
+                           for f in os.listdir(entry_dir))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue  # evicted while listing
+            entries.append((entry_dir, size, last_use))
+        return entries
+
+    def _remove_entry(self, entry_dir):
+        trash_dir = tempfile.mkdtemp(dir=self._tmp_dir)
+        try:
+            os.rename(entry_dir, os.path.join(trash_dir, 'entry'))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        shutil.rmtree(trash_dir, ignore_errors=True)
+
+
+
+def _mkdir_p(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _link_or_copy(src, dest):
+    """ hard link src to dest, copying instead across filesystems """
+    try:
+        os.link(src, dest)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy(src, dest)
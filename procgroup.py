@@ -0,0 +1,92 @@
+"""
+helpers for running work in child processes that can be cancelled as a unit
+
+Each child started with start_process_group becomes the leader of its own
+process group, so terminate_process_group also reaches anything the child
+launched (mpirun and the ranks under it). SIGTERM is turned into SystemExit
+in the child, so context managers such as the tile lock in
+dakota_interfacing_2.interfacing.parallel still release their resources.
+"""
+import errno
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+
+def _raise_system_exit(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def _group_leader(target, args, kwargs):
+    """ runs in the child: become a process group leader, then run target """
+    try:
+        os.setpgid(0, 0)
+    except OSError:
+        pass  # parent already did it
+    signal.signal(signal.SIGTERM, _raise_system_exit)
+    try:
+        target(*args, **kwargs)
+    finally:
+        # once target is done, a SystemExit from a late SIGTERM would be
+        # raised after multiprocessing stops catching it, and unwind into
+        # the copy of the parent's stack the child was forked with
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def start_process_group(target, args=(), kwargs=None):
+    """
+    start target(*args, **kwargs) in a new multiprocessing.Process that
+    leads its own process group. returns the started Process.
+    """
+    if kwargs is None:
+        kwargs = {}
+    sys.stdout.flush()  # don't let the child inherit and re-flush our buffer
+    p = multiprocessing.Process(target=_group_leader, args=(target, args, kwargs))
+    p.start()
+    try:
+        # also set the group from the parent so terminate_process_group
+        # can't race the child's own setpgid call
+        os.setpgid(p.pid, p.pid)
+    except OSError:
+        pass
+    return p
+
+
+def terminate_process_group(process):
+    """ send SIGTERM to process's group and wait for process to exit """
+    if process.is_alive():
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+    process.join()
+
+
+def wait_all(processes, poll_interval=0.1, check=None):
+    """
+    wait for every process to exit
+
+    If any process exits with a nonzero exit code, or check(process)
+    returns False for it, the remaining processes are terminated with
+    terminate_process_group.
+
+    returns None if all processes succeeded, otherwise the first process
+    found to have failed.
+    """
+    running = list(processes)
+    while running:
+        for p in list(running):
+            if p.is_alive():
+                continue
+            p.join()
+            running.remove(p)
+            if p.exitcode != 0 or (check is not None and not check(p)):
+                for other in running:
+                    terminate_process_group(other)
+                return p
+        if running:
+            time.sleep(poll_interval)
+    return None
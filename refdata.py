@@ -0,0 +1,146 @@
+"""
+memory-mapped binary copies of the reference data text files
+
+Every evaluation reads the campaign's configurations.in and
+allelectron_forces.dat. Instead of each driver parsing the text, load()
+parses it once into {source}.npy next to it and opens that read-only with
+mmap, so the drivers on a node share its pages. {source}.npy.json records
+
+    format: FORMAT_VERSION
+    shape, dtype, num_atoms: of the array (num_atoms is the last dimension
+        over 3, as in the M by 3N arrays of both files)
+    data_size: size of {source}.npy in bytes
+    data_sha1: checksum of the array's data
+    source_mtime, source_size, source_sha1: of the text file parsed
+
+The copy is used while the source's mtime and size match, or its size and
+checksum do (the file was touched, not changed), and the .npy file matches
+the shape, dtype and size in the header. Otherwise it is written again.
+Loading doesn't read the data: data_sha1 is only checked with verify=True.
+Files are written under temporary names and renamed into place, the array
+before its header, so concurrent drivers see either the old or the new
+copy. If the copy can't be written (e.g. a read-only campaign directory),
+the parsed array is returned.
+"""
+import hashlib
+import json
+import os
+import numpy as np
+
+FORMAT_VERSION = 2
+
+
+def load(source_path, parse, verify=False):
+    """
+    returns the array parse(source_path) returns, read-only and memory
+    mapped from the binary copy of source_path, which is written if it
+    is missing or out of date. With verify, the copy's data is checked
+    against its checksum too.
+    """
+    cache_path = source_path + '.npy'
+    header_path = cache_path + '.json'
+    st = os.stat(source_path)
+    header = read_header(header_path)
+    if header is not None and source_matches(header, source_path, st, header_path):
+        data = open_data(cache_path, header, verify)
+        if data is not None:
+            return data
+
+    array = np.asarray(parse(source_path))
+    try:
+        write(cache_path, header_path, array, source_path, st)
+    except (IOError, OSError) as e:
+        print 'Could not write binary copy of', source_path + ':', e
+        return array
+    data = open_data(cache_path, read_header(header_path))
+    return array if data is None else data
+
+
+def read_header(header_path):
+    """ returns the header dict, None if it is missing, unreadable or of another format """
+    try:
+        with open(header_path) as fin:
+            header = json.load(fin)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(header, dict) or header.get('format') != FORMAT_VERSION:
+        return None
+    return header
+
+
+def source_matches(header, source_path, st, header_path):
+    """
+    True if the header was written for the current contents of
+    source_path. A touched but unchanged source gets its new mtime
+    recorded in the header.
+    """
+    if header['source_size'] != st.st_size:
+        return False
+    if header['source_mtime'] == st.st_mtime:
+        return True
+    if header['source_sha1'] != file_sha1(source_path):
+        return False
+    header = dict(header, source_mtime=st.st_mtime)
+    try:
+        _write_json(header_path, header)
+    except (IOError, OSError):
+        pass
+    return True
+
+
+def open_data(cache_path, header, verify=False):
+    """
+    returns read-only memory map of cache_path, None if it doesn't match
+    header (or, with verify, the data doesn't match its checksum)
+    """
+    if header is None:
+        return None
+    try:
+        if os.path.getsize(cache_path) != header['data_size']:
+            return None
+        data = np.load(cache_path, mmap_mode='r')
+    except (OSError, IOError, ValueError):
+        return None
+    if list(data.shape) != header['shape'] or data.dtype.str != header['dtype']:
+        return None
+    if verify and array_sha1(data) != header['data_sha1']:
+        return None
+    return data
+
+
+def write(cache_path, header_path, array, source_path, st):
+    """ writes the binary copy of array parsed from source_path and its header """
+    header = {'format': FORMAT_VERSION,
+              'shape': list(array.shape),
+              'dtype': array.dtype.str,
+              'num_atoms': array.shape[-1] // 3 if array.ndim else 0,
+              'data_sha1': array_sha1(array),
+              'source': os.path.basename(source_path),
+              'source_mtime': st.st_mtime,
+              'source_size': st.st_size,
+              'source_sha1': file_sha1(source_path)}
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    with open(tmp_path, 'wb') as fout:
+        np.save(fout, array)
+    header['data_size'] = os.path.getsize(tmp_path)
+    os.rename(tmp_path, cache_path)
+    _write_json(header_path, header)
+
+
+def _write_json(path, obj):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as fout:
+        json.dump(obj, fout, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def array_sha1(array):
+    return hashlib.sha1(np.ascontiguousarray(array)).hexdigest()
+
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 20), ''):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,104 @@
+"""
+persistent store of finished evaluations
+
+The genetic algorithm often asks for the same parameter vector again (elites,
+duplicate children). ResultStore keeps the objectives of successful
+evaluations only, in an SQLite database keyed by evaluation_key, a hash of
+everything that determines the result: the parameter values, the input
+templates, the reference data files and the settings of the gcut
+convergence search. Failed evaluations get no entry; their penalties are
+left to the failure ledger.
+
+The database can be shared by all analysis drivers in a campaign. It uses
+SQLite's write-ahead log where the filesystem supports it, and every
+connection waits up to timeout seconds for a lock instead of failing.
+"""
+import hashlib
+import json
+import sqlite3
+import time
+
+
+def _file_hash(path):
+    """ sha256 of a file's contents, or 'missing' if it can't be read """
+    sha = hashlib.sha256()
+    try:
+        with open(path, 'rb') as fin:
+            for block in iter(lambda: fin.read(1 << 20), b''):
+                sha.update(block)
+    except IOError:
+        return 'missing'
+    return sha.hexdigest()
+
+
+def _canonical_value(value):
+    """ same numeric value gives the same string however it was written """
+    if isinstance(value, (int, long, float)):
+        return repr(float(value))
+    return str(value)
+
+
+def evaluation_key(params, input_files, settings):
+    """
+    returns hash identifying an evaluation
+
+    params: Parameters object for the evaluation
+    input_files: paths of every file the evaluation reads (templates,
+        configurations, reference forces). Their contents are hashed.
+    settings: dict of other settings the result depends on, such as
+        gcuts and energy_tol
+    """
+    description = {
+        'params': [(d, _canonical_value(params[d])) for d in params.descriptors],
+        'files': [_file_hash(path) for path in input_files],
+        'settings': sorted((k, settings[k]) for k in settings),
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True)).hexdigest()
+
+
+class ResultStore(object):
+    """
+    SQLite table of evaluation key: objectives
+
+    path: database file, created if needed
+    timeout: seconds to wait for another process's lock
+    """
+    def __init__(self, path, timeout=60.):
+        self.path = path
+        self.timeout = timeout
+        conn = self._connect()
+        try:
+            # WAL lets readers proceed while one process writes, but is not
+            # supported on every (network) filesystem; the default rollback
+            # journal still works there, just with more lock waiting.
+            conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS results ('
+                             'key TEXT PRIMARY KEY, objectives TEXT, created REAL)')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=self.timeout)
+
+    def get(self, key):
+        """ returns dict of objectives stored for key, None if not stored """
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT objectives FROM results WHERE key = ?',
+                               (key,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, key, objectives):
+        """ store dict of objectives (e.g. {'accu': 0.1, 'work': 0.01}) for key """
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                             (key, json.dumps(objectives, sort_keys=True), time.time()))
+        finally:
+            conn.close()
@@ -1,14 +1,18 @@
 #!/bin/env python
 #
-# tests requiring dprepro calls.
+# tests of template preprocessing for atompaw input files.
 #
-# will not run if dprepro not installed or not in path
+# the correct outputs were made with Dakota's dprepro
 import os
 import sys
+import time
 sys.path.append('.')
+import pytest
 import shutil
 import tools_for_tests
 import analysis_driver
+import dprepro
+import dakota_interfacing_2.interfacing as di
 
 # directory of test input files
 test_inputs_dir = os.path.join(tools_for_tests.test_dir, 'test_inputs_dprepro')
@@ -31,3 +35,34 @@ def test_preprocess_pseudopotential_input_files():
         correct_Ge_file = os.path.join(test_inputs_dir, 'Ge.in.correct')
         with open(correct_Ge_file) as f1, open('Ge.in') as f2:
             assert f1.readlines() == f2.readlines()
+
+
+def test_preprocess_byte_identical():
+    """ output matches dprepro output byte for byte """
+    params, _ = di.read_parameters_file(os.path.join(test_inputs_dir, 'params.example'), di.UNNAMED)
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        for elem in ['Si', 'Ge']:
+            dprepro.preprocess(os.path.join(test_inputs_dir, elem+'.in.template'), params, elem+'.in')
+            with open(os.path.join(test_inputs_dir, elem+'.in.correct'), 'rb') as f1, open(elem+'.in', 'rb') as f2:
+                assert f1.read() == f2.read()
+
+
+def test_load_template_recompiles_when_changed():
+    """ cached template is reused until the file changes """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        with open('X.in.template', 'w') as fout:
+            fout.write('a {DAKOTA_Si_RC} b\n')
+        compiled = dprepro.load_template('X.in.template')
+        assert compiled == ['a ', 'DAKOTA_Si_RC', ' b\n']
+        assert dprepro.load_template('X.in.template') is compiled
+        with open('X.in.template', 'w') as fout:
+            fout.write('{DAKOTA_Si_EP}\n')
+        os.utime('X.in.template', (time.time()+10, time.time()+10))
+        assert dprepro.load_template('X.in.template') == ['', 'DAKOTA_Si_EP', '\n']
+
+
+def test_render_unknown_tag():
+    """ raises TemplateError if a tag isn't a parameter """
+    params, _ = di.read_parameters_file(os.path.join(test_inputs_dir, 'params.example'), di.UNNAMED)
+    with pytest.raises(dprepro.TemplateError):
+        dprepro.render(dprepro.compile_template('{DAKOTA_C_RC}'), params)
@@ -1,14 +1,35 @@
 #!/usr/bin/env python
+import json
 import numpy as np
 import os
 import pytest
 import shutil
+import signal
+import subprocess
+import tarfile
+import threading
+import multiprocessing
 import sys
+import time
 sys.path.append('.')
 import analysis_driver
+import atompaw_watchdog
 import calc_accuracy
+import compact
+import diaryf
+import eval_client
 import eval_pp
+import eval_server
+import eval_trace
+import failure_ledger
+import file_cache
+import flop_model
+import logtail
+import pp_cache
+import refdata
+import result_store
 import tools_for_tests
+import workspace
 
 # directory of test input files
 test_inputs_dir = os.path.join(tools_for_tests.test_dir, 'test_inputs')
@@ -49,6 +70,27 @@ def test_preproc_crystal():
      ['Si', '0.5', '0.6', '0.7']]
 
 
+def test_socorro_templates():
+    """ templates are read once and render every configuration's crystal """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        shutil.copy(os.path.join(test_inputs_dir, 'argvf.template.example1'), 'argvf.template')
+        shutil.copy(os.path.join(test_inputs_dir, 'crystal.template.example1'), 'crystal.template')
+        templates = eval_pp.SocorroTemplates('argvf.template', 'crystal.template')
+        positions = np.array([[0.0, 0, 0.1, 0.5, 0.6, 0.7],
+                              [0.25, 0.5, 0.125, 1., 0.75, 0.3]])
+        crystals = templates.render_crystals(positions)
+        assert templates.render_argvf(40., False) == 'asdfsd\nasdf 40.0\nasdfas 160.0\n\n\nlkjlj\n'
+        os.remove('argvf.template')
+        os.remove('crystal.template')
+        assert templates.render_argvf(40., False) == 'asdfsd\nasdf 40.0\nasdfas 160.0\n\n\nlkjlj\n'
+        assert templates.render_crystals(positions) == crystals
+        assert len(crystals) == 2
+        assert crystals[1].splitlines()[-2:] == ['Si 0.25 0.5 0.125', 'Si 1.0 0.75 0.3']
+        with open(os.path.join(test_inputs_dir, 'crystal.template.example1')) as fin:
+            tmplt_txt = fin.readlines()
+        assert crystals[0] == ''.join(eval_pp.DftRun._preproc_crystal(tmplt_txt, positions[0].reshape(-1, 3)))
+
+
 def test_symlink_pseudopotentials():
     """
     symlinks pseudopotentials into data/ directory and compares to 
@@ -377,29 +419,50 @@ def test_calc_accuracy_objective():
     obj = calc_accuracy.calc_accuracy_objective(f_soc, allelectron_forces_file)
     assert np.isclose(obj, 0.98397061458192536)
 
+def test_force_objective_configs_atoms_3():
+    """ (configs, atoms, 3) socorro forces give the same objective as M by 3N """
+    b = np.random.random([4, 6])
+    a = np.random.random([4, 6])
+    assert np.isclose(calc_accuracy.force_objective(a.reshape(4, 2, 3), b),
+                      calc_accuracy.force_objective(a, b))
+
+
+def test_read_diaryf_forces_out():
+    """ forces are parsed straight into a row of a preallocated array """
+    forces = np.zeros([2, 2, 3])
+    record = diaryf.read_diaryf(os.path.join(test_inputs_dir, 'diaryf.test_get_forces'),
+                                forces_out=forces[1])
+    correct_forces = np.array([[0.007170, -0.015092, -0.069756], [-0.007170, 0.015092, 0.069756]])
+    assert np.isclose(forces[1], correct_forces).all()
+    assert (forces[0] == 0.).all()
+    assert np.may_share_memory(record['forces'], forces)
+    with pytest.raises(ValueError):
+        diaryf.read_diaryf(os.path.join(test_inputs_dir, 'diaryf.test_get_forces'),
+                           forces_out=np.zeros([3, 3]))
+
+
 def test_calc_work_objective():
-    #     with tools_for_tests.TemporaryDirectory() as tmp_dir:
-    #         shutil.copy(os.path.join(test_inputs_dir, 'diaryf.test_calc_nflops'), 'diaryf')
-    #         obj = eval_pp.calc_work_objective(path_2_calc_nflops=os.path.join('..', 'calc_nflops'))
-    #         assert np.isclose(obj, 0.00291912152732412591)
-    # 
-    #         # set up two mock dft runs
-    #         main_pp_path_list = []
-    #         main_argvf_template_path = ''
-    #         main_crystal_template_path = ''
-    #         pos = []
-    #         gcut = -1
-    # 
-    #         run1 = eval_pp.DftRun(main_pp_path_list, main_argvf_template_path, main_crystal_template_path, pos, gcut)
-    #         mock_run_dir_1 = 'dir_1'
-    #         os.mkdir(mock_run_dir_1)
-    #         run1.run_dir = mock_run_dir_1
-    # 
-    #         run2 = eval_pp.DftRun(main_pp_path_list, main_argvf_template_path, main_crystal_template_path, pos, gcut)
-    #         mock_run_dir_2 = 'dir_2'
-    #         os.mkdir(mock_run_dir_2)
-    #         run2.run_dir = mock_run_dir_2
-    raise NotImplementedError
+    """ same Gflops as the calc_nflops script, summed over runs """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        runs = []
+        for n in range(2):
+            run = eval_pp.DftRun([], '', '', [], -1)
+            run.run_dir = 'dir_' + str(n)
+            os.mkdir(run.run_dir)
+            shutil.copy(os.path.join(test_inputs_dir, 'diaryf.test_calc_nflops'),
+                        os.path.join(run.run_dir, 'diaryf'))
+            runs.append(run)
+        obj = eval_pp.calc_work_objective(runs)
+        assert np.isclose(obj, 2*0.00291912152732412591, rtol=1.e-12, atol=0.)
+
+
+def test_flop_model_extensions():
+    """ k-point and projector terms only add work """
+    record = diaryf.read_diaryf(os.path.join(test_inputs_dir, 'diaryf.test_calc_nflops'))
+    base = flop_model.gflops([record])
+    assert np.isclose(base[0], 0.00291912152732412591, rtol=1.e-12, atol=0.)
+    assert flop_model.gflops([record], kpoints=True)[0] > base[0]
+    assert flop_model.gflops([record], num_projectors=4)[0] > base[0]
 
 def test_read_inputs():
     filename = os.path.join(test_inputs_dir, 'opal.in')
@@ -407,3 +470,1242 @@ def test_read_inputs():
     assert settings['fake_setting_int'] == '4'
     assert settings['fake_setting_list'] == ['a', 'bc', 'd']
     assert settings['fake_setting_float'] == '4.1'
+
+
+def test_pp_cache_store_fetch():
+    """ pseudopotential stored in cache can be fetched with same key """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        shutil.copy(os.path.join(test_inputs_dir, 'PAW.Si'), 'Si.SOCORRO.atomicdata')
+        with open('Si.in', 'w') as fout:
+            fout.write('Si 14\n')
+        cache = pp_cache.PseudopotentialCache('cache')
+        key = cache.key('Si', 'Si.in')
+        assert not cache.fetch(key, 'Si', 'PAW.Si')
+        cache.store(key, 'Si', 'Si.SOCORRO.atomicdata')
+        assert cache.fetch(key, 'Si', 'PAW.Si')
+        with open('PAW.Si') as f1, open(os.path.join(test_inputs_dir, 'PAW.Si')) as f2:
+            assert f1.read() == f2.read()
+        # a different input file gives a different key
+        assert cache.key('Ge', 'Si.in') != key
+
+
+def test_pp_cache_evict_lru():
+    """ least recently used entry is evicted when cache is too big """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        with open('pp', 'w') as fout:
+            fout.write('x'*100)
+        cache = pp_cache.PseudopotentialCache('cache', max_bytes=250)
+        cache.store('a', 'Si', 'pp')
+        cache.store('b', 'Si', 'pp')
+        os.utime(os.path.join('cache', 'entries', 'a'), (1, 1))
+        os.utime(os.path.join('cache', 'entries', 'b'), (2, 2))
+        assert cache.fetch('a', 'Si', 'hit_a')  # a is now most recently used
+        cache.store('c', 'Si', 'pp')
+        assert cache.size() == 200
+        assert not cache.fetch('b', 'Si', 'hit_b')
+        assert cache.fetch('c', 'Si', 'hit_c')
+
+
+def test_create_a_pseudopotential_cached():
+    """ cache hit links PAW.{elem} without running atompaw """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        with open('Si.in', 'w') as fout:
+            fout.write('Si 14\n')
+        cache = pp_cache.PseudopotentialCache('cache')
+        cache.store(cache.key('Si', 'Si.in'), 'Si', os.path.join(test_inputs_dir, 'PAW.Si'))
+        analysis_driver.create_a_pseudopotential('Si', cache)
+        assert os.readlink('PAW.Si') == os.path.join('Si_pseudopotential', 'Si.SOCORRO.atomicdata')
+        with open('PAW.Si') as f1, open(os.path.join(test_inputs_dir, 'PAW.Si')) as f2:
+            assert f1.read() == f2.read()
+
+
+def test_create_all_pseudopotentials_cancels_siblings(monkeypatch):
+    """ first PseudopotentialFail returns False without waiting for other elements """
+    def mock_create_a_pseudopotential(elem, pseudopotential_cache=None, watchdog=None,
+                                      workspace=None):
+        if elem == 'Si':
+            raise analysis_driver.PseudopotentialFail
+        time.sleep(60)
+    monkeypatch.setattr(analysis_driver, 'create_a_pseudopotential', mock_create_a_pseudopotential)
+    start = time.time()
+    assert analysis_driver.create_all_pseudopotentials(['Ge', 'Si']) is False
+    assert time.time() - start < 30
+
+
+def test_create_all_pseudopotentials_concurrent(monkeypatch):
+    """ all elements run at the same time """
+    def mock_create_a_pseudopotential(elem, pseudopotential_cache=None, watchdog=None,
+                                      workspace=None):
+        time.sleep(1)
+    monkeypatch.setattr(analysis_driver, 'create_a_pseudopotential', mock_create_a_pseudopotential)
+    start = time.time()
+    assert analysis_driver.create_all_pseudopotentials(['Si', 'Ge', 'C']) is True
+    assert time.time() - start < 2.5
+
+
+def test_run_atompaw_waits_for_tile(monkeypatch):
+    """ atompaw waits for a tile while all of them are taken """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_fake_mpirun(monkeypatch, tmp_dir, 'cat > Si.SOCORRO.atomicdata\n')
+        monkeypatch.setattr(eval_pp, 'TILE_RETRY_SECONDS', 0.1)
+        with open('Si.in', 'w') as fout:
+            fout.write('Si input\n')
+        os.mkdir('.DakotaEvalTiling')
+        for tile in range(2):
+            os.mkfifo(os.path.join('.DakotaEvalTiling', '123.%d' % tile))
+        timer = threading.Timer(0.5, os.remove, [os.path.join('.DakotaEvalTiling', '123.1')])
+        timer.start()
+        start = time.time()
+        assert analysis_driver.run_atompaw('Si.in') is None
+        assert time.time() - start >= 0.5
+        with open('Si.SOCORRO.atomicdata') as fin:
+            assert fin.read() == 'Si input\n'
+        # with the tiles taken for too long, atompaw gives up
+        os.mkfifo(os.path.join('.DakotaEvalTiling', '123.1'))
+        monkeypatch.setattr(analysis_driver, 'ATOMPAW_MAX_TILE_WAIT', 0.3)
+        start = time.time()
+        with pytest.raises(analysis_driver.di.ResourceError):
+            analysis_driver.run_atompaw('Si.in')
+        assert time.time() - start < 5.
+        # a job without a tile for atompaw fails right away
+        monkeypatch.setenv('SLURM_TASKS_PER_NODE', '2')
+        with pytest.raises(analysis_driver.di.ResourceError):
+            analysis_driver.run_atompaw('Si.in')
+
+
+def test_create_all_pseudopotentials_transient(monkeypatch):
+    """ a child that found no tile in time reports a transient failure """
+    def mock_create_a_pseudopotential(elem, pseudopotential_cache=None, watchdog=None,
+                                      workspace=None):
+        raise analysis_driver.PseudopotentialTransientFail
+    monkeypatch.setattr(analysis_driver, 'create_a_pseudopotential', mock_create_a_pseudopotential)
+    with pytest.raises(analysis_driver.PseudopotentialTransientFail):
+        analysis_driver.create_all_pseudopotentials(['Si'])
+
+
+def test_evaluate_transient_atompaw_failure(monkeypatch):
+    """ atompaw finding no tile is penalized but not recorded in the ledger """
+    def create_all_pseudopotentials(*args):
+        raise analysis_driver.PseudopotentialTransientFail
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_known_failure_workdir()
+        params, results = analysis_driver.di.read_parameters_file('params', 'results')
+        settings = analysis_driver.read_inputs('../opal.in')
+        monkeypatch.setattr(analysis_driver, 'preprocess_pseudopotential_input_files',
+                            lambda *args: None)
+        monkeypatch.setattr(analysis_driver, 'create_all_pseudopotentials',
+                            create_all_pseudopotentials)
+        params['DAKOTA_Si_RC'] = 10.  # far from the recorded failure
+        assert analysis_driver.evaluate(settings, params, results) == 'atompaw'
+        assert results['accu'].function == 100
+        with open('../ledger') as fin:
+            assert len(fin.readlines()) == 1
+
+
+def test_failure_ledger_lookup():
+    """ lookup finds recorded failures within radius and keeps stats """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        ledger = failure_ledger.FailureLedger('ledger', radius=0.1)
+        assert ledger.lookup([1., 2.]) is None
+        ledger.record('socorro', [1., 2.])
+        ledger.record('atompaw', [5., 5.])
+        assert ledger.lookup([1.05, 2.]) == 'socorro'
+        assert ledger.lookup([5., 5.05]) == 'atompaw'
+        assert ledger.lookup([1.2, 2.]) is None
+        assert ledger.lookup([1., 2., 3.]) is None  # different dimension
+        stats = ledger.stats(radii=[0.3])
+        assert stats['lookups'] == 5
+        assert stats['misses'] == 3
+        assert stats['hits'] == {'atompaw': 1, 'socorro': 1, 'cutoff': 0}
+        assert stats['would_hit'] == {0.3: 3}
+
+
+def test_failure_ledger_nearest_scaled():
+    """ the nearest failure wins, distances are scaled, strings must match """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        ledger = failure_ledger.FailureLedger('ledger', radius=0.1)
+        ledger.record('atompaw', [1., 2.])
+        ledger.record('socorro', [1.06, 2.])
+        assert ledger.lookup([1.05, 2.]) == 'socorro'
+        # the second variable spans 100 times the range of the first
+        scaled = failure_ledger.FailureLedger('ledger', radius=0.1, scales=[1., 100.])
+        assert scaled.lookup([1., 7.]) == 'atompaw'
+        assert ledger.lookup([1., 7.]) is None
+        ledger.record('cutoff', [3., 'lda', 4.])
+        assert ledger.lookup([3., 'lda', 4.05]) == 'cutoff'
+        assert ledger.lookup([3., 'gga', 4.]) is None
+        assert ledger.lookup([1., 2.]) == 'atompaw'
+        with open('params', 'w') as fout:
+            fout.write('3 variables\n1.5 x\n2 n\nlda m\n1 functions\n1 ASV_1:f\n'
+                       '0 derivative_variables\n0 analysis_components\n1 eval_id\n')
+        params, _ = analysis_driver.di.read_parameters_file('params', 'results')
+        assert failure_ledger.parameter_vector(params) == [1.5, 2., 'lda']
+
+
+def test_failure_ledger_json_lines():
+    """ each failure is a JSON line, so strings with spaces and quotes round trip """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        ledger = failure_ledger.FailureLedger('ledger', radius=0.1)
+        ledger.record('socorro', [1., "it's lda", 2])
+        with open('ledger') as fin:
+            assert json.loads(fin.read()) == {'kind': 'socorro', 'vector': [1., "it's lda", 2.]}
+        assert ledger.lookup([1., "it's lda", 2.]) == 'socorro'
+        assert ledger.lookup([1., "it's", 2.]) is None
+
+
+def setup_known_failure_workdir():
+    """
+    sets up opal.in, a failure ledger and workdir.example/params in the
+    current directory so that analysis_driver.main returns 95 without
+    running atompaw or socorro, then moves to workdir.example
+    """
+    params_file = os.path.join(tools_for_tests.test_dir, 'test_inputs_integration',
+                               'analysis_driver_main_success', 'params')
+    with open('opal.in', 'w') as fout:
+        fout.write('element_list Si Ge\ntemplates_dir .\ngcuts 20 30\nenergy_tol 1e-3\n'
+                   'failure_ledger ../ledger\nfailure_radius 0.01\n')
+    ledger = failure_ledger.FailureLedger('ledger', 0.01)
+    ledger.record('cutoff', [1.9, 4.5, 2.3, 3.001])
+    os.mkdir('workdir.example')
+    os.chdir('workdir.example')
+    shutil.copy(params_file, 'params')
+
+
+def test_analysis_driver_main_known_failure():
+    """ parameters near a recorded failure return its penalty without running anything """
+    stdout = sys.stdout
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_known_failure_workdir()
+        try:
+            analysis_driver.main()
+        finally:
+            sys.stdout = stdout
+        with open('results') as fin:
+            assert fin.readlines()==['  9.5000000000000000E+01 accu\n', '  9.5000000000000000E+01 work\n']
+
+
+def test_eval_server():
+    """ evaluation forwarded to the server writes results in the client's directory """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        socket_path = os.path.join(tmp_dir, 'eval.sock')
+        assert eval_client.forward(socket_path, ['params', 'results']) is None
+        server = multiprocessing.Process(target=eval_server.serve, args=(socket_path,))
+        server.start()
+        try:
+            for _ in range(100):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.05)
+            setup_known_failure_workdir()
+            assert eval_client.forward(socket_path, ['params', 'results']) == 0
+            with open('results') as fin:
+                assert fin.readlines()==['  9.5000000000000000E+01 accu\n', '  9.5000000000000000E+01 work\n']
+            # a failed evaluation reports a nonzero status
+            os.remove('params')
+            assert eval_client.forward(socket_path, ['params', 'results']) == 1
+        finally:
+            server.terminate()
+            server.join()
+
+
+def test_memoize_file():
+    """ file is only re-read when it changes """
+    calls = []
+    @file_cache.memoize_file
+    def loader(filename):
+        calls.append(filename)
+        return np.loadtxt(filename)
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        with open('data', 'w') as fout:
+            fout.write('1 2 3\n')
+        assert (loader('data') == [1, 2, 3]).all()
+        assert (loader(filename='data') == [1, 2, 3]).all()
+        assert len(calls) == 1
+        with pytest.raises(ValueError):
+            loader('data')[0] = 5.  # cached arrays are read-only
+        with open('data', 'w') as fout:
+            fout.write('4 5 6 7\n')
+        assert (loader('data') == [4, 5, 6, 7]).all()
+        assert len(calls) == 2
+
+
+def test_refdata_load():
+    """ the text is parsed once into a binary copy that is memory mapped read-only """
+    calls = []
+    def parse(filename):
+        calls.append(filename)
+        return np.genfromtxt(filename, comments='#')
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        shutil.copy(os.path.join(test_inputs_dir, 'configurations.in.example'), 'configurations.in')
+        positions = refdata.load('configurations.in', parse)
+        assert isinstance(positions, np.memmap)
+        assert (positions == np.genfromtxt('configurations.in', comments='#')).all()
+        with pytest.raises(ValueError):
+            positions[0, 0] = 5.
+        with open('configurations.in.npy.json') as fin:
+            header = json.load(fin)
+        assert header['shape'] == [4, 6] and header['num_atoms'] == 2
+        assert (refdata.load('configurations.in', parse) == positions).all()
+        assert len(calls) == 1
+
+
+def test_refdata_load_regenerates():
+    """ the binary copy is written again when the source changes or it is damaged """
+    calls = []
+    def parse(filename):
+        calls.append(filename)
+        return np.loadtxt(filename)
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        with open('forces.dat', 'w') as fout:
+            fout.write('1 2 3\n4 5 6\n')
+        refdata.load('forces.dat', parse)
+        # touched but not changed
+        os.utime('forces.dat', (0, 0))
+        assert (refdata.load('forces.dat', parse) == [[1, 2, 3], [4, 5, 6]]).all()
+        assert len(calls) == 1
+        with open('forces.dat', 'w') as fout:
+            fout.write('1 2 3\n4 5 7\n')
+        assert (refdata.load('forces.dat', parse) == [[1, 2, 3], [4, 5, 7]]).all()
+        assert len(calls) == 2
+        # a changed value is only found by checking the checksum
+        with open('forces.dat.npy', 'r+b') as f:
+            f.seek(-8, 2)
+            f.write(np.array([9.]).tostring())
+        assert refdata.load('forces.dat', parse)[1, 2] == 9.
+        assert (refdata.load('forces.dat', parse, verify=True) == [[1, 2, 3], [4, 5, 7]]).all()
+        assert len(calls) == 3
+        # a truncated copy is found from its size
+        with open('forces.dat.npy', 'r+b') as f:
+            f.truncate(os.path.getsize('forces.dat.npy') - 8)
+        assert (refdata.load('forces.dat', parse) == [[1, 2, 3], [4, 5, 7]]).all()
+        assert len(calls) == 4
+
+
+def test_reference_data_binary_cache():
+    """ configurations and all electron forces read the same from their binary copies """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        for name in ['configurations.in.example', 'allelectron_forces.dat.example']:
+            shutil.copy(os.path.join(test_inputs_dir, name), name)
+        assert (eval_pp.get_random_configurations('configurations.in.example', binary_cache=True) ==
+                eval_pp.get_random_configurations('configurations.in.example')).all()
+        assert (calc_accuracy.read_allelectron_forces('allelectron_forces.dat.example',
+                                                      binary_cache=True) ==
+                calc_accuracy.read_allelectron_forces('allelectron_forces.dat.example')).all()
+        assert os.path.isfile('configurations.in.example.npy')
+        assert os.path.isfile('allelectron_forces.dat.example.npy')
+
+
+def _put_results(path, n):
+    store = result_store.ResultStore(path)
+    for i in range(n):
+        store.put('key%d.%d' % (os.getpid(), i), {'accu': i, 'work': 2*i})
+
+
+def test_result_store_concurrent_writers():
+    """ results stored by several processes at once can all be read back """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        writers = [multiprocessing.Process(target=_put_results, args=('store.db', 20))
+                   for _ in range(4)]
+        for p in writers:
+            p.start()
+        for p in writers:
+            p.join()
+            assert p.exitcode == 0
+        store = result_store.ResultStore('store.db')
+        for p in writers:
+            assert store.get('key%d.19' % p.pid) == {'accu': 19, 'work': 38}
+        assert store.get('not stored') is None
+
+
+def test_analysis_driver_main_stored_result():
+    """ identical evaluation is answered from the result store """
+    stdout = sys.stdout
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_known_failure_workdir()
+        with open('../opal.in', 'a') as fout:
+            fout.write('result_store ../results.db\n')
+        params, _ = analysis_driver.di.read_parameters_file('params', 'results')
+        settings = analysis_driver.read_inputs('../opal.in')
+        key = analysis_driver.evaluation_key(params, settings)
+        result_store.ResultStore('../results.db').put(key, {'accu': 0.5, 'work': 0.25})
+        try:
+            analysis_driver.main()
+        finally:
+            sys.stdout = stdout
+        with open('results') as fin:
+            assert fin.readlines()==['  5.0000000000000000E-01 accu\n', '  2.5000000000000000E-01 work\n']
+        # a different energy_tol is a different evaluation, so falls through to the ledger
+        with open('../opal.in', 'a') as fout:
+            fout.write('energy_tol 1e-4\n')
+        try:
+            analysis_driver.main()
+        finally:
+            sys.stdout = stdout
+        with open('results') as fin:
+            assert fin.readlines()==['  9.5000000000000000E+01 accu\n', '  9.5000000000000000E+01 work\n']
+
+
+def test_evaluation_key_settings():
+    """ every setting the objectives depend on is in the key, and only those """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_known_failure_workdir()
+        params, _ = analysis_driver.di.read_parameters_file('params', 'results')
+        settings = analysis_driver.read_inputs('../opal.in')
+        key = analysis_driver.evaluation_key(params, settings)
+        for name, value in [('gcut_search', 'adaptive'), ('convergence_subset', '2'),
+                            ('restart_files', 'data/density'), ('scf_max_steps', '50')]:
+            assert analysis_driver.evaluation_key(params, dict(settings, **{name: value})) != key
+        for name, value in [('launch_engine', 'direct'), ('refdata_cache', 'yes')]:
+            assert analysis_driver.evaluation_key(params, dict(settings, **{name: value})) == key
+        # the files are found through the workspace, wherever the current directory is
+        ws = workspace.Workspace()
+        os.chdir(tmp_dir)
+        assert analysis_driver.evaluation_key(params, settings, ws) == key
+        with open('configurations.in', 'w') as fout:
+            fout.write('0.\n')
+        assert analysis_driver.evaluation_key(params, settings, ws) != key
+
+
+def test_evaluate_does_not_store_penalties(monkeypatch):
+    """ a failed evaluation is left to the failure ledger, not the result store """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_known_failure_workdir()
+        params, results = analysis_driver.di.read_parameters_file('params', 'results')
+        settings = {'element_list': ['Si', 'Ge'], 'templates_dir': '.', 'gcuts': ['20', '30'],
+                    'energy_tol': '1e-3', 'result_store': '../results.db'}
+        monkeypatch.setattr(analysis_driver, 'preprocess_pseudopotential_input_files',
+                            lambda *args: None)
+        monkeypatch.setattr(analysis_driver, 'create_all_pseudopotentials', lambda *args: False)
+        assert analysis_driver.evaluate(settings, params, results) == 'atompaw'
+        key = analysis_driver.evaluation_key(params, settings)
+        assert result_store.ResultStore('../results.db').get(key) is None
+
+
+def test_logtail():
+    """ only complete lines are returned, each once """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        tail = logtail.LogTail('log')
+        assert tail.read_lines() == []
+        with open('log', 'w') as fout:
+            fout.write('line 1\nline')
+        assert tail.read_lines() == ['line 1']
+        with open('log', 'a') as fout:
+            fout.write(' 2\n')
+        assert tail.read_lines() == ['line 2']
+        assert tail.read_lines() == []
+
+
+def test_atompaw_watchdog_kill_pattern():
+    """ run is killed as soon as the log shows non-convergence """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        watchdog = atompaw_watchdog.AtompawWatchdog('history', poll_interval=0.05)
+        with open('log', 'w') as log:
+            p = subprocess.Popen(['sh', '-c', 'echo iter 1; echo "SCF did not converge"; exec sleep 30'],
+                                 stdout=log)
+            start = time.time()
+            returncode = watchdog.monitor('log', 'Si')(p)
+        assert time.time() - start < 10
+        assert returncode != 0
+        assert watchdog.kill_reason == 'log: SCF did not converge'
+        assert not watchdog.timed_out
+        assert watchdog.history()[0]['kill_reason'] == watchdog.kill_reason
+
+
+def test_atompaw_watchdog_timeout():
+    """ timeout comes from earlier runtimes once there are enough of them """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        watchdog = atompaw_watchdog.AtompawWatchdog('history', timeout_factor=2., min_samples=3,
+                                                    default_timeout=60., poll_interval=0.05)
+        assert watchdog.timeout('Si') == 60.
+        for i in range(3):
+            watchdog.record('Si', 0.1, 0, None)
+        watchdog.record('Si', 100., 0, 'timeout')  # killed runs don't count
+        assert np.isclose(watchdog.timeout('Si'), 0.2)
+        assert watchdog.timeout('Ge') == 60.  # runtimes are per element
+        p = subprocess.Popen(['sleep', '30'])
+        watchdog.monitor('log', 'Si')(p)
+        assert watchdog.kill_reason.startswith('timeout')
+        assert watchdog.timed_out
+        # a normal run is not killed
+        p = subprocess.Popen(['true'])
+        assert watchdog.monitor('log', 'Si')(p) == 0
+        assert watchdog.kill_reason is None
+        assert not watchdog.timed_out
+
+
+def test_atompaw_watchdog_history_roll_over():
+    """ the history keeps the last history_runs runs of each element """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        watchdog = atompaw_watchdog.AtompawWatchdog('history', min_samples=1, history_runs=3)
+        other = atompaw_watchdog.AtompawWatchdog('history', min_samples=1, history_runs=3,
+                                                 percentile=100., timeout_factor=1.)
+        watchdog.record('Ge', 5., 0, None)
+        for i in range(6):
+            watchdog.record('Si', float(i), 0, None)
+        assert other.timeout('Si') == 5.
+        # the next Si run rolls the file over, keeping Ge
+        watchdog.record('Si', 0.5, 0, None)
+        with open('history') as fin:
+            assert [json.loads(line)['seconds'] for line in fin] == [5., 4., 5., 0.5]
+        # other reads the rolled over file from the start
+        assert other.timeout('Si') == 5.
+        assert other.timeout('Ge') == 5.
+        watchdog.record('Si', 7., 0, None)
+        assert other.timeout('Si') == 7.
+        assert [run['seconds'] for run in other.history()] == [5., 5., 0.5, 7.]
+
+
+def test_create_a_pseudopotential_watchdog_kills(monkeypatch):
+    """ a timeout kill is a transient failure, a kill on the log is not """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        with open('Si.in', 'w') as fout:
+            fout.write('Si 14\n')
+        watchdog = atompaw_watchdog.AtompawWatchdog('history')
+        def mock_run_atompaw(atompaw_input_filename, watchdog, run_dir):
+            watchdog.timed_out = watchdog.kill_reason.startswith('timeout')
+            return watchdog.kill_reason
+        monkeypatch.setattr(analysis_driver, 'run_atompaw', mock_run_atompaw)
+        watchdog.kill_reason = 'timeout after 1.0 s'
+        with pytest.raises(analysis_driver.PseudopotentialTransientFail):
+            analysis_driver.create_a_pseudopotential('Si', watchdog=watchdog)
+        shutil.rmtree('Si_pseudopotential')
+        watchdog.kill_reason = 'log: SCF did not converge'
+        with pytest.raises(analysis_driver.PseudopotentialFail) as excinfo:
+            analysis_driver.create_a_pseudopotential('Si', watchdog=watchdog)
+        assert not isinstance(excinfo.value, analysis_driver.PseudopotentialTransientFail)
+
+
+def make_finished_evaluation():
+    """ mock evaluation directory layout in the current directory """
+    for f in ['params', 'results', 'analysis_driver.log', 'Si.in', 'argvf.template']:
+        with open(f, 'w') as fout:
+            fout.write(f+'\n')
+    os.mkdir('Si_pseudopotential')
+    for f in ['log', 'Si.SOCORRO.atomicdata']:
+        with open(os.path.join('Si_pseudopotential', f), 'w') as fout:
+            fout.write(f+'\n')
+    os.symlink('Si_pseudopotential/Si.SOCORRO.atomicdata', 'PAW.Si')
+    for gcut_dir in ['gcut_dir.20', 'gcut_dir.30', 'gcut_dir.100']:
+        os.makedirs(os.path.join(gcut_dir, 'workdir_r.1', 'data'))
+        with open(os.path.join(gcut_dir, 'workdir_r.1', 'diaryf'), 'w') as fout:
+            fout.write('diaryf\n')
+        os.symlink('../../PAW.Si', os.path.join(gcut_dir, 'workdir_r.1', 'PAW.Si'))
+
+
+def test_compact_final_gcut():
+    """ only the highest gcut is archived and generated files are removed """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        make_finished_evaluation()
+        compact.compact(tmp_dir, 'final_gcut')
+        assert sorted(os.listdir('.')) == ['analysis_driver.log', 'argvf.template',
+                                           compact.ARCHIVE_NAME, 'params', 'results']
+        with tarfile.open(compact.ARCHIVE_NAME) as tar:
+            assert sorted(tar.getnames()) == ['Si.in', 'Si_pseudopotential/Si.SOCORRO.atomicdata',
+                                              'Si_pseudopotential/log',
+                                              'gcut_dir.100/workdir_r.1/diaryf']
+
+
+def test_compact_final_gcut_converged():
+    """ the gcut the energies converged in is archived, not the highest one """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        make_finished_evaluation()
+        with open('converged_gcut', 'w') as fout:
+            fout.write('gcut_dir.30\n')
+        # left behind by an evaluation that died before writing its trace
+        with open('eval_trace.spool', 'w') as fout:
+            fout.write('{}\n')
+        compact.compact(tmp_dir, 'final_gcut')
+        assert sorted(os.listdir('.')) == ['analysis_driver.log', 'argvf.template',
+                                           compact.ARCHIVE_NAME, 'params', 'results']
+        with tarfile.open(compact.ARCHIVE_NAME) as tar:
+            assert 'converged_gcut' in tar.getnames()
+            assert 'eval_trace.spool' in tar.getnames()
+            assert 'gcut_dir.30/workdir_r.1/diaryf' in tar.getnames()
+            assert 'gcut_dir.100/workdir_r.1/diaryf' not in tar.getnames()
+
+
+def test_compact_all_and_results():
+    """ 'all' archives every generated file, 'results' none """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        make_finished_evaluation()
+        assert len(compact.files_to_keep(tmp_dir, 'all')) == 6
+        assert compact.files_to_keep(tmp_dir, 'results') == []
+        compact.compact(tmp_dir, 'none')
+        assert os.path.isdir('gcut_dir.20')
+        compact.compact(tmp_dir, 'results')
+        assert sorted(os.listdir('.')) == ['analysis_driver.log', 'argvf.template', 'params', 'results']
+
+
+def test_compact_in_background():
+    """ compaction runs after compact_in_background returns """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        make_finished_evaluation()
+        compact.compact_in_background(tmp_dir, 'all')
+        for _ in range(200):
+            # the highest gcut_dir is removed last
+            if not os.path.exists('gcut_dir.100'):
+                break
+            time.sleep(0.05)
+        assert os.path.isfile(compact.ARCHIVE_NAME)
+        assert not os.path.exists('Si_pseudopotential')
+
+
+def test_eval_trace():
+    """ spans, including ones recorded by forked children, end up in one trace line """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        with eval_trace.span('ignored'):
+            pass  # not tracing yet
+        eval_trace.start('spool')
+        with eval_trace.span('preprocess'):
+            pass
+        child = multiprocessing.Process(target=eval_trace.record_timings,
+                                        args=('atompaw', {'tile_wait': 1., 'mpirun': 2.}))
+        child.start()
+        child.join()
+        eval_trace.finish('trace.jsonl', outcome='success')
+        assert not os.path.exists('spool')
+        eval_trace.start('spool')
+        eval_trace.record('preprocess', 3.)
+        eval_trace.finish('trace.jsonl', outcome='cutoff')
+        with open('trace.jsonl') as fin:
+            lines = fin.readlines()
+        assert len(lines) == 2
+        summary = eval_trace.summarize(['trace.jsonl'])
+        assert sorted(summary) == ['atompaw.mpirun', 'atompaw.tile_wait', 'evaluation', 'preprocess']
+        assert summary['evaluation']['count'] == 2
+        assert summary['preprocess']['count'] == 2
+        assert summary['atompaw.mpirun']['total'] == 2.
+        assert summary['preprocess']['p50'] > 1.
+
+
+def test_analysis_driver_main_trace():
+    """ main appends a trace line for the evaluation when trace_file is set """
+    stdout = sys.stdout
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_known_failure_workdir()
+        with open('../opal.in', 'a') as fout:
+            fout.write('trace_file ../trace.jsonl\n')
+        try:
+            analysis_driver.main()
+        finally:
+            sys.stdout = stdout
+        assert not os.path.exists(workspace.Workspace().trace_spool_file())
+        summary = eval_trace.summarize(['../trace.jsonl'])
+        assert summary['evaluation']['count'] == 1
+
+
+def test_available_tiles(monkeypatch):
+    """ tiles with a lock file are not available """
+    monkeypatch.setenv('SLURM_JOBID', '123')
+    monkeypatch.setenv('SLURM_TASKS_PER_NODE', '4')
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        os.mkfifo('123.1')
+        assert eval_pp.di.available_tiles(commands=eval_pp.SOCORRO_COMMANDS, lock_dir=tmp_dir) == 3
+
+
+def setup_eval_pp_workdir():
+    """
+    sets up configurations, reference forces and workdir.example with
+    the socorro templates and pseudopotentials, then moves to workdir.example
+    """
+    inputs = os.path.join(tools_for_tests.test_dir, 'test_inputs_integration', 'eval_pp_main_test')
+    shutil.copy(os.path.join(inputs, 'configurations.in.example'), 'configurations.in')
+    shutil.copy(os.path.join(inputs, 'allelectron_forces.dat.example'), 'allelectron_forces.dat')
+    os.mkdir('workdir.example')
+    os.chdir('workdir.example')
+    for f in ['argvf.template', 'crystal.template', 'PAW.Si', 'PAW.Ge']:
+        shutil.copy(os.path.join(inputs, f), f)
+
+
+def fake_socorro_worker(started_log, slow_gcut_dirs=()):
+    """
+    returns a replacement for eval_pp._run_socorro_worker that logs the
+    gcut directory it ran in and writes a finished diaryf, sleeping first
+    in slow_gcut_dirs
+    """
+    def worker(run_dir, scf_watchdog=None):
+        gcut_dir = os.path.basename(os.path.dirname(run_dir))
+        with open(started_log, 'a') as fout:
+            fout.write(gcut_dir + '\n')
+        if gcut_dir in slow_gcut_dirs:
+            time.sleep(30)
+        shutil.copy(os.path.join(test_inputs_dir, 'diaryf.test_get_dft_results_2'),
+                    os.path.join(run_dir, 'diaryf'))
+        with open(os.path.join(run_dir, 'data', 'restart'), 'a') as fout:
+            fout.write(gcut_dir + '\n')
+    return worker
+
+
+def test_eval_pp_main_speculative(monkeypatch):
+    """ higher gcuts start early and are cancelled and removed once converged """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_eval_pp_workdir()
+        started_log = os.path.join(tmp_dir, 'started')
+        monkeypatch.setattr(eval_pp, '_run_socorro_worker',
+                            fake_socorro_worker(started_log, ['gcut_dir.40', 'gcut_dir.50']))
+        monkeypatch.setattr(eval_pp.di, 'available_tiles', lambda **kwargs: 100)
+        monkeypatch.setattr(eval_pp, 'calc_work_objective', lambda runs: 1.)
+        start = time.time()
+        objectives = eval_pp.main(['Si', 'Ge'], [20., 30., 40., 50.], 1.e-3, speculative_gcuts=2)
+        assert time.time() - start < 20
+        assert objectives['work'] == 1.
+        with open(started_log) as fin:
+            assert set(fin.read().split()) == set(['gcut_dir.20', 'gcut_dir.30',
+                                                   'gcut_dir.40', 'gcut_dir.50'])
+        assert sorted(d for d in os.listdir('.') if d.startswith('gcut_dir')) == \
+            ['gcut_dir.20', 'gcut_dir.30']
+
+
+def test_eval_pp_main_no_idle_tiles(monkeypatch):
+    """ nothing is started speculatively when the tiles are busy """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_eval_pp_workdir()
+        started_log = os.path.join(tmp_dir, 'started')
+        monkeypatch.setattr(eval_pp, '_run_socorro_worker', fake_socorro_worker(started_log))
+        monkeypatch.setattr(eval_pp.di, 'available_tiles', lambda **kwargs: 0)
+        monkeypatch.setattr(eval_pp, 'calc_work_objective', lambda runs: 1.)
+        eval_pp.main(['Si', 'Ge'], [20., 30., 40., 50.], 1.e-3, speculative_gcuts=2)
+        with open(started_log) as fin:
+            assert set(fin.read().split()) == set(['gcut_dir.20', 'gcut_dir.30'])
+
+
+def test_eval_pp_main_speculative_no_slurm(monkeypatch):
+    """ outside a SLURM allocation there are no idle tiles to speculate on """
+    monkeypatch.delenv('SLURM_JOBID', raising=False)
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_eval_pp_workdir()
+        started_log = os.path.join(tmp_dir, 'started')
+        monkeypatch.setattr(eval_pp, '_run_socorro_worker', fake_socorro_worker(started_log))
+        monkeypatch.setattr(eval_pp, 'calc_work_objective', lambda runs: 1.)
+        eval_pp.main(['Si', 'Ge'], [20., 30., 40., 50.], 1.e-3, speculative_gcuts=2)
+        with open(started_log) as fin:
+            assert set(fin.read().split()) == set(['gcut_dir.20', 'gcut_dir.30'])
+
+
+def test_eval_pp_main_cancels_waited_sweep(monkeypatch):
+    """ the sweep being waited on is cancelled when the wait raises """
+    waited = []
+    def wait_position_sweep(sweep, others=()):
+        waited.append(sweep)
+        raise ValueError('bad diaryf')
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_eval_pp_workdir()
+        monkeypatch.setattr(eval_pp, '_run_socorro_worker',
+                            fake_socorro_worker(os.path.join(tmp_dir, 'started'), ['gcut_dir.20']))
+        monkeypatch.setattr(eval_pp, 'wait_position_sweep', wait_position_sweep)
+        with pytest.raises(ValueError):
+            eval_pp.main(['Si', 'Ge'], [20., 30., 40., 50.], 1.e-3)
+        assert not any(p.is_alive() for p in waited[0].processes)
+        assert not os.path.exists('gcut_dir.20')
+
+
+def test_eval_pp_main_workspace(monkeypatch):
+    """ main runs in its workspace without changing the current directory """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_eval_pp_workdir()
+        os.chdir(tmp_dir)
+        monkeypatch.setattr(eval_pp, '_run_socorro_worker',
+                            fake_socorro_worker(os.path.join(tmp_dir, 'started')))
+        monkeypatch.setattr(eval_pp, 'calc_work_objective', lambda runs: 1.)
+        ws = workspace.Workspace('workdir.example')
+        objectives = eval_pp.main(['Si', 'Ge'], [20., 30., 40.], 1.e-3, workspace=ws)
+        assert os.getcwd() == tmp_dir
+        assert objectives['num_sweeps'] == 2
+        assert sorted(d for d in os.listdir('workdir.example') if d.startswith('gcut_dir')) == \
+            ['gcut_dir.20', 'gcut_dir.30']
+        assert os.path.isfile(os.path.join('workdir.example', 'gcut_dir.30', 'workdir_r.1', 'argvf'))
+
+
+def test_create_a_pseudopotential_workspace():
+    """ the pseudopotential is linked in the workspace, not the current directory """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        os.mkdir('eval')
+        with open(os.path.join('eval', 'Si.in'), 'w') as fout:
+            fout.write('Si 14\n')
+        cache = pp_cache.PseudopotentialCache('cache')
+        cache.store(cache.key('Si', os.path.join('eval', 'Si.in')), 'Si',
+                    os.path.join(test_inputs_dir, 'PAW.Si'))
+        analysis_driver.create_a_pseudopotential('Si', cache, workspace=workspace.Workspace('eval'))
+        assert os.getcwd() == tmp_dir
+        assert not os.path.exists('PAW.Si')
+        with open(os.path.join('eval', 'PAW.Si')) as f1, open(os.path.join(test_inputs_dir, 'PAW.Si')) as f2:
+            assert f1.read() == f2.read()
+
+
+def test_adaptive_gcut_search():
+    """ adaptive search stops where the linear search would, in fewer sweeps """
+    gcuts = range(10, 210, 10)
+    tol = 1.e-3
+    def energy(g):
+        return [-10. + 50.*np.exp(-0.08*g), -12. + 20.*np.exp(-0.06*g)]
+    # where the linear search stops
+    all_energy = []
+    for linear, g in enumerate(gcuts):
+        all_energy.append(energy(g))
+        if eval_pp.is_converged(all_energy, tol):
+            break
+    run = set()
+    def get_energies(i, j):
+        run.update([i, j])
+        return [energy(gcuts[i]), energy(gcuts[j])]
+    assert eval_pp.adaptive_gcut_search(gcuts, tol, get_energies) == linear
+    assert len(run) < linear + 1
+
+
+def test_adaptive_gcut_search_bounded_overshoot():
+    """ an early convergence doesn't send the search far above it """
+    gcuts = range(16, 52, 4)
+    energy = lambda g: [0.5*np.exp(-g/6.) + 0.05*np.exp(-g/15.)]
+    run = set()
+    def get_energies(i, j):
+        run.update([i, j])
+        return [energy(gcuts[i]), energy(gcuts[j])]
+    assert eval_pp.adaptive_gcut_search(gcuts, 1.e-2, get_energies) == 3
+    assert max(run) == 3
+
+
+def test_adaptive_gcut_search_no_converge():
+    """ returns None if no consecutive gcuts converge """
+    gcuts = [10., 20., 30., 40.]
+    get_energies = lambda i, j: [[gcuts[i]], [gcuts[j]]]
+    assert eval_pp.adaptive_gcut_search(gcuts, 1.e-3, get_energies) is None
+
+
+def test_predict_converged_gcut():
+    """ exponentially shrinking differences are extrapolated to the tolerance """
+    differences = [[np.exp(-0.1*g)] for g in [20., 30.]]
+    assert np.isclose(eval_pp.predict_converged_gcut([20., 30.], differences, np.exp(-5.)), 50.)
+    assert eval_pp.predict_converged_gcut([20.], differences[:1], 1.e-3) is None
+    assert eval_pp.predict_converged_gcut([20., 30.], differences[::-1], 1.e-3) is None
+
+
+def test_eval_pp_main_adaptive(monkeypatch):
+    """ the number of sweeps is returned and added to the trace """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_eval_pp_workdir()
+        monkeypatch.setattr(eval_pp, '_run_socorro_worker',
+                            fake_socorro_worker(os.path.join(tmp_dir, 'started')))
+        monkeypatch.setattr(eval_pp, 'calc_work_objective', lambda runs: 1.)
+        eval_trace.start('spool')
+        objectives = eval_pp.main(['Si', 'Ge'], [20., 30., 40., 50.], 1.e-3, gcut_search='adaptive')
+        eval_trace.finish('trace.jsonl')
+        assert objectives['num_sweeps'] == 2
+        assert eval_trace.summarize(['trace.jsonl'])['num_sweeps']['mean'] == 2
+        with open('converged_gcut') as fin:
+            assert fin.read() == 'gcut_dir.30\n'
+
+
+def test_setup_files_restart():
+    """ restart files are copied from restart_dir and {restart} is set """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        with open('argvf.template', 'w') as fout:
+            fout.write('wf_cutoff {gcut}\nrestart {restart}\n')
+        shutil.copy(test_inputs_dir+'/crystal.template.example1', 'crystal.template')
+        os.makedirs('previous/data')
+        with open('previous/data/density', 'w') as fout:
+            fout.write('density\n')
+        pos = [[0.0, 0, '0.1'], [0.5, 0.6, 0.7]]
+        for name, restart_files in [('cold', []), ('missing', ['data/density', 'wfs']),
+                                    ('warm', ['data/density'])]:
+            os.mkdir(name)
+            os.chdir(name)
+            run = eval_pp.DftRun([], '../argvf.template', '../crystal.template', pos, 30.,
+                                 os.path.join(tmp_dir, 'previous'), restart_files)
+            run.setup_files()
+            with open('argvf') as fin:
+                assert fin.readlines()[1] == 'restart %s\n' % ('on' if name == 'warm' else 'off')
+            assert run.restarted == (name == 'warm')
+            assert os.path.isfile('data/density') == (name == 'warm')
+            os.chdir(tmp_dir)
+
+
+def test_eval_pp_main_restart(monkeypatch):
+    """ each gcut restarts from the previous gcut's run of the same configuration """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_eval_pp_workdir()
+        monkeypatch.setattr(eval_pp, '_run_socorro_worker',
+                            fake_socorro_worker(os.path.join(tmp_dir, 'started')))
+        monkeypatch.setattr(eval_pp, 'calc_work_objective', lambda runs: 1.)
+        eval_trace.start('spool')
+        eval_pp.main(['Si', 'Ge'], [20., 30.], 1.e-3, restart_files=['data/restart'])
+        eval_trace.finish('trace.jsonl')
+        assert eval_trace.summarize(['trace.jsonl'])['scf_steps_saved']['total'] == 0
+        # the fake socorro appends to the restart file it was given
+        with open('gcut_dir.30/workdir_r.4/data/restart') as fin:
+            assert fin.read().split() == ['gcut_dir.20', 'gcut_dir.30']
+
+
+def test_select_convergence_subset():
+    """ even spread without history, then unrecorded and slowest configurations """
+    assert eval_pp.select_convergence_subset(20, 0) == range(20)
+    assert eval_pp.select_convergence_subset(20, 4) == [0, 6, 13, 19]
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        with open('history', 'w') as fout:
+            fout.write('0 1e-4\n1 5e-4\n2 1e-4\n2 3e-4\n3 1e-5\n')
+        assert eval_pp.select_convergence_subset(4, 2, 'history') == [1, 2]
+        assert eval_pp.select_convergence_subset(6, 3, 'history') == [1, 4, 5]
+
+
+def test_eval_pp_main_convergence_subset(monkeypatch):
+    """ the ladder runs on the subset, the rest only at the converged gcut """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_eval_pp_workdir()
+        monkeypatch.setattr(eval_pp, '_run_socorro_worker',
+                            fake_socorro_worker(os.path.join(tmp_dir, 'started')))
+        monkeypatch.setattr(eval_pp, 'calc_work_objective', lambda runs: 1.)
+        objectives = eval_pp.main(['Si', 'Ge'], [20., 30., 40.], 1.e-3, convergence_subset=2,
+                                  convergence_history='../history')
+        assert objectives['num_runs'] == 6
+        assert sorted(os.listdir('gcut_dir.20')) == ['workdir_r.1', 'workdir_r.4']
+        assert len(os.listdir('gcut_dir.30')) == 4
+        with open('../history') as fin:
+            assert [line.split()[0] for line in fin] == ['0', '3']
+        shutil.rmtree('gcut_dir.20')
+        shutil.rmtree('gcut_dir.30')
+        # verification runs the rest at the gcut below as well
+        objectives = eval_pp.main(['Si', 'Ge'], [20., 30., 40.], 1.e-3, convergence_subset=2,
+                                  convergence_verify=True, convergence_history='../history')
+        assert objectives['num_runs'] == 8
+        with open('../history') as fin:
+            assert [line.split()[0] for line in fin] == ['0', '3', '0', '1', '2', '3']
+
+
+def test_gcut_ladder_runs_once(monkeypatch):
+    """ each configuration runs once per gcut; forces of configurations not run are nan """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_eval_pp_workdir()
+        monkeypatch.setattr(eval_pp, '_run_socorro_worker',
+                            fake_socorro_worker(os.path.join(tmp_dir, 'started')))
+        positions = eval_pp.get_random_configurations('../configurations.in')
+        ladder = eval_pp.GcutLadder(['Si', 'Ge'], [20., 30.], 1.e-3, positions,
+                                    workspace.Workspace())
+        try:
+            energies = ladder.run_levels([0], [1])
+            assert ladder.run_levels([0], [1]) == energies
+            assert ladder.run_levels([0], [0, 1])[0][1] == energies[0][0]
+            ladder.run_levels([1], [1])
+        finally:
+            ladder.cancel()
+        with open(os.path.join(tmp_dir, 'started')) as fin:
+            assert fin.read().split() == ['gcut_dir.20', 'gcut_dir.20', 'gcut_dir.30']
+        assert sorted(ladder.levels[0]) == [0, 1]
+        assert np.all(np.isfinite(ladder.level_forces[1][1]))
+        assert np.all(np.isnan(ladder.level_forces[1][0]))
+
+
+def make_dft_runs(n):
+    """ returns n DftRuns with the example templates, gcut 30 """
+    pp_path_list = [test_inputs_dir+'/PAW.Si', test_inputs_dir+'/PAW.Ge']
+    argvf_template_path = test_inputs_dir+'/argvf.template.example1'
+    crystal_template_path = test_inputs_dir+'/crystal.template.example1'
+    pos = [[0.0, 0, 0.1], [0.5, 0.6, 0.7]]
+    return [eval_pp.DftRun(pp_path_list, argvf_template_path, crystal_template_path, pos, 30.)
+            for _ in range(n)]
+
+
+@pytest.mark.parametrize('failure', ['exit code', 'no diaryf'])
+def test_position_sweep_fail_fast(monkeypatch, failure):
+    """ the first failed run cancels the others and raises SocorroFail """
+    def worker(run_dir, scf_watchdog=None):
+        if os.path.basename(run_dir) == 'workdir_r.2':
+            sys.exit(1 if failure == 'exit code' else 0)
+        time.sleep(30)
+    monkeypatch.setattr(eval_pp, '_run_socorro_worker', worker)
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        dft_runs = make_dft_runs(3)
+        sweep = eval_pp.start_position_sweep(dft_runs)
+        start = time.time()
+        with pytest.raises(eval_pp.SocorroFail):
+            eval_pp.wait_position_sweep(sweep)
+        assert time.time() - start < 20
+        assert not any(p.is_alive() for p in sweep.processes)
+
+
+def test_position_sweep_success(monkeypatch):
+    """ runs that exit cleanly with a finished diaryf pass """
+    monkeypatch.setattr(eval_pp, '_run_socorro_worker',
+                        lambda run_dir, scf_watchdog: shutil.copy(
+                            os.path.join(test_inputs_dir, 'diaryf.test_get_dft_results_2'),
+                            os.path.join(run_dir, 'diaryf')))
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        dft_runs = make_dft_runs(3)
+        eval_pp.position_sweep(dft_runs)
+        assert all(eval_pp.is_run_complete(run) for run in dft_runs)
+
+
+def test_position_sweep_queues_runs(monkeypatch):
+    """ with more runs than idle tiles, the rest wait for a free tile """
+    def worker(run_dir, scf_watchdog=None):
+        run_name = os.path.basename(run_dir)
+        running_dir = os.path.join(run_dir, '..', 'running')
+        open(os.path.join(running_dir, run_name), 'w').close()
+        with open(os.path.join(run_dir, '..', 'concurrency'), 'a') as fout:
+            fout.write('%d\n' % len(os.listdir(running_dir)))
+        time.sleep(0.3)
+        os.remove(os.path.join(running_dir, run_name))
+        shutil.copy(os.path.join(test_inputs_dir, 'diaryf.test_get_dft_results_2'),
+                    os.path.join(run_dir, 'diaryf'))
+    monkeypatch.setattr(eval_pp, '_run_socorro_worker', worker)
+    monkeypatch.setattr(eval_pp.di, 'available_tiles', lambda **kwargs: 2)
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        os.mkdir('running')
+        dft_runs = make_dft_runs(5)
+        sweep = eval_pp.start_position_sweep(dft_runs)
+        assert len(sweep.running) == 2 and len(sweep.pending) == 3
+        eval_pp.wait_position_sweep(sweep)
+        with open('concurrency') as fin:
+            assert max(int(n) for n in fin) <= 2
+        assert sweep.returncodes == dict((i, 0) for i in range(5))
+        assert sorted(sweep.seconds) == range(5)
+        assert all(eval_pp.is_run_complete(run) for run in dft_runs)
+
+
+def test_position_sweep_requeues_busy_tiles(monkeypatch):
+    """ a run that finds every tile taken is started again later """
+    def worker(run_dir, scf_watchdog=None):
+        tried = os.path.join(run_dir, 'tried')
+        if not os.path.exists(tried):
+            open(tried, 'w').close()
+            sys.exit(eval_pp.TILES_BUSY_EXIT)
+        shutil.copy(os.path.join(test_inputs_dir, 'diaryf.test_get_dft_results_2'),
+                    os.path.join(run_dir, 'diaryf'))
+    monkeypatch.setattr(eval_pp, '_run_socorro_worker', worker)
+    monkeypatch.setattr(eval_pp.di, 'available_tiles', lambda **kwargs: 3)
+    monkeypatch.setattr(eval_pp, 'TILE_RETRY_SECONDS', 0.)
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        dft_runs = make_dft_runs(3)
+        sweep = eval_pp.start_position_sweep(dft_runs)
+        eval_pp.wait_position_sweep(sweep)
+        assert len(sweep.processes) == 6
+        assert all(eval_pp.is_run_complete(run) for run in dft_runs)
+
+
+def test_position_sweep_requeue_recounts_tiles(monkeypatch):
+    """ after runs found no idle tile, the retries use the tiles that are idle again """
+    def worker(run_dir, scf_watchdog=None):
+        tried = os.path.join(run_dir, 'tried')
+        if not os.path.exists(tried):
+            open(tried, 'w').close()
+            sys.exit(eval_pp.TILES_BUSY_EXIT)
+        run_name = os.path.basename(run_dir)
+        running_dir = os.path.join(run_dir, '..', 'running')
+        open(os.path.join(running_dir, run_name), 'w').close()
+        with open(os.path.join(run_dir, '..', 'concurrency'), 'a') as fout:
+            fout.write('%d\n' % len(os.listdir(running_dir)))
+        time.sleep(0.5)
+        os.remove(os.path.join(running_dir, run_name))
+        shutil.copy(os.path.join(test_inputs_dir, 'diaryf.test_get_dft_results_2'),
+                    os.path.join(run_dir, 'diaryf'))
+    monkeypatch.setattr(eval_pp, '_run_socorro_worker', worker)
+    monkeypatch.setattr(eval_pp.di, 'available_tiles', lambda **kwargs: 4)
+    monkeypatch.setattr(eval_pp, 'TILE_RETRY_SECONDS', 0.)
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        os.mkdir('running')
+        dft_runs = make_dft_runs(4)
+        sweep = eval_pp.start_position_sweep(dft_runs)
+        eval_pp.wait_position_sweep(sweep)
+        with open('concurrency') as fin:
+            assert max(int(n) for n in fin) > 1
+
+
+def setup_fake_mpirun(monkeypatch, tmp_dir, script):
+    """
+    puts an mpirun running script on the PATH and sets up a two node
+    SLURM allocation with its tile locks in tmp_dir
+    """
+    os.mkdir('bin')
+    with open(os.path.join('bin', 'mpirun'), 'w') as fout:
+        fout.write('#!/bin/sh\n' + script)
+    os.chmod(os.path.join('bin', 'mpirun'), 0o755)
+    monkeypatch.setenv('PATH', os.path.join(tmp_dir, 'bin') + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('HOME', tmp_dir)
+    monkeypatch.setenv('SLURM_JOBID', '123')
+    monkeypatch.setenv('SLURM_TASKS_PER_NODE', '2(x2)')
+
+
+def test_position_sweep_direct(monkeypatch):
+    """ runs launched from the driver process queue for the two tiles and release them """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_fake_mpirun(monkeypatch, tmp_dir, 'sleep 0.2\ncp %s diaryf\n' %
+                          os.path.join(test_inputs_dir, 'diaryf.test_get_dft_results_2'))
+        dft_runs = make_dft_runs(5)
+        sweep = eval_pp.start_position_sweep(dft_runs, launch_engine='direct')
+        assert len(sweep.running) == 2
+        assert all(isinstance(p, eval_pp.SocorroLaunch) for p in sweep.running)
+        eval_pp.wait_position_sweep(sweep)
+        assert sweep.returncodes == dict((i, 0) for i in range(5))
+        assert all(eval_pp.is_run_complete(run) for run in dft_runs)
+        assert os.listdir('.DakotaEvalTiling') == []
+
+
+def test_position_sweep_direct_scf_watchdog(monkeypatch):
+    """ a diverging run launched directly is killed and fails the sweep """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_fake_mpirun(monkeypatch, tmp_dir, ''.join(
+            'echo "%s" >> diaryf\n' % line.rstrip() for line in scf_lines([1e-1, 2e-1, 4e-1, 8e-1])) +
+                          'exec sleep 30\n')
+        dft_runs = make_dft_runs(1)
+        sweep = eval_pp.start_position_sweep(dft_runs, launch_engine='direct',
+                                             scf_watchdog=diaryf.ScfWatchdog(divergence_steps=2))
+        start = time.time()
+        with pytest.raises(eval_pp.SocorroFail):
+            eval_pp.wait_position_sweep(sweep)
+        assert time.time() - start < 20
+        assert os.listdir('.DakotaEvalTiling') == []
+
+
+def test_wait_position_sweep_polls_others(monkeypatch):
+    """ a sweep that finishes while another is waited on releases its tiles """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_fake_mpirun(monkeypatch, tmp_dir, 'case $PWD in *slow*) sleep 1;; esac\ncp %s diaryf\n' %
+                          os.path.join(test_inputs_dir, 'diaryf.test_get_dft_results_2'))
+        os.mkdir('fast')
+        os.mkdir('slow')
+        fast = eval_pp.start_position_sweep(make_dft_runs(1), sweep_dir='fast', launch_engine='direct')
+        slow = eval_pp.start_position_sweep(make_dft_runs(1), sweep_dir='slow', launch_engine='direct')
+        eval_pp.wait_position_sweep(slow, [fast, slow])
+        assert fast.is_done() and fast.returncodes == {0: 0}
+        assert os.listdir('.DakotaEvalTiling') == []
+
+
+def test_release_tile_runs_on_sigterm(monkeypatch):
+    """ the SIGTERM handler of the direct launch engine frees the tiles """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        setup_fake_mpirun(monkeypatch, tmp_dir, 'exec sleep 30\n')
+        sweep = eval_pp.start_position_sweep(make_dft_runs(2), launch_engine='direct')
+        assert len(os.listdir('.DakotaEvalTiling')) == 2
+        with pytest.raises(SystemExit):
+            eval_pp._release_tiles_and_exit(signal.SIGTERM, None)
+        assert os.listdir('.DakotaEvalTiling') == []
+        assert all(p._tile_run.process.returncode is not None for p in sweep.running)
+
+
+def test_socorro_simulator(monkeypatch):
+    """ the socorro stand-in of the benchmarks replays a diaryf for each run """
+    simulators_dir = os.path.join(tools_for_tests.test_dir, '..', 'benchmarks', 'simulators')
+    inputs_dir = os.path.join(tools_for_tests.test_dir, 'test_inputs_integration', 'eval_pp_main_test')
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        monkeypatch.setenv('PATH', os.path.abspath(simulators_dir) + os.pathsep + os.environ['PATH'])
+        monkeypatch.setenv('HOME', tmp_dir)
+        monkeypatch.setenv('SLURM_JOBID', '123')
+        monkeypatch.setenv('SLURM_TASKS_PER_NODE', '2(x2)')
+        monkeypatch.setenv('OPAL_SIM_SOCORRO_RUNTIME', '0')
+        pos = [[0.0, 0, 0.1], [0.5, 0.6, 0.7]]
+        dft_runs = [eval_pp.DftRun([inputs_dir+'/PAW.Si', inputs_dir+'/PAW.Ge'],
+                                   inputs_dir+'/argvf.template', inputs_dir+'/crystal.template',
+                                   pos, gcut)
+                    for gcut in [20., 40., 60.]]
+        sweep = eval_pp.start_position_sweep(dft_runs, launch_engine='direct')
+        eval_pp.wait_position_sweep(sweep)
+        records = [run.parse_diaryf() for run in dft_runs]
+        assert [r['ng'] for r in records] == [20., 40., 60.]
+        assert [r['nd'] for r in records] == [80., 160., 240.]
+        assert all(r['niter'] == 19 and r['forces'].shape == (6,) for r in records)
+        # the energy converges with gcut
+        energies = [r['energy'] for r in records]
+        assert abs(energies[2] - energies[1]) < abs(energies[1] - energies[0])
+
+
+def test_read_diaryf():
+    """ one pass over diaryf gets everything calc_nflops and the objectives need """
+    record = diaryf.read_diaryf(os.path.join(test_inputs_dir, 'diaryf.test_calc_nflops'))
+    assert record['nb'] == 17
+    assert record['nkpnts'] == 32
+    assert record['nd'] == 160.
+    assert record['ng'] == 40.
+    assert record['niter'] == 19
+    assert len(record['scf_energies']) == 19
+    assert np.isclose(record['scf_energies'][0], -737.946658240)
+    assert record['energy'] == -20000.
+    assert len(record['forces']) == 6
+
+    record = diaryf.read_diaryf(os.path.join(test_inputs_dir, 'diaryf.test_get_dft_results_none'))
+    assert record['energy'] is None
+
+
+def test_get_dft_results_at_gcut_reuses_record(monkeypatch):
+    """ runs already parsed by wait_position_sweep aren't read again """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        run = eval_pp.DftRun([], '', '', [], -1)
+        run.run_dir = 'dir_1'
+        os.mkdir(run.run_dir)
+        shutil.copy(os.path.join(test_inputs_dir, 'diaryf.test_get_dft_results_2'),
+                    os.path.join(run.run_dir, 'diaryf'))
+        assert eval_pp.is_run_complete(run)
+
+        def fail(path):
+            raise AssertionError('diaryf read twice')
+        monkeypatch.setattr(diaryf, 'read_diaryf', fail)
+        dft_results = eval_pp.get_dft_results_at_gcut([run])
+        assert np.isclose(dft_results['energies'], [-738.821147137]).all()
+
+
+def test_parse_scf_step():
+    """ SCF step lines of diaryf are parsed, other lines are not """
+    with open(os.path.join(test_inputs_dir, 'diaryf.test_calc_nflops')) as fin:
+        steps = [s for s in map(diaryf.parse_scf_step, fin) if s is not None]
+    assert len(steps) == 19
+    assert steps[0] == (1, -737.946658240, None)
+    assert steps[1] == (2, -738.689642401, -7.4298E-01)
+
+
+def scf_lines(changes):
+    """ diaryf SCF step lines with the given energy changes """
+    lines = ['   Self-consistent step  1:  cell energy = -737.946658240\n']
+    for i, change in enumerate(changes):
+        lines.append('   Self-consistent step %2d:  cell energy = -738.0,  energy change = %.4E\n'
+                     % (i+2, change))
+    return lines
+
+
+def test_scf_progress_kill_reason():
+    """ growing or stagnating energy changes and too many steps kill the run """
+    converging = scf_lines([-1., 0.5, -0.1, 0.01, -0.001])
+    growing = scf_lines([-1., 0.1, -0.2, 0.3, -0.4])
+    oscillating = scf_lines([-1., 0.1, -0.2, 0.15, -0.2, 0.15])
+    for lines, kwargs, killed in [(converging, {'divergence_steps': 2, 'stagnation_steps': 3}, False),
+                                  (growing, {'divergence_steps': 3}, True),
+                                  (growing, {'divergence_steps': 4}, False),
+                                  (oscillating, {'stagnation_steps': 4}, True),
+                                  (converging, {'max_steps': 5}, True)]:
+        progress = diaryf.ScfProgress(**kwargs)
+        for line in lines:
+            progress.add(line)
+        assert (progress.kill_reason() is not None) == killed
+
+
+def test_scf_watchdog_notices_short_run():
+    """ a short run is noticed soon after it exits, not a poll_interval later """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        watchdog = diaryf.ScfWatchdog(max_steps=100, poll_interval=5.)
+        p = subprocess.Popen(['sleep', '0.2'])
+        start = time.time()
+        assert watchdog.monitor('diaryf', 'workdir_r.1')(p) == 0
+        assert time.time() - start < 1.
+
+
+def test_get_eval_pp_options_scf_watchdog():
+    """ the scf watchdog follows socorro runs only if a limit is set """
+    assert 'scf_watchdog' not in analysis_driver.get_eval_pp_options({})
+    watchdog = analysis_driver.get_eval_pp_options({'scf_max_steps': '50'})['scf_watchdog']
+    assert watchdog.max_steps == 50 and watchdog.divergence_steps is None
+
+
+def test_scf_watchdog_kills_diverging_run():
+    """ a run writing growing energy changes is terminated and traced """
+    with tools_for_tests.TemporaryDirectory() as tmp_dir:
+        with open('growing', 'w') as fout:
+            fout.writelines(scf_lines([-1., 0.1, -0.2, 0.3, -0.4]))
+        watchdog = diaryf.ScfWatchdog(divergence_steps=3, poll_interval=0.05)
+        eval_trace.start('spool')
+        p = subprocess.Popen(['sh', '-c', 'cat growing > diaryf; exec sleep 30'])
+        start = time.time()
+        returncode = watchdog.monitor('diaryf', 'workdir_r.1')(p)
+        eval_trace.finish('trace.jsonl')
+        assert time.time() - start < 10
+        assert returncode != 0
+        with open('trace.jsonl') as fin:
+            span, = json.loads(fin.read())['spans']
+        assert span['name'] == 'socorro.scf'
+        assert span['steps'] == 6
+        assert span['kill_reason'].startswith('energy change grew')
@@ -0,0 +1,52 @@
+"""
+absolute paths of the files of an evaluation, so nothing has to os.chdir
+
+The process working directory is shared by every thread, so code that
+changes it can't run concurrently in one process. Instead, the current
+directory is read once, where dakota starts the analysis driver, and
+everything below takes absolute paths from a Workspace. The layout on disk
+is the same as when each step changed into its directory:
+
+    campaign_dir/                   opal.in, configurations.in, ...
+        eval_dir/                   dakota's work directory of an evaluation
+            {elem}.in               atompaw input
+            {elem}_pseudopotential/ atompaw run
+            PAW.{elem}              link to the pseudopotential
+            argvf.template, crystal.template
+            gcut_dir.{gcut}/
+                workdir_r.{n}/      socorro run of configuration n
+            converged_gcut          name of the gcut_dir the energies converged in
+            eval_trace.spool        timing spans until the evaluation's trace line is written
+"""
+import os
+
+
+class Workspace(object):
+    """
+    eval_dir: the evaluation's directory, the current directory by default
+    """
+    def __init__(self, eval_dir=None):
+        if eval_dir is None:
+            eval_dir = os.getcwd()
+        self.eval_dir = os.path.abspath(eval_dir)
+        self.campaign_dir = os.path.dirname(self.eval_dir)
+
+    def path(self, *names):
+        """ returns path of names in eval_dir """
+        return os.path.join(self.eval_dir, *names)
+
+    def campaign_path(self, *names):
+        """ returns path of names in the campaign directory, eval_dir/.. """
+        return os.path.join(self.campaign_dir, *names)
+
+    def pseudopotential_dir(self, elem):
+        return self.path(elem+'_pseudopotential')
+
+    def gcut_dir(self, gcut):
+        return self.path('gcut_dir.' + str(int(gcut)))
+
+    def converged_gcut_file(self):
+        return self.path('converged_gcut')
+
+    def trace_spool_file(self):
+        return self.path('eval_trace.spool')